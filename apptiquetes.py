@@ -1,27 +1,51 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, current_app
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, current_app, Response
 import os
 import requests
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import is_resource_modified
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 from datetime import datetime
-from weasyprint import HTML
 import tempfile
 import logging
 import traceback
 import mimetypes
 import time
 import json
-import qrcode
+import hashlib
+import secrets
+import zipfile
+import click
+from urllib.parse import urlsplit
 from io import BytesIO
 from PIL import Image
 from openpyxl import Workbook, load_workbook
 from openpyxl.drawing.image import Image as ExcelImage
-from parser import parse_markdown_response
+from parser import parse_markdown_response, parsear_respuesta
+from ticket_data import TicketData, NO_DISPONIBLE
 from config import app
 from utils import Utils
-import random
-import string
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 from knowledge_updater import knowledge_bp
+from ocr_jobs import OCRJobQueue, ColaLlenaError, solicitar_ocr
+from ocr_cache import OCRCache, hash_archivo
+from guia_store import GuiaStore
+from guia_lifecycle import GuiaLifecycle, TransicionInvalidaError, etapas_completadas, ETAPAS, ETAPAS_POSTERIORES
+from patio import DifusorPatio, ClientesAgotadosError
+from autorizaciones import AutorizacionStore, VALIDO, INEXISTENTE, EXPIRADO, BLOQUEADO
+from outbox import Outbox
+from orquestador import Orquestador
+from base_maestra import base_maestra_bp, provider_index
+from webhook_client import WebhookClient
+from pdf_renderer import PDFRenderService
+from batch_ingest import BatchIngestor
+from image_prep import ImageNormalizer
+from upload_pipeline import ArchivoRechazadoError
+from upload_store import UploadStore
+from retention import RetentionManager, Politica, DIA
+from qr_service import QRService, clave_payload
+from render_cache import RenderCache
 
 
 # Configuración de Logging
@@ -31,7 +55,18 @@ logger = logging.getLogger(__name__)
 # Inicializar Utils
 utils = Utils(app)
 
+# Pool de procesos para renderizar PDFs fuera de la petición
+pdf_renderer = PDFRenderService(
+    app,
+    max_workers=app.config['PDF_WORKERS'],
+    timeout=app.config['PDF_RENDER_TIMEOUT']
+)
+
 app.register_blueprint(knowledge_bp)
+app.register_blueprint(base_maestra_bp)
+
+# Índice local de la base maestra para revalidar sin ir al webhook
+provider_index.cargar_ultimo(app.config['BASE_MAESTRA_FOLDER'])
 
 # En apptiquetes.py, al inicio después de las importaciones
 # Configuración de carpetas usando Utils
@@ -58,25 +93,165 @@ app.config.update(
     UPLOAD_FOLDER=os.path.join(app.static_folder, 'uploads'),
     PDF_FOLDER=os.path.join(app.static_folder, 'pdfs'),
     EXCEL_FOLDER=os.path.join(app.static_folder, 'excels'),
-    SECRET_KEY='tu_clave_secreta_aquí'
+    # Debe ser la misma en todos los procesos del servidor para que la cookie de sesión sea válida en cualquiera
+    SECRET_KEY=os.getenv('SECRET_KEY', 'tu_clave_secreta_aquí')
 )
 
 # Crear directorios necesarios
 for folder in ['GUIAS_FOLDER', 'UPLOAD_FOLDER', 'PDF_FOLDER', 'EXCEL_FOLDER']:
     os.makedirs(app.config[folder], exist_ok=True)
 
+# Las plantillas compiladas se guardan en disco y los procesos nuevos no las recompilan
+if app.config['TEMPLATE_BYTECODE_CACHE']:
+    carpeta_bytecode = os.path.join(app.config['DATA_FOLDER'], 'jinja_cache')
+    os.makedirs(carpeta_bytecode, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(carpeta_bytecode)
+
+# Fragmentos estáticos de las plantillas (estilos, scripts), renderizados una vez por proceso
+fragmentos = RenderCache(ttl=app.config['FRAGMENT_CACHE_TTL'], max_entradas=100)
+
+def renderizar_estatica(nombre):
+    """
+    Renderiza una plantilla que no depende del contexto, desde la caché de
+    fragmentos. Con recarga de plantillas (modo debug) no se cachea
+    """
+    if app.jinja_env.auto_reload:
+        return render_template(nombre)
+    return fragmentos.obtener_o_renderizar(nombre, None, lambda: render_template(nombre))
+
+@app.template_global()
+def fragmento(nombre):
+    """
+    Incluye un fragmento estático de templates/fragmentos
+    """
+    return Markup(renderizar_estatica(f"fragmentos/{nombre}"))
+
+@app.template_filter()
+def fecha_evento(timestamp):
+    """
+    Fecha y hora de un evento del historial de la guía
+    """
+    return datetime.fromtimestamp(timestamp).strftime("%d/%m/%Y %H:%M:%S")
+
+@app.after_request
+def cachear_uploads(response):
+    """
+    Las imágenes subidas con el hash en el nombre no cambian nunca: se
+    sirven con caché de larga duración para las tablets de portería
+    """
+    if (
+        request.endpoint == 'static'
+        and response.status_code == 200
+        and request.view_args.get('filename', '').startswith('uploads/')
+        and upload_store.es_inmutable(request.view_args['filename'][len('uploads/'):])
+    ):
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['UPLOAD_CACHE_MAX_AGE']
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+@app.before_request
+def iniciar_servicios():
+    """
+    Inicia los servicios de fondo del proceso: precalienta el pool de PDFs
+    sin bloquear (para que el primer tiquete del día no sea el más lento),
+    el borrado de códigos de autorización vencidos, el envío de
+    notificaciones pendientes y la retención de artefactos. Con gunicorn
+    se llama tras cada fork; con el servidor de desarrollo, con la primera
+    petición. Cada servicio arranca una sola vez por proceso
+    """
+    if app.config['PDF_WARMUP']:
+        pdf_renderer.warmup()
+    autorizaciones.iniciar()
+    outbox.iniciar()
+    if app.config['RETENTION_ENABLED']:
+        retention_manager.iniciar()
+
+def detener_servicios():
+    """
+    Apagado ordenado del proceso: espera los trabajos OCR encolados, detiene
+    los hilos de fondo y cierra el pool de PDFs
+    """
+    if not ocr_queue.esperar(app.config['SHUTDOWN_TIMEOUT']):
+        logger.warning("Apagado con trabajos OCR pendientes")
+    orquestador.cerrar()
+    outbox.detener()
+    retention_manager.detener()
+    autorizaciones.detener()
+    difusor_patio.detener()
+    pdf_renderer.cerrar()
+
+@app.before_request
+def recargar_base_maestra():
+    """
+    Toma el snapshot de la base maestra actualizado por otro proceso
+    """
+    provider_index.recargar_si_cambio(
+        app.config['BASE_MAESTRA_FOLDER'],
+        intervalo=app.config['BASE_MAESTRA_RELOAD_INTERVAL']
+    )
+
 @app.route('/guias/<filename>')
 def serve_guia(filename):
     """
-    Sirve los archivos HTML de las guías de proceso
+    Página de seguimiento de la guía (destino del QR), renderizada con su
+    estado actual. Las guías HTML estáticas anteriores se siguen sirviendo
     """
+    if filename.startswith('guia_') and filename.endswith('.html'):
+        guia = guia_store.obtener(filename[len('guia_'):-len('.html')])
+        if guia:
+            return respuesta_guia(guia)
+    
     try:
-        logger.info(f"Intentando servir guía: {filename}")
+        logger.info(f"Sirviendo guía estática: {filename}")
         return send_from_directory(app.config['GUIAS_FOLDER'], filename)
     except Exception as e:
         logger.error(f"Error sirviendo guía: {str(e)}")
         return render_template('error.html', message="Guía no encontrada"), 404
 
+def respuesta_guia(guia):
+    """
+    Responde la página de la guía desde la caché de render, con ETag y
+    Last-Modified según su última actualización en el almacén
+    """
+    etag = hashlib.sha1(f"{guia['codigo_guia']}:{guia['actualizado']}".encode('utf-8')).hexdigest()
+    ultima_modificacion = datetime.fromtimestamp(int(guia['actualizado']), timezone.utc)
+    
+    if not is_resource_modified(request.environ, etag=etag, last_modified=ultima_modificacion):
+        response = Response(status=304)
+    else:
+        html = guia_pages.obtener_o_renderizar(
+            guia['codigo_guia'],
+            guia['actualizado'],
+            lambda: render_template('guia_template.html', **datos_pagina_guia(guia))
+        )
+        response = Response(html, mimetype='text/html')
+    
+    response.set_etag(etag)
+    response.last_modified = ultima_modificacion
+    # Siempre se revalida, para que un escaneo muestre el estado actual
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/guias/<codigo_guia>/qr.<formato>')
+def guia_qr(codigo_guia, formato):
+    """
+    Código QR de seguimiento de la guía en PNG o SVG, generado en memoria
+    """
+    if formato not in ('png', 'svg') or not guia_store.obtener(codigo_guia):
+        return render_template('error.html', message="Guía no encontrada"), 404
+    
+    payload = url_seguimiento(codigo_guia)
+    if formato == 'png':
+        response = Response(qr_service.png(payload), mimetype='image/png')
+    else:
+        response = Response(qr_service.svg(payload), mimetype='image/svg+xml')
+    response.set_etag(clave_payload(payload))
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
 # URLs de los Webhooks en Make.com
 PROCESS_WEBHOOK_URL = "https://hook.us2.make.com/asrfb3kv3cw4o4nd43wylyasfx5yq55f"
 REGISTER_WEBHOOK_URL = "https://hook.us2.make.com/f63o7rmsuixytjfqxq3gjljnscqhiedl"
@@ -86,7 +261,282 @@ PESAJE_WEBHOOK_URL = "https://hook.us2.make.com/srw5ti54ulwuxtvocrj2lypa5pmq3im4
 AUTORIZACION_WEBHOOK_URL = "https://hook.us2.make.com/py29fwgfrehp9il45832acotytu8xr5s"
 REGISTRO_PESO_WEBHOOK_URL = "https://hook.us2.make.com/agxyjbyswl2cg1bor1wdrlfcgrll0y15"
 
-codigos_autorizacion = {}
+# Cliente compartido para todos los webhooks, con timeout por endpoint
+webhooks = WebhookClient(
+    pool_size=app.config['WEBHOOK_POOL_SIZE'],
+    reintentos=app.config['WEBHOOK_RETRIES'],
+    umbral_fallos=app.config['WEBHOOK_BREAKER_THRESHOLD'],
+    enfriamiento=app.config['WEBHOOK_BREAKER_COOLDOWN']
+)
+webhooks.registrar('process', PROCESS_WEBHOOK_URL, timeout=app.config['OCR_JOB_TIMEOUT'],
+                   plazo=app.config['OCR_JOB_TIMEOUT'])
+# El registro crea la guía en el sistema central: un 5xx no se reintenta
+webhooks.registrar('register', REGISTER_WEBHOOK_URL, timeout=30, idempotente=False)
+webhooks.registrar('revalidation', REVALIDATION_WEBHOOK_URL, timeout=30)
+webhooks.registrar('admin_notification', ADMIN_NOTIFICATION_WEBHOOK_URL, timeout=15, idempotente=False)
+webhooks.registrar('pesaje', PESAJE_WEBHOOK_URL, timeout=60)
+webhooks.registrar('autorizacion', AUTORIZACION_WEBHOOK_URL, timeout=15, idempotente=False)
+# Enviado por el outbox, que ya reintenta con su propia espera
+webhooks.registrar('registro_peso', REGISTRO_PESO_WEBHOOK_URL, timeout=15, reintentos=0, idempotente=False)
+
+# Pasos independientes de una operación, ejecutados en paralelo
+orquestador = Orquestador(app, max_workers=app.config['ORCHESTRATOR_WORKERS'])
+
+# Códigos de autorización de pesaje virtual, compartidos entre procesos
+autorizaciones = AutorizacionStore(
+    os.path.join(app.config['DATA_FOLDER'], 'autorizaciones.db'),
+    ttl=app.config['AUTORIZACION_TTL'],
+    max_intentos=app.config['AUTORIZACION_MAX_INTENTOS'],
+    intervalo_limpieza=app.config['AUTORIZACION_SWEEP_INTERVAL']
+)
+app.extensions['autorizaciones'] = autorizaciones
+
+# Imágenes subidas por hash de contenido, en subdirectorios fecha/prefijo
+upload_store = UploadStore(
+    app.config['UPLOAD_FOLDER'],
+    os.path.join(app.config['DATA_FOLDER'], 'uploads.db')
+)
+app.extensions['upload_store'] = upload_store
+app.add_template_global(upload_store.url, 'upload_url')
+
+# Estado de las guías en almacén local; la cookie de sesión solo guarda codigo_guia
+guia_store = GuiaStore(os.path.join(app.config['DATA_FOLDER'], 'guias.db'))
+guia_lifecycle = GuiaLifecycle(guia_store)
+
+# Notificaciones no críticas, enviadas en segundo plano con reintentos. Viven
+# en la base de las guías para encolarlas en la misma transacción del evento
+outbox = Outbox(
+    guia_store.ruta_db,
+    webhooks,
+    max_intentos=app.config['OUTBOX_MAX_ATTEMPTS'],
+    backoff=app.config['OUTBOX_BACKOFF']
+)
+app.extensions['outbox'] = outbox
+
+# Cambios de estado de las guías para el tablero del patio, leídos una vez por proceso
+difusor_patio = DifusorPatio(
+    guia_store,
+    capacidad=app.config['PATIO_BUFFER_SIZE'],
+    intervalo=app.config['PATIO_POLL_INTERVAL'],
+    max_clientes=app.config['PATIO_MAX_CLIENTES']
+)
+app.extensions['difusor_patio'] = difusor_patio
+
+# Caché persistente de resultados OCR por hash de imagen
+ocr_cache = OCRCache(
+    os.path.join(app.config['DATA_FOLDER'], 'ocr_cache.db'),
+    ttl=app.config['OCR_CACHE_TTL'],
+    max_entradas=app.config['OCR_CACHE_MAX_ENTRIES']
+)
+
+# Normalización de imágenes antes de enviarlas a OCR y pesaje; el original se conserva
+image_normalizer = ImageNormalizer(
+    max_workers=app.config['IMAGE_PREP_WORKERS'],
+    max_lado=app.config['IMAGE_PREP_MAX_EDGE'],
+    calidad=app.config['IMAGE_PREP_QUALITY'],
+    escala_grises=app.config['IMAGE_PREP_GRAYSCALE'],
+    habilitado=app.config['IMAGE_PREP_ENABLED']
+)
+
+def guardar_resultado_ocr(trabajo):
+    """
+    Guarda en la guía el resultado de un trabajo OCR, para que la consulta
+    de estado funcione desde cualquier proceso del servidor
+    """
+    if not trabajo['contexto']:
+        return
+    cambios = {'ocr_estado': trabajo['estado'], 'ocr_mensaje': trabajo['mensaje']}
+    if trabajo['estado'] == 'completado':
+        cambios['parsed_data'] = trabajo['resultado']
+    guia_store.actualizar(trabajo['contexto'], cambios)
+
+# Cola de trabajos OCR con pool acotado de workers
+ocr_queue = OCRJobQueue(
+    app,
+    webhooks,
+    'process',
+    max_workers=app.config['OCR_WORKERS'],
+    max_queue=app.config['OCR_QUEUE_MAX'],
+    timeout=app.config['OCR_JOB_TIMEOUT'],
+    cache=ocr_cache,
+    normalizador=image_normalizer,
+    al_finalizar=guardar_resultado_ocr
+)
+
+# Códigos QR de seguimiento generados en memoria (SVG en plantillas, PNG por HTTP)
+qr_service = QRService(max_entradas=app.config['QR_CACHE_MAX_ENTRIES'])
+app.extensions['qr_service'] = qr_service
+
+# Páginas de guía renderizadas; se invalidan al cambiar el estado de la guía
+guia_pages = RenderCache(
+    ttl=app.config['GUIA_RENDER_TTL'],
+    max_entradas=app.config['GUIA_RENDER_MAX_ENTRIES']
+)
+guia_store.suscribir(guia_pages.invalidar)
+
+def url_seguimiento(codigo_guia):
+    """
+    URL de seguimiento de la guía, que es el contenido de su código QR.
+    Se construye sobre URL_PUBLICA y no sobre el Host de la petición, que
+    puede ser una dirección interna del servidor
+    """
+    publica = urlsplit(app.config['URL_PUBLICA'])
+    adapter = app.url_map.bind(publica.netloc, script_name=publica.path or '/', url_scheme=publica.scheme)
+    return adapter.build('serve_guia', {'filename': f"guia_{codigo_guia}.html"}, force_external=True)
+
+
+def artefactos_referenciados():
+    """
+    Artefactos referenciados por el estado de las guías, con la última
+    actualización de la guía que los referencia
+    """
+    referencias = {'pdfs': {}, 'qr': {}}
+    for guia in guia_store.iterar():
+        for tipo, nombre in (
+            ('pdfs', guia.get('pdf_filename')),
+            ('pdfs', guia.get('pdf_pesaje')),
+            ('qr', guia.get('qr_filename'))
+        ):
+            if nombre:
+                referencias[tipo][nombre] = max(guia['actualizado'], referencias[tipo].get(nombre, 0))
+    return referencias
+
+def guia_html_vigente(nombre):
+    """
+    Una guía HTML estática cuya guía no está en el almacén sigue siendo la
+    página que sirve serve_guia para su QR, por eso no se elimina
+    """
+    return guia_store.obtener(nombre[len('guia_'):-len('.html')]) is None
+
+# Limpieza periódica de PDFs, temporales, guías HTML y QR
+retention_manager = RetentionManager(
+    os.path.join(app.config['DATA_FOLDER'], 'retencion.db'),
+    [
+        Politica(
+            'pdf_temporales',
+            app.config['PDF_FOLDER'],
+            ['tmp*.pdf', '*.tmp'],
+            max_edad=app.config['RETENTION_TMP_HOURS'] * 3600
+        ),
+        Politica(
+            'uploads_temporales',
+            os.path.join(app.config['UPLOAD_FOLDER'], '.tmp'),
+            ['*'],
+            max_edad=app.config['RETENTION_TMP_HOURS'] * 3600
+        ),
+        Politica(
+            'pdfs',
+            app.config['PDF_FOLDER'],
+            ['tiquete_*.pdf', 'pesaje_*.pdf', '[0-9][0-9][0-9][0-9]-*.pdf'],
+            max_edad=app.config['RETENTION_DAYS'] * DIA,
+            max_cantidad=app.config['RETENTION_MAX_FILES'],
+            gracia=app.config['RETENTION_ORPHAN_GRACE_DAYS'] * DIA,
+            archivar=app.config['RETENTION_ARCHIVE']
+        ),
+        Politica(
+            'guias_html',
+            app.config['GUIAS_FOLDER'],
+            ['guia_*.html'],
+            max_edad=app.config['RETENTION_DAYS'] * DIA,
+            max_cantidad=app.config['RETENTION_MAX_FILES'],
+            gracia=app.config['RETENTION_ORPHAN_GRACE_DAYS'] * DIA,
+            archivar=app.config['RETENTION_ARCHIVE'],
+            conservar=guia_html_vigente
+        ),
+        Politica(
+            'qr',
+            app.static_folder,
+            ['qr_*.png'],
+            max_edad=app.config['RETENTION_DAYS'] * DIA,
+            max_cantidad=app.config['RETENTION_MAX_FILES'],
+            gracia=app.config['RETENTION_ORPHAN_GRACE_DAYS'] * DIA,
+            archivar=app.config['RETENTION_ARCHIVE']
+        ),
+    ],
+    artefactos_referenciados,
+    app.config['ARCHIVE_FOLDER'],
+    intervalo=app.config['RETENTION_INTERVAL']
+)
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    El proceso está vivo y atiende peticiones.
+    """
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    El proceso puede recibir tráfico: almacenes accesibles, carpetas con
+    escritura y espacio en la cola OCR.
+    """
+    checks = {}
+    try:
+        guia_store.ultimo_evento()
+        checks['guias'] = True
+    except Exception as e:
+        logger.error(f"Almacén de guías no disponible: {str(e)}")
+        checks['guias'] = False
+    for carpeta in ('UPLOAD_FOLDER', 'PDF_FOLDER', 'DATA_FOLDER'):
+        checks[carpeta.lower()] = os.access(app.config[carpeta], os.W_OK)
+    cola = ocr_queue.metrics()
+    checks['cola_ocr'] = cola['profundidad_cola'] < cola['capacidad_cola']
+    
+    listo = all(checks.values())
+    return jsonify({'status': 'ok' if listo else 'error', 'pid': os.getpid(), 'checks': checks}), 200 if listo else 503
+
+@app.route('/retention_metrics', methods=['GET'])
+def retention_metrics():
+    """
+    Tamaño de las carpetas de artefactos y resultado de las últimas limpiezas.
+    """
+    return jsonify(retention_manager.metrics())
+
+@app.cli.command('retencion')
+@click.option('--simular', is_flag=True, help="Solo reporta lo que se eliminaría.")
+def ejecutar_retencion(simular):
+    """
+    Ejecuta la limpieza de artefactos generados.
+    """
+    resultado = retention_manager.ejecutar(forzar=True, simulacion=simular)
+    click.echo(json.dumps(resultado, indent=2, ensure_ascii=False))
+
+
+@app.cli.command('benchmark-parser')
+@click.argument('archivos', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--repeticiones', default=20, show_default=True, help="Pasadas sobre el corpus.")
+@click.option('--limite', default=1000, show_default=True, help="Respuestas a tomar de la caché OCR.")
+def benchmark_parser(archivos, repeticiones, limite):
+    """
+    Mide el parser de respuestas OCR sobre las respuestas guardadas en la
+    caché OCR y los archivos markdown dados.
+    """
+    corpus = ocr_cache.respuestas(limite)
+    for ruta in archivos:
+        with open(ruta, encoding='utf-8') as f:
+            corpus.append(f.read())
+    if not corpus:
+        raise click.ClickException("No hay respuestas guardadas para medir.")
+
+    filas = sum(len(parsear_respuesta(texto)) for texto in corpus)
+    duraciones = []
+    for _ in range(repeticiones):
+        for texto in corpus:
+            inicio = time.perf_counter()
+            parse_markdown_response(texto)
+            duraciones.append(time.perf_counter() - inicio)
+
+    duraciones.sort()
+    click.echo(json.dumps({
+        'respuestas': len(corpus),
+        'filas': filas,
+        'parseos': len(duraciones),
+        'total_ms': round(sum(duraciones) * 1000, 2),
+        'promedio_us': round(sum(duraciones) / len(duraciones) * 1e6, 1),
+        'p95_us': round(duraciones[int(len(duraciones) * 0.95) - 1] * 1e6, 1),
+        'max_us': round(duraciones[-1] * 1e6, 1)
+    }, indent=2))
 
 
 # Extensiones permitidas para subir
@@ -95,6 +545,22 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def guia_actual():
+    """
+    Retorna la guía asociada a la sesión actual, o un diccionario vacío
+    """
+    return guia_store.obtener(session.get('codigo_guia')) or {}
+
+def buscar_guia(codigo):
+    """
+    Busca la guía de un proveedor: primero la de la sesión y si no coincide,
+    la más reciente del almacén (por ejemplo, al escanear el QR en otra estación)
+    """
+    guia = guia_actual()
+    if guia and guia.get('codigo') == codigo:
+        return guia
+    return guia_store.ultima_por_codigo(codigo) or guia
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     session.clear()
@@ -103,24 +569,26 @@ def upload_file():
         file = request.files.get('file')
         if file and allowed_file(file.filename):
             try:
-                # Generar nombre seguro para el archivo
-                filename = secure_filename(file.filename)
-                # Asegurar que el directorio de uploads existe
-                os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-                
-                # Guardar el archivo
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(image_path)
+                # Guardar el archivo por bloques en el almacén, nombrado por su hash
+                recibido = upload_store.guardar_upload(file, max_bytes=app.config['MAX_UPLOAD_SIZE'])
+                image_path = recibido.ruta
                 
                 # Verificar que el archivo se guardó correctamente
                 if os.path.exists(image_path):
-                    session['image_filename'] = filename
+                    session['codigo_guia'] = guia_store.crear({
+                        'image_filename': recibido.clave,
+                        'image_original': secure_filename(file.filename),
+                        'image_hash': recibido.hash,
+                        'image_mime': recibido.mime
+                    })
                     logger.info(f"Imagen guardada exitosamente: {image_path}")
                     return redirect(url_for('processing'))
                 else:
                     logger.error(f"Error: El archivo no se guardó correctamente en {image_path}")
                     return render_template('error.html', message="Error al guardar el archivo.")
                     
+            except ArchivoRechazadoError as e:
+                return render_template('error.html', message=str(e)), e.status
             except Exception as e:
                 logger.error(f"Error guardando archivo: {str(e)}")
                 return render_template('error.html', message="Error procesando el archivo.")
@@ -130,7 +598,7 @@ def upload_file():
 
 @app.route('/processing')
 def processing():
-    image_filename = session.get('image_filename')
+    image_filename = guia_actual().get('image_filename')
     if not image_filename:
         return render_template('error.html', message="No se encontró una imagen para procesar.")
     return render_template('processing.html')
@@ -138,44 +606,39 @@ def processing():
 @app.route('/process_image', methods=['POST'])
 def process_image():
     """
-    Ruta que maneja el envío de la imagen al webhook y retorna la respuesta parseada.
+    Encola la imagen para su envío al webhook OCR y retorna el identificador del trabajo.
     """
-    image_filename = session.get('image_filename')
+    codigo_guia = session.get('codigo_guia')
+    guia = guia_actual()
+    image_filename = guia.get('image_filename')
     if not image_filename:
         return jsonify({"result": "error", "message": "No se encontró una imagen para procesar."}), 400
     
     try:
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
+        image_path = upload_store.ruta(image_filename)
         
         if not os.path.exists(image_path):
             logger.error(f"Archivo no encontrado: {image_path}")
             return jsonify({"result": "error", "message": "Archivo no encontrado."}), 404
         
-        # Verificaciones de archivo...
-        with open(image_path, 'rb') as f:
-            files = {'file': (image_filename, f, 'multipart/form-data')}
-            response = requests.post(PROCESS_WEBHOOK_URL, files=files)
-            
-        logger.info(f"Respuesta del Webhook: {response.status_code} - {response.text}")
+        # Una imagen idéntica ya procesada no vuelve al webhook
+        image_hash = guia.get('image_hash') or hash_archivo(image_path)
+        cached = ocr_cache.get(image_hash)
+        if cached:
+            guia_store.actualizar(codigo_guia, {'parsed_data': cached['parsed_data']})
+            return jsonify({"result": "ok", "cache": True})
         
-        if response.status_code != 200:
-            return jsonify({"result": "error", "message": f"Error del webhook: {response.text}"}), 500
-            
-        # Obtener y verificar la respuesta del texto
-        response_text = response.text.strip()
-        if not response_text:
-            return jsonify({"result": "error", "message": "Respuesta vacía del webhook."}), 500
-            
-        # Procesar la respuesta
-        parsed_data = parse_markdown_response(response_text)
-        if not parsed_data:
-            logger.error("No se pudieron parsear los datos de la respuesta.")
-            return jsonify({"result": "error", "message": "No se pudieron parsear los datos."}), 500
+        job_id = ocr_queue.enqueue(image_path, image_filename, image_hash=image_hash, contexto=codigo_guia)
+        guia_store.actualizar(codigo_guia, {'ocr_job_id': job_id, 'ocr_estado': 'en_cola', 'ocr_mensaje': ''})
         
-        # Guardar en sesión
-        session['parsed_data'] = parsed_data
-        return jsonify({"result": "ok"})
+        return jsonify({
+            "result": "en_cola",
+            "job_id": job_id,
+            "status_url": url_for('ocr_job_status', job_id=job_id)
+        }), 202
         
+    except ColaLlenaError as e:
+        return jsonify({"result": "error", "message": str(e)}), 503
     except Exception as e:
         logger.error(f"Error al procesar la imagen: {str(e)}")
         logger.error(traceback.format_exc())
@@ -183,14 +646,56 @@ def process_image():
             "result": "error", 
             "message": f"Error al procesar la imagen: {str(e)}"
         }), 500
+
+@app.route('/ocr_jobs/<job_id>', methods=['GET'])
+def ocr_job_status(job_id):
+    """
+    Retorna el estado de un trabajo OCR. Al completarse guarda los datos parseados en la guía.
+    """
+    guia = guia_actual()
+    if guia.get('ocr_job_id') != job_id:
+        return jsonify({"result": "error", "message": "Trabajo no encontrado."}), 404
+    
+    # El trabajo pudo encolarse en otro proceso del servidor: su resultado queda en la guía
+    trabajo = ocr_queue.get(job_id) or {
+        'estado': guia.get('ocr_estado', 'en_cola'),
+        'mensaje': guia.get('ocr_mensaje', '')
+    }
+    
+    if trabajo['estado'] == 'completado':
+        return jsonify({"result": "ok", "estado": trabajo['estado']})
+    
+    if trabajo['estado'] in OCRJobQueue.ESTADOS_FINALES:
+        return jsonify({
+            "result": "error",
+            "estado": trabajo['estado'],
+            "message": trabajo['mensaje']
+        })
+    
+    return jsonify({
+        "result": "pendiente",
+        "estado": trabajo['estado'],
+        "profundidad_cola": ocr_queue.metrics()['profundidad_cola']
+    })
+
+@app.route('/ocr_metrics', methods=['GET'])
+def ocr_metrics():
+    """
+    Métricas de la cola OCR para medir el throughput de la portería.
+    """
+    metrics = ocr_queue.metrics()
+    metrics['cache'] = ocr_cache.stats()
+    metrics['normalizacion'] = image_normalizer.metrics()
+    return jsonify(metrics)
     
 @app.route('/review', methods=['GET'])
 def review():
     """
     Muestra la página de revisión con la tabla de tres columnas.
     """
-    parsed_data = session.get('parsed_data', {})
-    image_filename = session.get('image_filename', '')
+    guia = guia_actual()
+    parsed_data = guia.get('parsed_data', {})
+    image_filename = guia.get('image_filename', '')
     
     if not parsed_data or not image_filename:
         return render_template('error.html', message="No hay datos para revisar.")
@@ -199,13 +704,10 @@ def review():
         logger.error("Formato de datos incorrecto")
         return render_template('error.html', message="Error en el formato de los datos.")
     
-    timestamp = datetime.now().timestamp()
-    
     return render_template(
         'review.html',
         image_filename=image_filename,
-        parsed_data=parsed_data,
-        timestamp=timestamp
+        parsed_data=parsed_data
     )
 
 # En apptiquetes.py, ruta update_data
@@ -216,23 +718,18 @@ def update_data():
         updated_data = request.get_json()
         logger.info(f"Datos recibidos en update_data: {updated_data}")
         
-        # Actualizar los datos en la sesión
-        parsed_data = session.get('parsed_data', {})
+        # Actualizar los datos de la guía
+        ticket = TicketData(guia_actual().get('parsed_data', {}))
+        parsed_data = ticket.parsed_data
         table_data = updated_data.get('table_data', [])
         
         # Actualizar todos los campos en parsed_data
         for row in table_data:
-            campo = row.get('campo')
-            valor_modificado = row.get('sugerido', '').strip()
-            
-            # Buscar y actualizar en parsed_data
-            for original_row in parsed_data.get('table_data', []):
-                if original_row['campo'] == campo:
-                    original_row['sugerido'] = valor_modificado
+            ticket.actualizar(row.get('campo'), row.get('sugerido', '').strip())
         
-        # Guardar parsed_data actualizado en sesión
-        session['parsed_data'] = parsed_data
-        logger.info(f"Datos actualizados en sesión: {parsed_data}")
+        # Guardar parsed_data actualizado en la guía
+        guia_store.actualizar(session.get('codigo_guia'), {'parsed_data': parsed_data})
+        logger.info(f"Datos actualizados en la guía: {parsed_data}")
 
         # Si hay campos críticos modificados (nombre o código), revalidar
         modifications = []
@@ -248,56 +745,13 @@ def update_data():
                     })
 
         if modifications:
+            # Intentar primero la revalidación contra el índice local, con los valores ya editados
+            resultado_local = revalidar_localmente(modifications, TicketData(parsed_data))
+            if resultado_local:
+                return jsonify({"status": "success", "data": resultado_local})
+            
             try:
-                response = requests.post(
-                    REVALIDATION_WEBHOOK_URL,
-                    json={"json": {"modificaciones": modifications}},
-                    headers={'Content-Type': 'application/json'},
-                    timeout=30
-                )
-                
-                logger.info(f"Respuesta del webhook - Status: {response.status_code}")
-                logger.info(f"Respuesta del webhook - Texto: {response.text}")
-                
-                if response.status_code == 200:
-                    try:
-                        webhook_data = response.json()
-                        return jsonify({
-                            "status": "success",
-                            "data": {
-                                "Result": webhook_data.get('Body', {}).get('Resultado', ''),
-                                "Codigo": webhook_data.get('Body', {}).get('Codigo', ''),
-                                "Nombre": webhook_data.get('Body', {}).get('Nombre', ''),
-                                "Nota": webhook_data.get('Body', {}).get('Nota', ''),
-                                "modificaciones": modifications,
-                                "webhook_status": response.status_code
-                            }
-                        })
-                    except ValueError:
-                        webhook_text = response.text
-                        if isinstance(webhook_text, str):
-                            webhook_data = {
-                                'Body': {
-                                    'Resultado': next((l.replace('Resultado:', '').strip() for l in webhook_text.split('\n') if 'Resultado:' in l), ''),
-                                    'Codigo': next((l.replace('Codigo:', '').strip().strip('"') for l in webhook_text.split('\n') if 'Codigo:' in l), ''),
-                                    'Nombre': next((l.replace('Nombre:', '').strip().strip('"') for l in webhook_text.split('\n') if 'Nombre:' in l), ''),
-                                    'Nota': next((l.replace('Nota:', '').strip() for l in webhook_text.split('\n') if 'Nota:' in l), '')
-                                }
-                            }
-                            return jsonify({
-                                "status": "success",
-                                "data": {
-                                    "Result": webhook_data['Body']['Resultado'],
-                                    "Codigo": webhook_data['Body']['Codigo'],
-                                    "Nombre": webhook_data['Body']['Nombre'],
-                                    "Nota": webhook_data['Body']['Nota'],
-                                    "modificaciones": modifications,
-                                    "webhook_status": response.status_code
-                                }
-                            })
-                else:
-                    raise Exception(f"Error en webhook: {response.text}")
-                    
+                return jsonify({"status": "success", "data": revalidar_webhook(modifications)})
             except requests.exceptions.RequestException as e:
                 logger.error(f"Error en petición al webhook: {str(e)}")
                 return jsonify({
@@ -317,30 +771,82 @@ def update_data():
             "message": str(e)
         }), 500
 
-@app.route('/processing', methods=['GET'])
-def processing_screen():
+def revalidar_webhook(modifications):
     """
-    Pantalla de carga mientras se procesa la revalidación.
+    Revalida las modificaciones con el webhook de revalidación.
     """
-    return render_template('processing.html')
-
+    response = webhooks.post(
+        'revalidation',
+        json={"json": {"modificaciones": modifications}},
+        headers={'Content-Type': 'application/json'}
+    )
+    
+    logger.info(f"Respuesta del webhook - Status: {response.status_code}")
+    logger.info(f"Respuesta del webhook - Texto: {response.text}")
+    
+    if response.status_code != 200:
+        raise Exception(f"Error en webhook: {response.text}")
+    
+    try:
+        webhook_data = response.json()
+    except ValueError:
+        webhook_text = response.text
+        webhook_data = {
+            'Body': {
+                'Resultado': next((l.replace('Resultado:', '').strip() for l in webhook_text.split('\n') if 'Resultado:' in l), ''),
+                'Codigo': next((l.replace('Codigo:', '').strip().strip('"') for l in webhook_text.split('\n') if 'Codigo:' in l), ''),
+                'Nombre': next((l.replace('Nombre:', '').strip().strip('"') for l in webhook_text.split('\n') if 'Nombre:' in l), ''),
+                'Nota': next((l.replace('Nota:', '').strip() for l in webhook_text.split('\n') if 'Nota:' in l), '')
+            }
+        }
+    
+    return {
+        "Result": webhook_data.get('Body', {}).get('Resultado', ''),
+        "Codigo": webhook_data.get('Body', {}).get('Codigo', ''),
+        "Nombre": webhook_data.get('Body', {}).get('Nombre', ''),
+        "Nota": webhook_data.get('Body', {}).get('Nota', ''),
+        "modificaciones": modifications,
+        "webhook_status": response.status_code
+    }
 
-# >>> NUEVO: Función para generar QR y devolver su nombre o ruta
-def generate_qr_image(codigo, nombre, fruta):
+def revalidar_localmente(modifications, ticket=None):
     """
-    Genera un archivo PNG de código QR que contenga info clave (código, agricultor, fruta).
-    Retorna el nombre de archivo PNG.
+    Revalida las modificaciones de código y nombre contra la base maestra local.
+    Si se da el tiquete, el campo no modificado se valida junto con el otro
+    (el código modificado debe corresponder al nombre actual y viceversa).
+    Retorna None si la validación local no es concluyente y se debe usar el webhook.
     """
-    content = f"Código: {codigo}\nAgricultor: {nombre}\nFruta: {fruta}"
-    qr_img = qrcode.make(content)
+    if not len(provider_index):
+        return None
     
-    # Guardarlo en static con un nombre único
-    qr_filename = f"qr_{codigo}_{int(time.time())}.png"
-    qr_path = os.path.join(app.static_folder, qr_filename)
-    qr_img.save(qr_path)
+    cambios = {mod['campo']: mod['valor_modificado'] for mod in modifications}
+    if ticket is not None:
+        for campo in ('Código', 'Nombre del Agricultor'):
+            if campo not in cambios and ticket.valor(campo) not in ('', NO_DISPONIBLE):
+                cambios[campo] = ticket.valor(campo)
+    proveedor = provider_index.validar(
+        codigo=cambios.get('Código'),
+        nombre=cambios.get('Nombre del Agricultor')
+    )
+    if not proveedor:
+        return None
     
-    # Retornar sólo el nombre, para usarlo en la plantilla
-    return qr_filename
+    logger.info(f"Revalidación local exitosa: {proveedor}")
+    return {
+        "Result": "Exitoso",
+        "Codigo": proveedor['codigo'],
+        "Nombre": proveedor['nombre'],
+        "Nota": f"Proveedor validado contra la base maestra local ({proveedor['tipo_proveedor']}).",
+        "modificaciones": modifications,
+        "origen": "local"
+    }
+
+@app.route('/processing', methods=['GET'])
+def processing_screen():
+    """
+    Pantalla de carga mientras se procesa la revalidación.
+    """
+    return render_template('processing.html')
 
 
 def generate_pdf(parsed_data, image_filename, fecha_procesamiento, hora_procesamiento, revalidation_data=None):
@@ -351,34 +857,27 @@ def generate_pdf(parsed_data, image_filename, fecha_procesamiento, hora_procesam
         logger.info("Iniciando generación de PDF")
         logger.info(f"Datos de revalidación: {revalidation_data}")
         
-        # Obtener fecha original del tiquete
-        fecha_registro = None
-        for row in parsed_data.get('table_data', []):
-            if row['campo'] == 'Fecha':
-                fecha_registro = row['original'] if row['sugerido'] == 'No disponible' else row['sugerido']
-                break
+        ticket = TicketData.de(parsed_data)
         
-        if not fecha_registro:
-            fecha_registro = datetime.now().strftime("%d-%m-%Y")
+        # Obtener fecha original del tiquete
+        fecha_registro = ticket.fecha_texto or datetime.now().strftime("%d-%m-%Y")
         
         # Preparar datos para el QR
         qr_data = {
-            "codigo": revalidation_data.get('Código') if revalidation_data else parsed_data.get('codigo', ''),
-            "nombre": revalidation_data.get('Nombre del Agricultor') if revalidation_data else parsed_data.get('nombre_agricultor', ''),
+            "codigo": revalidation_data.get('Código') if revalidation_data else ticket.valor('Código'),
+            "nombre": revalidation_data.get('Nombre del Agricultor') if revalidation_data else ticket.valor('Nombre del Agricultor'),
             "fecha": fecha_registro,
-            "placa": next((row['sugerido'] for row in parsed_data.get('table_data', []) if row['campo'] == 'Placa'), ''),
-            "transportador": next((row['sugerido'] for row in parsed_data.get('table_data', []) if row['campo'] == 'Transportador'), ''),
-            "cantidad_racimos": next((row['sugerido'] for row in parsed_data.get('table_data', []) if row['campo'] == 'Cantidad de Racimos'), '')
+            "placa": ticket.valor('Placa'),
+            "transportador": ticket.valor('Transportador'),
+            "cantidad_racimos": ticket.valor('Cantidad de Racimos')
         }
         
-        qr_filename = f"qr_{qr_data['codigo']}_{int(time.time())}.png"
-        qr_path = os.path.join(app.static_folder, qr_filename)
-        utils.generate_qr(qr_data, qr_path)
+        qr_svg = qr_service.svg(json.dumps(qr_data, ensure_ascii=False))
         
         # Renderizar plantilla
         rendered = render_template(
             'pdf_template.html',
-            parsed_data=parsed_data,
+            parsed_data=ticket.parsed_data,
             revalidation_data=revalidation_data,
             image_filename=image_filename,
             fecha_registro=fecha_registro,
@@ -386,33 +885,125 @@ def generate_pdf(parsed_data, image_filename, fecha_procesamiento, hora_procesam
             hora_procesamiento=hora_procesamiento,
             fecha_emision=datetime.now().strftime("%d-%m-%Y"),
             hora_emision=datetime.now().strftime("%H:%M:%S"),
-            qr_filename=qr_filename
+            qr_svg=qr_svg
         )
         
         # Generar PDF
         pdf_filename = f'tiquete_{qr_data["codigo"]}_{fecha_registro}.pdf'
-        pdf_path = os.path.join(app.config['PDF_FOLDER'], pdf_filename)
-        
-        HTML(
-            string=rendered,
-            base_url=app.static_folder
-        ).write_pdf(pdf_path)
-        
-        logger.info(f"PDF generado exitosamente: {pdf_filename}")
-        return pdf_filename
+        return utils.render_pdf(rendered, pdf_filename, 'pdf_tiquete.css')
         
     except Exception as e:
         logger.error(f"Error en generate_pdf: {str(e)}")
         logger.error(traceback.format_exc())
         raise Exception(f"Error generando PDF: {str(e)}")
 
+def enviar_registro(ticket, revalidation_data, fecha_tiquete, hora_procesamiento):
+    """
+    Registra la guía en el sistema central (webhook de registro)
+    """
+    try:
+        response = webhooks.post(
+            'register',
+            json={
+                "parsed_data": ticket.parsed_data,
+                "revalidation_data": revalidation_data,
+                "fecha": fecha_tiquete,
+                "hora": hora_procesamiento
+            },
+            headers={'Content-Type': 'application/json'}
+        )
+        
+        if response.status_code != 200:
+            logger.error(f"Error en webhook de registro: {response.text}")
+            raise Exception("Error al registrar en el sistema central")
+            
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error llamando webhook de registro: {str(e)}")
+        raise Exception("Error de conexión con el sistema central")
+
+def registrar_guia(codigo_guia, parsed_data, image_filename, data=None):
+    """
+    Registra la guía en el sistema central, le asigna su código definitivo y
+    genera el QR y el PDF. El webhook de registro y el QR y PDF se ejecutan
+    en paralelo; el código definitivo solo se asigna si el registro fue
+    exitoso. Retorna codigo_guia, codigo, pdf_filename y qr_url. Lanza
+    TransicionInvalidaError, antes de cualquier efecto, si la guía no existe
+    o ya fue registrada
+    """
+    guia = guia_store.obtener(codigo_guia)
+    if not guia:
+        raise TransicionInvalidaError("Guía no encontrada", status=404)
+    guia_lifecycle.verificar(guia, 'registro')
+    
+    ticket = TicketData.de(parsed_data)
+    fecha_tiquete = ticket.fecha_registro()
+    hora_procesamiento = datetime.now().strftime("%H:%M:%S")
+    
+    revalidation_data = utils.prepare_revalidation_data(ticket, data)
+    
+    codigo = revalidation_data.get('Código', '')
+    now = datetime.now()
+    nuevo_codigo_guia = f"{codigo}_{now.strftime('%Y%m%d_%H%M%S')}"
+    
+    def generar_documentos(codigo_guia_qr, pdf_filename):
+        # QR de seguimiento, generado en memoria y cacheado por contenido
+        qr_svg = qr_service.svg(url_seguimiento(codigo_guia_qr))
+        return utils.generate_pdf(
+            parsed_data=ticket,
+            image_filename=image_filename,
+            fecha_procesamiento=fecha_tiquete,
+            hora_procesamiento=hora_procesamiento,
+            revalidation_data=revalidation_data,
+            qr_svg=qr_svg,
+            pdf_filename=pdf_filename
+        )
+    
+    # El PDF se renderiza con un nombre provisional y solo reemplaza al
+    # definitivo (que puede ser el de otro tiquete del día) si el registro
+    # fue exitoso
+    pdf_filename = utils.nombre_pdf_tiquete(ticket)
+    pdf_temporal = f"tmp_{secrets.token_hex(8)}_{pdf_filename}"
+    try:
+        orquestador.en_paralelo(
+            registro=lambda: enviar_registro(ticket, revalidation_data, fecha_tiquete, hora_procesamiento),
+            pdf=lambda: generar_documentos(nuevo_codigo_guia, pdf_temporal)
+        )
+    except Exception:
+        pdf_renderer.descartar(pdf_temporal)
+        raise
+    
+    # Asignar el código de guía definitivo al borrador
+    codigo_guia = guia_store.renombrar(codigo_guia, nuevo_codigo_guia)
+    if codigo_guia == nuevo_codigo_guia:
+        pdf_renderer.promover(pdf_temporal, pdf_filename)
+    else:
+        # Otra guía tomó el código en el mismo segundo: el QR del PDF debe apuntar a esta
+        pdf_renderer.descartar(pdf_temporal)
+        generar_documentos(codigo_guia, pdf_filename)
+    
+    guia_lifecycle.aplicar(codigo_guia, 'registro', {
+        'codigo': codigo,
+        'fecha_registro_porteria': now.strftime("%d/%m/%Y"),
+        'hora_registro_porteria': now.strftime("%H:%M:%S"),
+        'pdf_filename': pdf_filename,
+        'revalidation_data': revalidation_data
+    })
+    
+    return {
+        'codigo_guia': codigo_guia,
+        'codigo': codigo,
+        'pdf_filename': pdf_filename,
+        'qr_url': url_for('guia_qr', codigo_guia=codigo_guia, formato='png')
+    }
+
 @app.route('/register', methods=['POST'])
 def register():
     try:
         logger.info("Iniciando proceso de registro")
         
-        parsed_data = session.get('parsed_data', {})
-        image_filename = session.get('image_filename', '')
+        guia = guia_actual()
+        parsed_data = guia.get('parsed_data', {})
+        image_filename = guia.get('image_filename', '')
         
         if not parsed_data or not image_filename:
             return jsonify({
@@ -423,71 +1014,22 @@ def register():
         try:
             data = request.get_json() if request.is_json else {}
             
-            fecha_tiquete = utils.get_ticket_date(parsed_data)
-            hora_procesamiento = datetime.now().strftime("%H:%M:%S")
-            
-            revalidation_data = utils.prepare_revalidation_data(parsed_data, data)
-            
-            # Enviar datos al webhook de registro
-            try:
-                response = requests.post(
-                    REGISTER_WEBHOOK_URL,
-                    json={
-                        "parsed_data": parsed_data,
-                        "revalidation_data": revalidation_data,
-                        "fecha": fecha_tiquete,
-                        "hora": hora_procesamiento
-                    },
-                    headers={'Content-Type': 'application/json'}
-                )
-                
-                if response.status_code != 200:
-                    logger.error(f"Error en webhook de registro: {response.text}")
-                    raise Exception("Error al registrar en el sistema central")
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error llamando webhook de registro: {str(e)}")
-                raise Exception("Error de conexión con el sistema central")
-            
-            # Generar QR
-            codigo = revalidation_data.get('Código', '')
-            timestamp = int(time.time())
-            qr_filename = f"qr_{codigo}_{timestamp}.png"
-            qr_path = os.path.join(app.static_folder, qr_filename)
-            
-            # Preparar datos para el QR
-            qr_data = {
-                "codigo": codigo,
-                "nombre": revalidation_data.get('Nombre del Agricultor', ''),
-                "fecha": fecha_tiquete,
-                "placa": revalidation_data.get('Placa', ''),
-                "transportador": revalidation_data.get('Transportador', ''),
-                "cantidad_racimos": revalidation_data.get('Cantidad de Racimos', '')
-            }
-            
-            utils.generate_qr(qr_data, qr_path)
-            session['qr_filename'] = qr_filename
-            
-            # Generar PDF
-            pdf_filename = utils.generate_pdf(
-                parsed_data=parsed_data,
-                image_filename=image_filename,
-                fecha_procesamiento=fecha_tiquete,
-                hora_procesamiento=hora_procesamiento,
-                revalidation_data=revalidation_data
-            )
-            
-            session['pdf_filename'] = pdf_filename
-            session['revalidation_data'] = revalidation_data
-            session['estado_actual'] = 'pesaje'
+            registro = registrar_guia(session['codigo_guia'], parsed_data, image_filename, data)
+            session['codigo_guia'] = registro['codigo_guia']
             
             return jsonify({
                 "status": "success",
                 "message": "Registro completado exitosamente",
-                "pdf_filename": pdf_filename,
-                "qr_filename": qr_filename
+                "pdf_filename": registro['pdf_filename'],
+                "pdf_status_url": url_for('pdf_job_status', pdf_filename=registro['pdf_filename']),
+                "qr_url": registro['qr_url']
             })
             
+        except TransicionInvalidaError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), e.status
         except Exception as e:
             logger.error(f"Error procesando registro: {str(e)}")
             return jsonify({
@@ -504,20 +1046,257 @@ def register():
 
 
     
+def revalidar_tiquete(parsed_data):
+    """
+    Revalida el código y nombre leídos del tiquete, primero contra la base
+    maestra local y luego con el webhook. Retorna None si no se validó.
+    """
+    ticket = TicketData.de(parsed_data)
+    modifications = [
+        {
+            "campo": campo,
+            "valor_anterior": ticket.original(campo),
+            "valor_modificado": ticket.valor(campo)
+        }
+        for campo in ('Código', 'Nombre del Agricultor')
+        if ticket.valor(campo) and ticket.valor(campo) != NO_DISPONIBLE
+    ]
+    if not modifications:
+        return None
+    
+    resultado = revalidar_localmente(modifications)
+    if not resultado:
+        try:
+            resultado = revalidar_webhook(modifications)
+        except Exception as e:
+            logger.error(f"Error revalidando tiquete del lote: {str(e)}")
+            return None
+    
+    if 'exitoso' not in str(resultado.get('Result', '')).lower():
+        return None
+    return resultado
+
+def procesar_item_lote(item, avanzar):
+    """
+    Flujo completo de un tiquete del lote: OCR, parseo, revalidación y registro.
+    Los tiquetes que no se pueden validar quedan en revisión para la portería.
+    """
+    avanzar('ocr')
+    cached = ocr_cache.get(item['image_hash'])
+    if cached:
+        parsed_data = cached['parsed_data']
+    else:
+        estado, parsed_data, mensaje = solicitar_ocr(
+            webhooks,
+            'process',
+            item['image_path'],
+            item['image_filename'],
+            app.config['OCR_JOB_TIMEOUT'],
+            cache=ocr_cache,
+            image_hash=item['image_hash'],
+            normalizador=image_normalizer
+        )
+        if estado != 'completado':
+            return {'estado': 'error', 'mensaje': mensaje}
+    
+    ticket = TicketData(parsed_data)
+    if not ticket:
+        return {'estado': 'error', 'mensaje': "No se encontraron datos en el tiquete."}
+    
+    codigo_guia = guia_store.crear({
+        'image_filename': item['image_filename'],
+        'parsed_data': parsed_data,
+        'lote_id': item['lote_id']
+    })
+    
+    avanzar('revalidacion')
+    revalidacion = revalidar_tiquete(ticket)
+    if not revalidacion:
+        guia_lifecycle.aplicar(codigo_guia, 'revision')
+        return {
+            'estado': 'revision',
+            'codigo_guia': codigo_guia,
+            'codigo': ticket.codigo,
+            'mensaje': "No se pudo validar el proveedor, requiere revisión manual."
+        }
+    
+    avanzar('registro')
+    registro = registrar_guia(codigo_guia, ticket, item['image_filename'], revalidacion)
+    return {
+        'estado': 'registrado',
+        'codigo_guia': registro['codigo_guia'],
+        'codigo': registro['codigo'],
+        'pdf_filename': registro['pdf_filename'],
+        'mensaje': revalidacion.get('Nota', '')
+    }
+
+# Ingesta de lotes con concurrencia acotada, independiente de la cola de portería
+batch_ingestor = BatchIngestor(
+    app,
+    os.path.join(app.config['DATA_FOLDER'], 'lotes.db'),
+    upload_store,
+    procesar_item_lote,
+    max_workers=app.config['BATCH_WORKERS'],
+    max_items=app.config['BATCH_MAX_ITEMS'],
+    max_bytes=app.config['MAX_UPLOAD_SIZE']
+)
+
+@app.route('/lotes', methods=['POST'])
+def crear_lote():
+    """
+    Recibe varias imágenes de tiquetes o un zip y las procesa como un lote.
+    """
+    archivos = request.files.getlist('files') + request.files.getlist('file')
+    fuentes = [(secure_filename(f.filename), f.stream) for f in archivos if f and f.filename]
+    if not fuentes:
+        return jsonify({"status": "error", "message": "No se recibieron archivos."}), 400
+    
+    try:
+        lote_id = batch_ingestor.crear_lote(
+            fuentes,
+            allowed_file,
+            origen='web'
+        )
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error creando lote: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"status": "error", "message": f"Error creando lote: {str(e)}"}), 500
+    
+    return jsonify({
+        "status": "success",
+        "lote_id": lote_id,
+        "total": batch_ingestor.obtener(lote_id)['total'],
+        "eventos_url": url_for('eventos_lote', lote_id=lote_id),
+        "resumen_url": url_for('resumen_lote', lote_id=lote_id)
+    }), 202
+
+@app.route('/lotes/<lote_id>', methods=['GET'])
+def resumen_lote(lote_id):
+    """
+    Reporte del lote con el resultado de cada tiquete.
+    """
+    resumen = batch_ingestor.resumen(lote_id)
+    if resumen is None:
+        return jsonify({"status": "error", "message": "Lote no encontrado."}), 404
+    return jsonify(resumen)
+
+@app.route('/lotes/<lote_id>/eventos', methods=['GET'])
+def eventos_lote(lote_id):
+    """
+    Progreso del lote por ítem como Server-Sent Events.
+    """
+    if batch_ingestor.obtener(lote_id) is None:
+        return jsonify({"status": "error", "message": "Lote no encontrado."}), 404
+    
+    desde = request.headers.get('Last-Event-ID', type=int) or request.args.get('desde', 0, type=int)
+    
+    def generar():
+        for evento_id, datos in batch_ingestor.eventos(lote_id, desde):
+            if evento_id is None:
+                yield ": ping\n\n"
+                continue
+            yield f"id: {evento_id}\nevent: {datos['tipo']}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+        yield f"event: resumen\ndata: {json.dumps(batch_ingestor.resumen(lote_id), ensure_ascii=False)}\n\n"
+    
+    return Response(generar(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.cli.command('ingestar-lote')
+@click.argument('rutas', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--reporte', type=click.Path(dir_okay=False), help="Archivo JSON para el reporte del lote.")
+def ingestar_lote(rutas, reporte):
+    """
+    Procesa un lote de imágenes de tiquetes (archivos, carpetas o zip).
+    """
+    archivos = []
+    for ruta in rutas:
+        if os.path.isdir(ruta):
+            archivos.extend(sorted(
+                os.path.join(ruta, nombre) for nombre in os.listdir(ruta)
+                if os.path.isfile(os.path.join(ruta, nombre))
+            ))
+        else:
+            archivos.append(ruta)
+    
+    def fuentes():
+        for ruta in archivos:
+            with open(ruta, 'rb') as f:
+                yield os.path.basename(ruta), f
+    
+    try:
+        lote_id = batch_ingestor.crear_lote(fuentes(), allowed_file, origen='cli')
+    except (ValueError, zipfile.BadZipFile) as e:
+        raise click.ClickException(str(e))
+    
+    total = batch_ingestor.obtener(lote_id)['total']
+    click.echo(f"Lote {lote_id}: {total} tiquetes")
+    
+    terminados = 0
+    for _, datos in batch_ingestor.eventos(lote_id):
+        if not datos or datos['tipo'] != 'item':
+            continue
+        if datos['estado'] in BatchIngestor.ESTADOS_FINALES:
+            terminados += 1
+            click.echo(f"[{terminados}/{total}] {datos['archivo']}: {datos['estado']} "
+                       f"{datos['codigo_guia']} {datos['mensaje']}".rstrip())
+        else:
+            click.echo(f"        {datos['archivo']}: {datos['etapa']}")
+    
+    resumen = batch_ingestor.resumen(lote_id)
+    
+    # Los PDFs se renderizan en el pool; esperar antes de terminar el proceso
+    for item in resumen['items']:
+        if item['pdf_filename'] and not pdf_renderer.wait(item['pdf_filename']):
+            click.echo(f"No se pudo generar el PDF {item['pdf_filename']}", err=True)
+    
+    click.echo(f"Resumen: {resumen['totales']} en {resumen['duracion']}s")
+    if reporte:
+        with open(reporte, 'w', encoding='utf-8') as f:
+            json.dump(resumen, f, indent=2, ensure_ascii=False)
+        click.echo(f"Reporte guardado en {reporte}")
+
 @app.route('/review_pdf')
 def review_pdf():
     """
     Muestra una página con el enlace del PDF generado y el código QR.
     """
-    pdf_filename = session.get('pdf_filename')
-    qr_filename = session.get('qr_filename')  # Asegúrate de que este valor se está guardando en la sesión
+    guia = guia_actual()
+    pdf_filename = guia.get('pdf_filename')
     
-    if not pdf_filename or not qr_filename:
+    if not pdf_filename:
         return render_template('error.html', message="No se encontró el PDF o QR generado.")
     
+    # Esperar a que el pool termine de renderizar el PDF
+    if not pdf_renderer.wait(pdf_filename):
+        return render_template('error.html', message="No se pudo generar el PDF del tiquete.")
+    
     return render_template('review_pdf.html', 
                          pdf_filename=pdf_filename,
-                         qr_filename=qr_filename)
+                         qr_url=url_for('guia_qr', codigo_guia=guia['codigo_guia'], formato='png'))
+
+@app.route('/pdf_jobs/<pdf_filename>', methods=['GET'])
+def pdf_job_status(pdf_filename):
+    """
+    Estado del renderizado de un PDF.
+    """
+    return jsonify({
+        "pdf_filename": pdf_filename,
+        "estado": pdf_renderer.estado(pdf_filename)
+    })
+
+@app.route('/pdf_metrics', methods=['GET'])
+def pdf_metrics():
+    """
+    Métricas de renderizado: pool de PDFs y cachés de QR y de páginas de guía.
+    """
+    metrics = pdf_renderer.metrics()
+    metrics['qr'] = qr_service.metrics()
+    metrics['paginas_guia'] = guia_pages.metrics()
+    return jsonify(metrics)
 
 @app.route('/test_webhook', methods=['GET'])
 def test_webhook():
@@ -525,7 +1304,7 @@ def test_webhook():
     Ruta de prueba para verificar la conectividad con el webhook.
     """
     try:
-        response = requests.get(PROCESS_WEBHOOK_URL)
+        response = webhooks.get('process')
         return jsonify({
             "status": "webhook accessible" if response.status_code == 200 else "webhook error",
             "status_code": response.status_code,
@@ -537,6 +1316,22 @@ def test_webhook():
             "message": str(e)
         })
 
+@app.route('/webhook_metrics', methods=['GET'])
+def webhook_metrics():
+    """
+    Latencias, reintentos y estado del circuito por webhook, y notificaciones en el outbox.
+    """
+    metrics = webhooks.metrics()
+    metrics['outbox'] = outbox.metrics()
+    return jsonify(metrics)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    mensaje = f"La petición supera el tamaño máximo de {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB."
+    if request.accept_mimetypes.best == 'text/html':
+        return render_template('error.html', message=mensaje), 413
+    return jsonify({"status": "error", "success": False, "message": mensaje}), 413
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('error.html', message="Página no encontrada."), 404
@@ -554,8 +1349,8 @@ def test_revalidation():
     }
     
     try:
-        response = requests.post(
-            REVALIDATION_WEBHOOK_URL,
+        response = webhooks.post(
+            'revalidation',
             json=test_payload,
             headers={'Content-Type': 'application/json'}
         )
@@ -573,37 +1368,148 @@ def revalidation_results():
     """
     Renderiza la página de resultados de revalidación
     """
-    return render_template('revalidation_results.html')
+    return renderizar_estatica('revalidation_results.html')
+
+def guia_de_etapa(codigo):
+    """
+    Guía sobre la que actúa una etapa: por codigo_guia o por código del proveedor
+    """
+    guia = guia_store.obtener(codigo) or buscar_guia(codigo)
+    if guia and codigo in (guia.get('codigo_guia'), guia.get('codigo')):
+        return guia
+    return None
+
+def aplicar_etapa(codigo, evento, datos):
+    """
+    Aplica un evento del ciclo de vida a la guía y retorna la respuesta JSON
+    """
+    guia = guia_de_etapa(codigo)
+    if not guia:
+        return jsonify({'success': False, 'message': 'Guía no encontrada'}), 404
+
+    try:
+        guia = guia_lifecycle.aplicar(guia['codigo_guia'], evento, datos)
+    except TransicionInvalidaError as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
+
+    return jsonify({
+        'success': True,
+        'codigo_guia': guia['codigo_guia'],
+        'estado_actual': guia['estado_actual'],
+        'etapas_completadas': etapas_completadas(guia['estado_actual'])
+    })
+
+def datos_de_etapa():
+    """
+    Datos enviados a una etapa, como JSON o como formulario
+    """
+    return request.get_json(silent=True) or request.form.to_dict()
 
 @app.route('/pesaje-inicial/<codigo>', methods=['GET', 'POST'])
 def pesaje_inicial(codigo):
     """Manejo de pesaje inicial (directo o virtual)"""
-    pass
+    if request.method == 'GET':
+        return redirect(url_for('pesaje', codigo=codigo))
+    return aplicar_etapa(codigo, 'pesaje_inicial', datos_de_etapa())
 
 @app.route('/clasificacion/<codigo>', methods=['GET', 'POST'])
 def clasificacion(codigo):
     """Manejo de clasificación de fruta (automático o manual)"""
-    pass
+    if request.method == 'GET':
+        return redirect(url_for('ver_guia', codigo=codigo))
+    return aplicar_etapa(codigo, 'clasificacion', datos_de_etapa())
 
 @app.route('/pesaje-tara/<codigo>', methods=['GET', 'POST'])
 def pesaje_tara(codigo):
     """Manejo de pesaje tara y generación de documentos"""
-    pass
+    if request.method == 'GET':
+        return redirect(url_for('ver_guia', codigo=codigo))
+    return aplicar_etapa(codigo, 'pesaje_tara', datos_de_etapa())
 
 @app.route('/salida/<codigo>', methods=['GET', 'POST'])
 def salida(codigo):
     """Manejo de proceso de salida y cierre de guía"""
-    pass
+    if request.method == 'GET':
+        return redirect(url_for('ver_guia', codigo=codigo))
+    return aplicar_etapa(codigo, 'salida', datos_de_etapa())
 
 @app.route('/seguimiento-guia/<codigo>')
 def seguimiento_guia(codigo):
     """Vista de seguimiento completo del proceso"""
-    pass
+    guia = guia_de_etapa(codigo)
+    if not guia:
+        return render_template('error.html', message="Guía no encontrada"), 404
+    return respuesta_guia(guia)
 
 @app.route('/actualizar-estado/<codigo>', methods=['POST'])
 def actualizar_estado(codigo):
-    """API para actualizar el estado de cualquier etapa del proceso"""
-    pass
+    """API para actualizar el estado de una etapa posterior al registro"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('evento'):
+        return jsonify({'success': False, 'message': 'Falta el evento'}), 400
+    if data['evento'] not in ETAPAS_POSTERIORES:
+        return jsonify({
+            'success': False,
+            'message': f"Evento no permitido: {data['evento']}. Se acepta uno de: {', '.join(ETAPAS_POSTERIORES)}"
+        }), 400
+    return aplicar_etapa(codigo, data['evento'], data.get('datos') or {})
+
+@app.route('/patio')
+def tablero_patio():
+    """
+    Tablero del patio: guías en proceso por etapa, actualizado en vivo
+    """
+    return render_template(
+        'patio.html',
+        etapas=ETAPAS,
+        estado=difusor_patio.estado(app.config['PATIO_HORAS'])
+    )
+
+@app.route('/patio/estado')
+def estado_patio():
+    """
+    Guías en el patio y el último evento incluido, para sincronizar el tablero
+    """
+    return jsonify(difusor_patio.estado(app.config['PATIO_HORAS']))
+
+@app.route('/patio/eventos')
+def eventos_patio():
+    """
+    Cambios de estado de las guías como Server-Sent Events, desde el canal
+    compartido del proceso. Cada conexión ocupa un hilo del servidor; al
+    superar PATIO_MAX_CLIENTES se responde 503 y el tablero consulta el
+    estado periódicamente hasta que haya lugar
+    """
+    desde = request.headers.get('Last-Event-ID', type=int)
+    if desde is None:
+        desde = request.args.get('desde', type=int)
+    
+    try:
+        difusor_patio.conectar()
+    except ClientesAgotadosError as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+    
+    def generar():
+        yield "retry: 3000\n\n"
+        for evento in difusor_patio.eventos(desde):
+            if evento is None:
+                yield ": ping\n\n"
+                continue
+            yield f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+    
+    response = Response(generar(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.call_on_close(difusor_patio.desconectar)
+    return response
+
+@app.route('/patio_metrics', methods=['GET'])
+def patio_metrics():
+    """
+    Clientes conectados y lecturas del canal de eventos del patio.
+    """
+    return jsonify(difusor_patio.metrics())
 
 @app.route('/pesaje/<codigo>', methods=['GET', 'POST'])
 def pesaje(codigo):
@@ -620,18 +1526,18 @@ def pesaje(codigo):
             tipo_pesaje = request.form.get('tipo_pesaje')
             peso_bruto = request.form.get('peso_bruto')
             
-            # Guardar datos de pesaje
-            session['peso_bruto'] = peso_bruto
-            session['tipo_pesaje'] = tipo_pesaje
-            session['fecha_pesaje'] = datetime.now().strftime("%Y-%m-%d")
-            session['hora_pesaje'] = datetime.now().strftime("%H:%M:%S")
-            
-            # Actualizar estado
-            actualizar_estado_guia(codigo, {
-                'estado': 'pesaje_completado',
-                'peso_bruto': peso_bruto,
-                'tipo_pesaje': tipo_pesaje
-            })
+            # Guardar datos de pesaje y actualizar estado
+            try:
+                guia = actualizar_estado_guia(codigo, 'pesaje_inicial', {
+                    'peso_bruto': peso_bruto,
+                    'tipo_pesaje': tipo_pesaje,
+                    'fecha_pesaje': datetime.now().strftime("%Y-%m-%d"),
+                    'hora_pesaje': datetime.now().strftime("%H:%M:%S")
+                })
+            except TransicionInvalidaError as e:
+                return render_template('error.html', message=str(e)), e.status
+            if not guia:
+                return render_template('error.html', message="Guía no encontrada"), 404
             
             return redirect(url_for('ver_guia', codigo=codigo))
             
@@ -656,19 +1562,35 @@ def procesar_pesaje_directo():
         
         if not foto:
             return jsonify({'success': False, 'message': 'Archivo no válido'})
-            
-        # Guardar la imagen temporalmente
-        filename = secure_filename(foto.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        foto.save(temp_path)
         
-        # Enviar al webhook de Make para procesamiento
-        with open(temp_path, 'rb') as f:
-            response = requests.post(
-                PESAJE_WEBHOOK_URL,
-                files={'file': (filename, f, 'image/jpeg')},
-                data={'codigo': codigo}
+        # Validar la etapa antes de llamar al webhook y generar el PDF
+        try:
+            if not verificar_etapa(codigo, 'pesaje_inicial'):
+                return jsonify({'success': False, 'message': 'Guía no encontrada'}), 404
+        except TransicionInvalidaError as e:
+            return jsonify({'success': False, 'message': str(e)}), e.status
+            
+        # Guardar la imagen por bloques en el almacén y conservar el archivo abierto
+        try:
+            recibido = upload_store.guardar_upload(
+                foto,
+                max_bytes=app.config['MAX_UPLOAD_SIZE'],
+                mantener_abierto=True
             )
+        except ArchivoRechazadoError as e:
+            return jsonify({'success': False, 'message': str(e)}), e.status
+        
+        # Enviar al webhook de Make la imagen normalizada, o la original desde el handle abierto
+        filename = recibido.clave
+        with recibido:
+            nombre_envio, archivo = image_normalizer.abrir(recibido.ruta, recibido.archivo)
+            mime = recibido.mime if archivo is recibido.archivo else 'image/jpeg'
+            with archivo:
+                response = webhooks.post(
+                    'pesaje',
+                    files={'file': (nombre_envio, archivo, mime)},
+                    data={'codigo': codigo}
+                )
         
         # Procesar respuesta del webhook
         if response.status_code == 200:
@@ -681,9 +1603,6 @@ def procesar_pesaje_directo():
                     peso = peso_match.group(1)
                     fecha_hora_actual = datetime.now()
                     
-                    # Guardar nombre de la imagen
-                    session['imagen_pesaje'] = filename
-                    
                     # Generar PDF de pesaje
                     pdf_pesaje = generar_pdf_pesaje(
                         codigo=codigo,
@@ -692,49 +1611,43 @@ def procesar_pesaje_directo():
                         imagen_peso=filename
                     )
                     
-                    # Registrar en Make.com
-                    registro_response = requests.post(
-                        REGISTRO_PESO_WEBHOOK_URL,
-                        json={
-                            'codigo': codigo,
-                            'peso_bruto': peso,
-                            'tipo_pesaje': 'directo',
-                            'fecha': fecha_hora_actual.strftime("%Y-%m-%d"),
-                            'hora': fecha_hora_actual.strftime("%H:%M:%S")
-                        }
-                    )
-                    
-                    if registro_response.status_code != 200:
-                        return jsonify({
-                            'success': False,
-                            'message': 'Error registrando el peso en el sistema'
-                        })
-                    
                     # Construir datos completos para guardar
                     datos_pesaje = {
-                        'estado': 'pesaje_completado',
-                        'estado_actual': 'pesaje_completado',
                         'peso_bruto': peso,
                         'tipo_pesaje': 'directo',
                         'fecha_pesaje': fecha_hora_actual.strftime("%Y-%m-%d"),
                         'hora_pesaje': fecha_hora_actual.strftime("%H:%M:%S"),
                         'pdf_pesaje': pdf_pesaje,
-                        'imagen_pesaje': filename,
-                        'codigo_guia': f"{codigo}_{fecha_hora_actual.strftime('%Y%m%d_%H%M%S')}"
+                        'imagen_pesaje': filename
                     }
                     
-                    # Guardar en sesión
-                    session.update(datos_pesaje)
-                    
-                    # Actualizar estado en la guía
-                    actualizar_estado_guia(codigo, datos_pesaje)
+                    # Actualizar estado en la guía y, en la misma transacción,
+                    # encolar el registro en Make.com (se envía en segundo plano)
+                    registro_peso = {
+                        'codigo': codigo,
+                        'peso_bruto': peso,
+                        'tipo_pesaje': 'directo',
+                        'fecha': fecha_hora_actual.strftime("%Y-%m-%d"),
+                        'hora': fecha_hora_actual.strftime("%H:%M:%S")
+                    }
+                    try:
+                        guia = actualizar_estado_guia(
+                            codigo, 'pesaje_inicial', datos_pesaje,
+                            en_transaccion=lambda conexion: outbox.encolar('registro_peso', registro_peso, conexion)
+                        )
+                    except TransicionInvalidaError as e:
+                        return jsonify({'success': False, 'message': str(e)}), e.status
+                    if not guia:
+                        return jsonify({'success': False, 'message': 'Guía no encontrada'}), 404
                     
                     logger.info(f"Estado actualizado para guía {codigo}: {datos_pesaje}")
                     
                     return jsonify({
                         'success': True,
                         'peso': peso,
-                        'message': 'Peso procesado correctamente'
+                        'message': 'Peso procesado correctamente',
+                        'pdf_filename': pdf_pesaje,
+                        'pdf_status_url': url_for('pdf_job_status', pdf_filename=pdf_pesaje) if pdf_pesaje else None
                     })
                     
                 else:
@@ -753,6 +1666,8 @@ def procesar_pesaje_directo():
                 'message': 'Error procesando la imagen'
             })
             
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         logger.error(f"Error en pesaje directo: {str(e)}")
         logger.error(traceback.format_exc())
@@ -774,18 +1689,12 @@ def solicitar_autorizacion_pesaje():
                 'message': 'Faltan datos requeridos'
             })
             
-        # Generar código aleatorio de 6 caracteres
-        codigo_autorizacion = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        
-        # Guardar código con expiración de 1 hora
-        codigos_autorizacion[codigo] = {
-            'codigo': codigo_autorizacion,
-            'expiracion': datetime.now() + timedelta(hours=1)
-        }
+        # Generar y guardar código aleatorio de 6 caracteres con expiración
+        codigo_autorizacion = autorizaciones.emitir(codigo)
         
         # Enviar solicitud a Make
-        response = requests.post(
-            AUTORIZACION_WEBHOOK_URL,
+        response = webhooks.post(
+            'autorizacion',
             json={
                 'codigo_guia': codigo,
                 'comentarios': comentarios,
@@ -822,30 +1731,20 @@ def validar_codigo_autorizacion():
                 'message': 'Faltan datos requeridos'
             })
             
-        # Verificar código
-        auth_data = codigos_autorizacion.get(codigo_guia)
-        if not auth_data:
-            return jsonify({
-                'success': False,
-                'message': 'No hay solicitud de autorización activa'
-            })
-            
-        # Verificar expiración
-        if datetime.now() > auth_data['expiracion']:
-            codigos_autorizacion.pop(codigo_guia)
-            return jsonify({
-                'success': False,
-                'message': 'El código ha expirado'
-            })
-            
-        # Verificar código
-        if auth_data['codigo'] != codigo_autorizacion:
-            return jsonify({
-                'success': False,
-                'message': 'Código inválido'
-            })
-            
-        return jsonify({'success': True})
+        # Verificar código, expiración e intentos
+        resultado = autorizaciones.validar(codigo_guia, codigo_autorizacion)
+        if resultado == VALIDO:
+            return jsonify({'success': True})
+        
+        mensajes = {
+            INEXISTENTE: 'No hay solicitud de autorización activa',
+            EXPIRADO: 'El código ha expirado',
+            BLOQUEADO: 'Demasiados intentos, solicite un nuevo código'
+        }
+        return jsonify({
+            'success': False,
+            'message': mensajes.get(resultado, 'Código inválido')
+        })
         
     except Exception as e:
         logger.error(f"Error validando código: {str(e)}")
@@ -871,20 +1770,13 @@ def generar_pdf_pesaje(codigo, peso_bruto, tipo_pesaje, imagen_peso=None):
             'fecha_generacion': fecha_actual.strftime('%d/%m/%Y'),
             'hora_generacion': fecha_actual.strftime('%H:%M:%S'),
             'imagen_peso': imagen_peso,
-            'qr_filename': session.get('qr_filename')
+            'qr_svg': qr_service.svg(url_seguimiento(datos_guia['codigo_guia'])) if datos_guia.get('codigo_guia') else ''
         }
         
         # Generar PDF
         rendered = render_template('pesaje_pdf_template.html', **datos_pdf)
         pdf_filename = f"pesaje_{codigo}_{fecha_actual.strftime('%Y%m%d_%H%M%S')}.pdf"
-        pdf_path = os.path.join(app.config['PDF_FOLDER'], pdf_filename)
-        
-        # Asegurar que el directorio existe
-        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-        
-        HTML(string=rendered, base_url=app.static_folder).write_pdf(pdf_path)
-        logger.info(f"PDF de pesaje generado exitosamente: {pdf_filename}")
-        return pdf_filename
+        return utils.render_pdf(rendered, pdf_filename, 'pdf_pesaje.css')
         
     except Exception as e:
         logger.error(f"Error generando PDF de pesaje: {str(e)}")
@@ -904,6 +1796,13 @@ def registrar_peso_virtual():
                 'message': 'Faltan datos requeridos'
             })
         
+        # Validar la etapa antes de generar el PDF
+        try:
+            if not verificar_etapa(codigo, 'pesaje_inicial'):
+                return jsonify({'success': False, 'message': 'Guía no encontrada'}), 404
+        except TransicionInvalidaError as e:
+            return jsonify({'success': False, 'message': str(e)}), e.status
+        
         # Fecha y hora actual
         fecha_hora = datetime.now()
         
@@ -917,7 +1816,6 @@ def registrar_peso_virtual():
         
         # Datos a guardar
         datos_pesaje = {
-            'estado': 'pesaje_completado',
             'peso_bruto': peso,
             'tipo_pesaje': 'virtual',
             'fecha_pesaje': fecha_hora.strftime("%Y-%m-%d"),
@@ -925,15 +1823,21 @@ def registrar_peso_virtual():
             'pdf_pesaje': pdf_filename
         }
         
-        # Guardar en sesión
-        session.update(datos_pesaje)
-        
         # Actualizar estado
-        actualizar_estado_guia(codigo, datos_pesaje)
+        try:
+            guia = actualizar_estado_guia(codigo, 'pesaje_inicial', datos_pesaje)
+        except TransicionInvalidaError as e:
+            return jsonify({'success': False, 'message': str(e)}), e.status
+        if not guia:
+            return jsonify({'success': False, 'message': 'Guía no encontrada'}), 404
         
         logger.info(f"Estado actualizado para guía {codigo}: {datos_pesaje}")
         
-        return jsonify({'success': True})
+        return jsonify({
+            'success': True,
+            'pdf_filename': pdf_filename,
+            'pdf_status_url': url_for('pdf_job_status', pdf_filename=pdf_filename) if pdf_filename else None
+        })
         
     except Exception as e:
         logger.error(f"Error registrando peso virtual: {str(e)}")
@@ -945,62 +1849,13 @@ def obtener_datos_guia(codigo):
     Obtiene los datos actuales de la guía usando los datos más recientes
     """
     try:
-        # Obtener datos de la sesión
-        parsed_data = session.get('parsed_data', {})
-        revalidation_data = session.get('revalidation_data', {})
-        image_filename = session.get('image_filename')
-
-        # Fecha y hora actual
-        now = datetime.now()
-        
-        # Datos básicos
-        datos = {
-            'codigo': codigo,
-            'nombre': '',
-            'fecha_registro': '',  # Se llenará con la fecha del tiquete
-            'hora_registro': now.strftime("%H:%M:%S"),
-            'placa': '',
-            'transportador': '',
-            'cantidad_racimos': '',
-            'estado_actual': session.get('estado_actual', 'pesaje'),
-            'image_filename': image_filename,
-            'pdf_filename': session.get('pdf_filename', ''),
-        }
-        
-        # Extraer datos del parsed_data
-        if parsed_data and 'table_data' in parsed_data:
-            for row in parsed_data['table_data']:
-                campo = row['campo']
-                valor = row['original'] if row['sugerido'] == 'No disponible' else row['sugerido']
-                
-                if campo == 'Fecha':
-                    # Intentar diferentes formatos de fecha
-                    try:
-                        # Intenta formato dd-mm-yyyy
-                        fecha_obj = datetime.strptime(valor, "%d-%m-%Y")
-                        datos['fecha_registro'] = fecha_obj.strftime("%d/%m/%Y")
-                    except ValueError:
-                        try:
-                            # Intenta formato yyyy-mm-dd
-                            fecha_obj = datetime.strptime(valor, "%Y-%m-%d")
-                            datos['fecha_registro'] = fecha_obj.strftime("%d/%m/%Y")
-                        except ValueError:
-                            datos['fecha_registro'] = valor
-                elif campo == 'Nombre del Agricultor':
-                    datos['nombre'] = valor
-                elif campo == 'Código':
-                    datos['codigo'] = valor
-                elif campo == 'Placa':
-                    datos['placa'] = valor
-                elif campo == 'Cantidad de Racimos':
-                    datos['cantidad_racimos'] = valor
-                elif campo == 'Transportador':
-                    datos['transportador'] = valor
-
-        # Si no se encontró fecha, usar la fecha actual
-        if not datos['fecha_registro']:
-            datos['fecha_registro'] = now.strftime("%d/%m/%Y")
+        # Obtener la guía del almacén
+        guia = buscar_guia(codigo)
+        if not guia:
+            logger.warning(f"No se encontró guía para el código {codigo}")
+            return {}
         
+        datos = datos_de_guia(guia, codigo)
         logger.info(f"Datos obtenidos para guía {codigo}: {datos}")
         return datos
         
@@ -1008,49 +1863,119 @@ def obtener_datos_guia(codigo):
         logger.error(f"Error obteniendo datos de guía: {str(e)}")
         logger.error(traceback.format_exc())
         return {}
+
+def datos_de_guia(guia, codigo=None):
+    """
+    Datos de la guía para las plantillas y los PDFs, a partir de su estado en el almacén
+    """
+    codigo = codigo or guia.get('codigo', '')
+    parsed_data = guia.get('parsed_data', {})
+    revalidation_data = guia.get('revalidation_data', {})
+    image_filename = guia.get('image_filename')
+
+    # Fecha y hora actual
+    now = datetime.now()
+    
+    # Datos básicos
+    datos = {
+        'codigo': codigo,
+        'codigo_guia': guia.get('codigo_guia', ''),
+        'nombre': '',
+        'fecha_registro': '',  # Se llenará con la fecha del tiquete
+        'hora_registro': now.strftime("%H:%M:%S"),
+        'placa': '',
+        'transportador': '',
+        'cantidad_racimos': '',
+        'estado_actual': guia.get('estado_actual') or 'pesaje',
+        'etapas_completadas': etapas_completadas(guia.get('estado_actual') or 'pesaje'),
+        'image_filename': image_filename,
+        'pdf_filename': guia.get('pdf_filename', ''),
+        'qr_filename': guia.get('qr_filename', ''),
+        # Datos de pesaje
+        'peso_bruto': guia.get('peso_bruto', ''),
+        'tipo_pesaje': guia.get('tipo_pesaje', ''),
+        'fecha_pesaje': guia.get('fecha_pesaje', ''),
+        'hora_pesaje': guia.get('hora_pesaje', ''),
+        'pdf_pesaje': guia.get('pdf_pesaje', ''),
+        'imagen_pesaje': guia.get('imagen_pesaje', ''),
+        # Datos de clasificación, pesaje tara y salida
+        'clasificacion': guia.get('clasificacion', ''),
+        'fecha_clasificacion': guia.get('fecha_clasificacion', ''),
+        'hora_clasificacion': guia.get('hora_clasificacion', ''),
+        'peso_tara': guia.get('peso_tara', ''),
+        'peso_neto': guia.get('peso_neto', ''),
+        'fecha_pesaje_tara': guia.get('fecha_pesaje_tara', ''),
+        'hora_pesaje_tara': guia.get('hora_pesaje_tara', ''),
+        'fecha_salida': guia.get('fecha_salida', ''),
+        'hora_salida': guia.get('hora_salida', '')
+    }
+    
+    # Extraer datos del parsed_data
+    ticket = TicketData(parsed_data)
+    datos.update({
+        'codigo': ticket.valor('Código', codigo),
+        'nombre': ticket.valor('Nombre del Agricultor'),
+        'fecha_registro': ticket.fecha_registro(conservar_texto=True),
+        'placa': ticket.valor('Placa'),
+        'transportador': ticket.valor('Transportador'),
+        'cantidad_racimos': ticket.valor('Cantidad de Racimos')
+    })
+    
+    return datos
     
-def actualizar_estado_guia(codigo, datos):
+def actualizar_estado_guia(codigo, evento, datos, en_transaccion=None):
     """
-    Actualiza el estado y datos de la guía
-    Por ahora guardamos en sesión, luego será en base de datos
+    Registra una etapa del proceso (evento del ciclo de vida) en la guía del
+    proveedor. Retorna la guía actualizada o None si no existe; lanza
+    TransicionInvalidaError si la etapa no se puede aplicar.
+    en_transaccion(conexion) se ejecuta antes de confirmar el evento
     """
-    try:
-        # Actualizar datos en la sesión
-        for key, value in datos.items():
-            session[key] = value
-            
-        logger.info(f"Estado actualizado para guía {codigo}: {datos}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error actualizando estado de guía: {str(e)}")
-        return False
+    guia = buscar_guia(codigo)
+    if not guia:
+        logger.error(f"No se encontró guía para actualizar: {codigo}")
+        return None
+
+    guia = guia_lifecycle.aplicar(guia['codigo_guia'], evento, datos, en_transaccion=en_transaccion)
+    if guia:
+        logger.info(f"Estado actualizado para guía {guia['codigo_guia']}: {datos}")
+    return guia
+
+def verificar_etapa(codigo, evento):
+    """
+    Guía del proveedor si la etapa se puede aplicar en su estado actual,
+    para validarla antes de webhooks y PDFs. Retorna None si no existe y
+    lanza TransicionInvalidaError si la etapa no corresponde
+    """
+    guia = buscar_guia(codigo)
+    if guia:
+        guia_lifecycle.verificar(guia, evento)
+    return guia or None
     
+def datos_pagina_guia(guia):
+    """
+    Contexto de guia_template.html para la guía dada
+    """
+    datos = datos_de_guia(guia)
+    now = datetime.now()
+    datos.update({
+        'fecha_formato': guia.get('fecha_registro_porteria') or now.strftime("%d/%m/%Y"),
+        'hora_formato': guia.get('hora_registro_porteria') or now.strftime("%H:%M:%S"),
+        'qr_svg': qr_service.svg(url_seguimiento(guia['codigo_guia'])),
+        'eventos': guia_store.historial(guia['codigo_guia'])
+    })
+    return datos
+
 @app.route('/ver_guia/<codigo>')
 def ver_guia(codigo):
     """
     Muestra la vista actual de la guía
     """
     try:
-        datos_guia = obtener_datos_guia(codigo)
-        if not datos_guia:
+        guia = buscar_guia(codigo)
+        if not guia:
             return render_template('error.html', message="Guía no encontrada"), 404
-
-        # Generar código de guía con formato: codigo_fecha_hora
-        now = datetime.now()
-        fecha_hora = now.strftime("%Y%m%d_%H%M%S")
-        
-        # Formatear fecha para mostrar
-        fecha_formato = now.strftime("%d/%m/%Y")
         
-        # Actualizar datos_guia con el nuevo código y fecha
-        datos_guia.update({
-            'codigo_guia': f"{codigo}_{fecha_hora}",
-            'fecha_formato': fecha_formato,
-            'hora_formato': now.strftime("%H:%M:%S")
-        })
-            
-        return render_template('guia_template.html', **datos_guia)
+        return respuesta_guia(guia)
         
     except Exception as e:
         logger.error(f"Error mostrando guía: {str(e)}")
@@ -1071,8 +1996,8 @@ def notify_admin():
         }
         
         # Llamar al webhook de notificación
-        response = requests.post(
-            ADMIN_NOTIFICATION_WEBHOOK_URL,
+        response = webhooks.post(
+            'admin_notification',
             json=notification_data,
             headers={'Content-Type': 'application/json'}
         )
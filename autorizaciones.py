@@ -0,0 +1,149 @@
+# autorizaciones.py
+
+import os
+import hmac
+import time
+import string
+import secrets
+import logging
+import threading
+import traceback
+
+from db import conectar
+
+logger = logging.getLogger(__name__)
+
+ALFABETO = string.ascii_uppercase + string.digits
+
+# Resultados de validar()
+VALIDO = 'valido'
+INEXISTENTE = 'inexistente'
+EXPIRADO = 'expirado'
+INVALIDO = 'invalido'
+BLOQUEADO = 'bloqueado'
+
+
+class AutorizacionStore:
+    """
+    Códigos de autorización de pesaje virtual en SQLite, compartidos por
+    todos los procesos del servidor. Cada código expira a los ttl segundos;
+    la expiración está indexada y un hilo por proceso borra los vencidos
+    cada intervalo_limpieza segundos. Los intentos fallidos se cuentan y al
+    llegar a max_intentos el código queda bloqueado
+    """
+
+    def __init__(self, ruta_db, ttl=3600, max_intentos=5, intervalo_limpieza=300):
+        self.ruta_db = ruta_db
+        self.ttl = ttl
+        self.max_intentos = max_intentos
+        self.intervalo_limpieza = intervalo_limpieza
+
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._pid = None
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conexion = conectar(self.ruta_db)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS codigos_autorizacion (
+                codigo_guia TEXT PRIMARY KEY,
+                codigo TEXT NOT NULL,
+                creado REAL NOT NULL,
+                expiracion REAL NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_codigos_autorizacion_expiracion "
+            "ON codigos_autorizacion (expiracion)"
+        )
+
+    def iniciar(self):
+        """
+        Inicia el hilo de limpieza de forma perezosa (y de nuevo tras un fork)
+        """
+        if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+                return
+            self._pid = os.getpid()
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._limpiador, name='autorizaciones', daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+
+    def _limpiador(self):
+        while not self._detener.wait(self.intervalo_limpieza):
+            try:
+                self.limpiar()
+            except Exception as e:
+                logger.error(f"Error limpiando códigos de autorización: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def emitir(self, codigo_guia, longitud=6):
+        """
+        Genera un código para la guía, reemplazando el anterior si lo había
+        """
+        codigo = ''.join(secrets.choice(ALFABETO) for _ in range(longitud))
+        ahora = time.time()
+        conectar(self.ruta_db).execute(
+            """
+            INSERT OR REPLACE INTO codigos_autorizacion (codigo_guia, codigo, creado, expiracion, intentos)
+            VALUES (?, ?, ?, ?, 0)
+            """,
+            (codigo_guia, codigo, ahora, ahora + self.ttl)
+        )
+        return codigo
+
+    def validar(self, codigo_guia, codigo):
+        """
+        Verifica el código de la guía y cuenta el intento si no coincide.
+        Retorna VALIDO, INEXISTENTE, EXPIRADO, INVALIDO o BLOQUEADO
+        """
+        conexion = conectar(self.ruta_db)
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            fila = conexion.execute(
+                "SELECT codigo, expiracion, intentos FROM codigos_autorizacion WHERE codigo_guia = ?",
+                (codigo_guia,)
+            ).fetchone()
+            if fila is None:
+                resultado = INEXISTENTE
+            elif fila['expiracion'] < time.time():
+                conexion.execute("DELETE FROM codigos_autorizacion WHERE codigo_guia = ?", (codigo_guia,))
+                resultado = EXPIRADO
+            elif fila['intentos'] >= self.max_intentos:
+                resultado = BLOQUEADO
+            elif hmac.compare_digest(fila['codigo'], str(codigo).strip().upper()):
+                resultado = VALIDO
+            else:
+                conexion.execute(
+                    "UPDATE codigos_autorizacion SET intentos = intentos + 1 WHERE codigo_guia = ?",
+                    (codigo_guia,)
+                )
+                resultado = BLOQUEADO if fila['intentos'] + 1 >= self.max_intentos else INVALIDO
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+        if resultado in (INVALIDO, BLOQUEADO):
+            logger.warning(f"Código de autorización {resultado} para la guía {codigo_guia}")
+        return resultado
+
+    def limpiar(self):
+        """
+        Borra los códigos vencidos usando el índice de expiración
+        """
+        borrados = conectar(self.ruta_db).execute(
+            "DELETE FROM codigos_autorizacion WHERE expiracion < ?",
+            (time.time(),)
+        ).rowcount
+        if borrados:
+            logger.info(f"Códigos de autorización vencidos borrados: {borrados}")
+        return borrados
@@ -0,0 +1,314 @@
+# base_maestra.py
+
+from flask import Blueprint, jsonify, request
+import os
+import re
+import glob
+import json
+import time
+import threading
+import unicodedata
+import logging
+import traceback
+from collections import defaultdict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Crear Blueprint
+base_maestra_bp = Blueprint('base_maestra', __name__)
+
+
+def normalizar_texto(texto):
+    """
+    Normaliza un texto para comparación: sin tildes, en mayúsculas y con
+    espacios simples
+    """
+    texto = unicodedata.normalize('NFKD', str(texto or ''))
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', texto).strip().upper()
+
+
+def normalizar_placa(placa):
+    """
+    Normaliza una placa eliminando espacios y guiones
+    """
+    return re.sub(r'[^A-Z0-9]', '', normalizar_texto(placa))
+
+
+def trigramas(texto):
+    """
+    Conjunto de trigramas de un texto normalizado
+    """
+    texto = f"  {normalizar_texto(texto)} "
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+class ProviderIndex:
+    """
+    Índice en memoria de la base maestra de proveedores con búsqueda O(1)
+    por código, búsqueda por placa e índice de trigramas sobre el nombre
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proveedores = []
+        self._por_codigo = {}
+        self._por_placa = {}
+        self._trigramas = {}
+        self._trigramas_nombre = []
+        self._revisado = 0
+        self.origen = None
+        self.huella = None
+
+    def cargar(self, proveedores, origen=None, huella=None):
+        """
+        Construye los índices a partir de una lista de proveedores y los
+        reemplaza de forma atómica
+        """
+        por_codigo = {}
+        por_placa = defaultdict(list)
+        indice_trigramas = defaultdict(set)
+        trigramas_nombre = []
+        lista = []
+
+        for proveedor in proveedores:
+            proveedor = {
+                'codigo': str(proveedor.get('codigo', '')).strip(),
+                'nombre': str(proveedor.get('nombre', '')).strip(),
+                'placa': str(proveedor.get('placa', '')).strip(),
+                'tipo_proveedor': proveedor.get('tipo_proveedor', '')
+            }
+            if not any((proveedor['codigo'], proveedor['nombre'], proveedor['placa'])):
+                continue
+
+            posicion = len(lista)
+            lista.append(proveedor)
+
+            if proveedor['codigo']:
+                por_codigo[normalizar_texto(proveedor['codigo'])] = posicion
+            if proveedor['placa']:
+                por_placa[normalizar_placa(proveedor['placa'])].append(posicion)
+
+            grams = trigramas(proveedor['nombre']) if proveedor['nombre'] else set()
+            trigramas_nombre.append(grams)
+            for gram in grams:
+                indice_trigramas[gram].add(posicion)
+
+        with self._lock:
+            self._proveedores = lista
+            self._por_codigo = por_codigo
+            self._por_placa = dict(por_placa)
+            self._trigramas = dict(indice_trigramas)
+            self._trigramas_nombre = trigramas_nombre
+            self.origen = origen
+            self.huella = huella
+
+        logger.info(f"Base maestra indexada: {len(lista)} proveedores, "
+                    f"{len(por_codigo)} códigos, {len(por_placa)} placas")
+        return len(lista)
+
+    def cargar_archivo(self, ruta):
+        """
+        Carga un archivo con el formato de debug/base_maestra_*.json
+        """
+        with open(ruta, 'r', encoding='utf-8') as f:
+            datos = json.load(f)
+        return self.cargar(datos.get('proveedores', []), origen=ruta, huella=datos.get('huella'))
+
+    @staticmethod
+    def _snapshots(directorio):
+        return sorted(glob.glob(os.path.join(directorio, 'base_maestra_*.json')))
+
+    def cargar_ultimo(self, directorio):
+        """
+        Carga el snapshot más reciente de la base maestra en el directorio dado
+        """
+        try:
+            archivos = self._snapshots(directorio)
+            if not archivos:
+                logger.warning(f"No hay snapshots de base maestra en {directorio}")
+                return 0
+            return self.cargar_archivo(archivos[-1])
+        except Exception as e:
+            logger.error(f"Error cargando base maestra: {str(e)}")
+            logger.error(traceback.format_exc())
+            return 0
+
+    def guardar_snapshot(self, directorio, proveedores, huella=None, conservar=2):
+        """
+        Escribe los proveedores como un nuevo snapshot de la base maestra
+        (de forma atómica) y los carga. Si el último snapshot tiene la misma
+        huella no se escribe nada. Se conservan los 'conservar' snapshots más
+        recientes (el anterior sigue disponible para los procesos que aún no
+        recargaron) y se eliminan los demás. Retorna la ruta del snapshot
+        """
+        archivos = self._snapshots(directorio)
+        if huella is not None and archivos:
+            if self.origen != archivos[-1]:
+                self.cargar_archivo(archivos[-1])
+            if self.huella == huella:
+                logger.info("Base maestra sin cambios, se conserva el snapshot actual")
+                return archivos[-1]
+
+        os.makedirs(directorio, exist_ok=True)
+        ruta = os.path.join(directorio, f"base_maestra_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        temp_path = f"{ruta}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'proveedores': proveedores, 'huella': huella}, f, ensure_ascii=False)
+        os.replace(temp_path, ruta)
+        self.cargar(proveedores, origen=ruta, huella=huella)
+
+        for antiguo in self._snapshots(directorio)[:-conservar]:
+            try:
+                os.remove(antiguo)
+            except OSError as e:
+                logger.warning(f"No se pudo eliminar el snapshot {antiguo}: {str(e)}")
+        return ruta
+
+    def recargar_si_cambio(self, directorio, intervalo=30):
+        """
+        Carga el snapshot más reciente si es distinto del cargado, revisando
+        como máximo una vez por intervalo. Así los demás procesos del
+        servidor toman la base maestra actualizada por uno de ellos
+        """
+        ahora = time.monotonic()
+        if ahora - self._revisado < intervalo:
+            return False
+        self._revisado = ahora
+
+        archivos = self._snapshots(directorio)
+        if not archivos or archivos[-1] == self.origen:
+            return False
+        try:
+            self.cargar_archivo(archivos[-1])
+            return True
+        except Exception as e:
+            logger.error(f"Error recargando base maestra: {str(e)}")
+            return False
+
+    def __len__(self):
+        return len(self._proveedores)
+
+    def por_codigo(self, codigo):
+        """
+        Retorna el proveedor con el código dado o None
+        """
+        posicion = self._por_codigo.get(normalizar_texto(codigo))
+        return dict(self._proveedores[posicion]) if posicion is not None else None
+
+    def por_placa(self, placa):
+        """
+        Retorna los proveedores asociados a una placa
+        """
+        return [dict(self._proveedores[p]) for p in self._por_placa.get(normalizar_placa(placa), [])]
+
+    def buscar_nombre(self, nombre, limite=5, umbral=0.3):
+        """
+        Búsqueda aproximada por nombre usando similitud de Jaccard sobre trigramas.
+        Retorna una lista de (proveedor, puntaje) ordenada de mayor a menor
+        """
+        consulta = trigramas(nombre)
+        if not consulta:
+            return []
+
+        # Contar trigramas compartidos solo para los candidatos del índice
+        compartidos = defaultdict(int)
+        for gram in consulta:
+            for posicion in self._trigramas.get(gram, ()):
+                compartidos[posicion] += 1
+
+        resultados = []
+        for posicion, comunes in compartidos.items():
+            total = len(consulta) + len(self._trigramas_nombre[posicion]) - comunes
+            puntaje = comunes / total if total else 0
+            if puntaje >= umbral:
+                resultados.append((dict(self._proveedores[posicion]), round(puntaje, 3)))
+
+        resultados.sort(key=lambda r: r[1], reverse=True)
+        return resultados[:limite]
+
+    def similitud_nombre(self, nombre_a, nombre_b):
+        """
+        Similitud de Jaccard entre los trigramas de dos nombres
+        """
+        a, b = trigramas(nombre_a), trigramas(nombre_b)
+        return len(a & b) / len(a | b) if a and b else 0
+
+    def validar(self, codigo=None, nombre=None, umbral_nombre=0.8):
+        """
+        Valida localmente un código y/o nombre de agricultor. Retorna el
+        proveedor encontrado o None si la validación local no es concluyente
+        """
+        if codigo:
+            proveedor = self.por_codigo(codigo)
+            if not proveedor:
+                return None
+            if nombre and self.similitud_nombre(nombre, proveedor['nombre']) < umbral_nombre:
+                return None
+            return proveedor
+
+        if nombre:
+            resultados = self.buscar_nombre(nombre, limite=2, umbral=umbral_nombre)
+            # Solo se acepta una coincidencia sin ambigüedad
+            if len(resultados) == 1 or (len(resultados) > 1 and resultados[0][1] > resultados[1][1]):
+                return resultados[0][0]
+
+        return None
+
+
+# Índice compartido por el proceso
+provider_index = ProviderIndex()
+
+
+@base_maestra_bp.route('/proveedores/buscar', methods=['GET'])
+def buscar_proveedores():
+    """
+    Búsqueda local en la base maestra por código, placa o nombre
+    """
+    try:
+        codigo = request.args.get('codigo', '').strip()
+        placa = request.args.get('placa', '').strip()
+        nombre = request.args.get('nombre', '').strip()
+        limite = request.args.get('limite', 5, type=int)
+
+        if codigo:
+            proveedor = provider_index.por_codigo(codigo)
+            resultados = [{'proveedor': proveedor, 'puntaje': 1.0}] if proveedor else []
+        elif placa:
+            resultados = [{'proveedor': p, 'puntaje': 1.0} for p in provider_index.por_placa(placa)]
+        elif nombre:
+            resultados = [
+                {'proveedor': p, 'puntaje': puntaje}
+                for p, puntaje in provider_index.buscar_nombre(nombre, limite=limite)
+            ]
+        else:
+            return jsonify({
+                'success': False,
+                'message': 'Debe indicar codigo, placa o nombre'
+            }), 400
+
+        return jsonify({
+            'success': True,
+            'total': len(resultados),
+            'resultados': resultados
+        })
+
+    except Exception as e:
+        logger.error(f"Error buscando proveedores: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'Error: {str(e)}'
+        }), 500
+
+
+@base_maestra_bp.route('/proveedores/estado', methods=['GET'])
+def estado_base_maestra():
+    """
+    Estado del índice local de la base maestra
+    """
+    return jsonify({
+        'success': True,
+        'proveedores': len(provider_index),
+        'origen': provider_index.origen
+    })
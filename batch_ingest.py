@@ -0,0 +1,358 @@
+# batch_ingest.py
+
+import os
+import json
+import time
+import uuid
+import zipfile
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from db import conectar
+from upload_pipeline import ArchivoRechazadoError
+
+logger = logging.getLogger(__name__)
+
+
+def iterar_imagenes(fuentes, permitido):
+    """
+    Recorre las fuentes (nombre, archivo) expandiendo los zip y retorna
+    (nombre, archivo) por cada imagen con extensión permitida
+    """
+    for nombre, archivo in fuentes:
+        if nombre.lower().endswith('.zip'):
+            with zipfile.ZipFile(archivo) as zf:
+                for info in sorted(zf.infolist(), key=lambda i: i.filename):
+                    miembro = os.path.basename(info.filename)
+                    if info.is_dir() or miembro.startswith('.') or not permitido(miembro):
+                        continue
+                    with zf.open(info) as contenido:
+                        yield miembro, contenido
+        elif permitido(nombre):
+            yield nombre, archivo
+        else:
+            logger.warning(f"Archivo omitido en el lote: {nombre}")
+
+
+class BatchIngestor:
+    """
+    Ingesta de lotes de tiquetes: cada imagen pasa por OCR, parseo,
+    revalidación y registro en un pool acotado de hilos. El progreso por
+    ítem queda en una tabla de eventos para que cualquier proceso lo transmita
+    """
+
+    ESTADOS_FINALES = ('registrado', 'revision', 'duplicado', 'error')
+
+    def __init__(self, app, ruta_db, almacen, procesar, max_workers=3, max_items=200, max_bytes=None):
+        """
+        almacen es el UploadStore donde se guardan las imágenes.
+        procesar(item, avanzar) ejecuta el flujo de un tiquete y retorna un
+        diccionario con estado, codigo_guia, codigo y mensaje
+        """
+        self.app = app
+        self.ruta_db = ruta_db
+        self.almacen = almacen
+        self.procesar = procesar
+        self.max_workers = max_workers
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._nuevos_eventos = threading.Condition()
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conexion = conectar(self.ruta_db)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS lotes (
+                lote_id TEXT PRIMARY KEY,
+                origen TEXT NOT NULL DEFAULT '',
+                total INTEGER NOT NULL,
+                estado TEXT NOT NULL,
+                creado REAL NOT NULL,
+                finalizado REAL
+            )
+        """)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS lote_items (
+                lote_id TEXT NOT NULL,
+                posicion INTEGER NOT NULL,
+                archivo TEXT NOT NULL,
+                image_hash TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                etapa TEXT NOT NULL DEFAULT '',
+                codigo_guia TEXT NOT NULL DEFAULT '',
+                codigo TEXT NOT NULL DEFAULT '',
+                pdf_filename TEXT NOT NULL DEFAULT '',
+                mensaje TEXT NOT NULL DEFAULT '',
+                duracion REAL,
+                actualizado REAL NOT NULL,
+                PRIMARY KEY (lote_id, posicion)
+            )
+        """)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS lote_eventos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                lote_id TEXT NOT NULL,
+                posicion INTEGER,
+                datos TEXT NOT NULL,
+                creado REAL NOT NULL
+            )
+        """)
+        conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_lote_eventos ON lote_eventos (lote_id, id)"
+        )
+
+    def _obtener_executor(self):
+        # El pool se crea de forma perezosa y de nuevo tras un fork del servidor
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='lote-worker'
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def crear_lote(self, fuentes, permitido, origen=''):
+        """
+        Guarda las imágenes de las fuentes (archivos sueltos o zip) en el
+        almacén, registra el lote y encola cada ítem. Retorna el lote_id
+        """
+        lote_id = uuid.uuid4().hex
+        items = []
+        hashes = {}
+        inicio = time.time()
+
+        try:
+            for nombre, archivo in iterar_imagenes(fuentes, permitido):
+                if len(items) >= self.max_items:
+                    raise ValueError(f"El lote supera el máximo de {self.max_items} imágenes.")
+                posicion = len(items)
+                item = {
+                    'lote_id': lote_id,
+                    'posicion': posicion,
+                    'archivo': nombre,
+                    'image_filename': '',
+                    'image_path': '',
+                    'image_hash': '',
+                    'rechazo': None,
+                    'duplicado_de': posicion
+                }
+                try:
+                    recibido = self.almacen.guardar(archivo, nombre, max_bytes=self.max_bytes)
+                    item.update({
+                        'image_filename': recibido.clave,
+                        'image_path': recibido.ruta,
+                        'image_hash': recibido.hash,
+                        # Una misma foto subida dos veces se procesa una sola vez
+                        'duplicado_de': hashes.setdefault(recibido.hash, posicion)
+                    })
+                except ArchivoRechazadoError as e:
+                    item['rechazo'] = str(e)
+                items.append(item)
+        except Exception:
+            # Se descartan solo las imágenes nuevas de este lote que nadie más subió
+            for clave in {item['image_filename'] for item in items if item['image_filename']}:
+                self.almacen.descartar(clave, inicio)
+            raise
+
+        if not items:
+            raise ValueError("El lote no contiene imágenes válidas.")
+
+        ahora = time.time()
+        conexion = conectar(self.ruta_db)
+        conexion.execute("BEGIN IMMEDIATE")
+        conexion.execute(
+            "INSERT INTO lotes (lote_id, origen, total, estado, creado) VALUES (?, ?, ?, 'procesando', ?)",
+            (lote_id, origen, len(items), ahora)
+        )
+        conexion.executemany(
+            """
+            INSERT INTO lote_items (lote_id, posicion, archivo, image_hash, estado, actualizado)
+            VALUES (?, ?, ?, ?, 'pendiente', ?)
+            """,
+            [(lote_id, i['posicion'], i['archivo'], i['image_hash'], ahora) for i in items]
+        )
+        conexion.execute("COMMIT")
+        self._emitir(lote_id, None, {'tipo': 'lote', 'estado': 'procesando', 'total': len(items)})
+        logger.info(f"Lote {lote_id} creado con {len(items)} imágenes ({origen})")
+
+        executor = self._obtener_executor()
+        for item in items:
+            if item['rechazo']:
+                self._finalizar_item(item, {'estado': 'error', 'mensaje': item['rechazo']}, 0)
+            elif item['duplicado_de'] != item['posicion']:
+                self._finalizar_item(item, {
+                    'estado': 'duplicado',
+                    'mensaje': f"Imagen idéntica al ítem {item['duplicado_de']} del lote."
+                }, 0)
+            else:
+                executor.submit(self._ejecutar_item, item)
+
+        return lote_id
+
+    def _ejecutar_item(self, item):
+        inicio = time.time()
+
+        def avanzar(etapa):
+            self._actualizar_item(item, 'procesando', etapa)
+
+        try:
+            # Sin SERVER_NAME, url_for requiere una petición: se usa una a URL_PUBLICA
+            with self.app.test_request_context(base_url=self.app.config['URL_PUBLICA']):
+                resultado = self.procesar(item, avanzar)
+        except Exception as e:
+            logger.error(f"Error procesando ítem {item['posicion']} del lote {item['lote_id']}: {str(e)}")
+            logger.error(traceback.format_exc())
+            resultado = {'estado': 'error', 'mensaje': str(e)}
+
+        self._finalizar_item(item, resultado, time.time() - inicio)
+
+    def _actualizar_item(self, item, estado, etapa):
+        conectar(self.ruta_db).execute(
+            "UPDATE lote_items SET estado = ?, etapa = ?, actualizado = ? WHERE lote_id = ? AND posicion = ?",
+            (estado, etapa, time.time(), item['lote_id'], item['posicion'])
+        )
+        self._emitir(item['lote_id'], item['posicion'], {
+            'tipo': 'item',
+            'posicion': item['posicion'],
+            'archivo': item['archivo'],
+            'estado': estado,
+            'etapa': etapa
+        })
+
+    def _finalizar_item(self, item, resultado, duracion):
+        estado = resultado.get('estado', 'error')
+        conexion = conectar(self.ruta_db)
+        conexion.execute("BEGIN IMMEDIATE")
+        conexion.execute(
+            """
+            UPDATE lote_items SET estado = ?, etapa = '', codigo_guia = ?, codigo = ?, pdf_filename = ?,
+                mensaje = ?, duracion = ?, actualizado = ?
+            WHERE lote_id = ? AND posicion = ?
+            """,
+            (
+                estado,
+                resultado.get('codigo_guia', ''),
+                resultado.get('codigo', ''),
+                resultado.get('pdf_filename', ''),
+                resultado.get('mensaje', ''),
+                round(duracion, 3),
+                time.time(),
+                item['lote_id'],
+                item['posicion']
+            )
+        )
+        pendientes = conexion.execute(
+            f"""
+            SELECT COUNT(*) FROM lote_items WHERE lote_id = ?
+            AND estado NOT IN ({','.join('?' * len(self.ESTADOS_FINALES))})
+            """,
+            (item['lote_id'], *self.ESTADOS_FINALES)
+        ).fetchone()[0]
+        if not pendientes:
+            conexion.execute(
+                "UPDATE lotes SET estado = 'finalizado', finalizado = ? WHERE lote_id = ?",
+                (time.time(), item['lote_id'])
+            )
+        conexion.execute("COMMIT")
+
+        self._emitir(item['lote_id'], item['posicion'], {
+            'tipo': 'item',
+            'posicion': item['posicion'],
+            'archivo': item['archivo'],
+            'estado': estado,
+            'codigo_guia': resultado.get('codigo_guia', ''),
+            'codigo': resultado.get('codigo', ''),
+            'mensaje': resultado.get('mensaje', ''),
+            'duracion': round(duracion, 3)
+        })
+        logger.info(f"Ítem {item['posicion']} del lote {item['lote_id']}: {estado}")
+
+        if not pendientes:
+            self._emitir(item['lote_id'], None, {'tipo': 'lote', 'estado': 'finalizado'})
+            logger.info(f"Lote {item['lote_id']} finalizado")
+
+    def _emitir(self, lote_id, posicion, datos):
+        conectar(self.ruta_db).execute(
+            "INSERT INTO lote_eventos (lote_id, posicion, datos, creado) VALUES (?, ?, ?, ?)",
+            (lote_id, posicion, json.dumps(datos, ensure_ascii=False), time.time())
+        )
+        with self._nuevos_eventos:
+            self._nuevos_eventos.notify_all()
+
+    def obtener(self, lote_id):
+        """
+        Retorna el lote o None si no existe
+        """
+        fila = conectar(self.ruta_db).execute(
+            "SELECT * FROM lotes WHERE lote_id = ?", (lote_id,)
+        ).fetchone()
+        return dict(fila) if fila else None
+
+    def eventos(self, lote_id, desde=0, intervalo=1.0):
+        """
+        Genera (id, datos) con los eventos del lote posteriores a 'desde'
+        hasta que el lote finaliza. Lee de la base de datos, por lo que
+        funciona aunque el lote se procese en otro proceso del servidor.
+        Sin eventos nuevos genera (None, None) para mantener viva la conexión
+        """
+        conexion = conectar(self.ruta_db)
+        while True:
+            filas = conexion.execute(
+                "SELECT id, datos FROM lote_eventos WHERE lote_id = ? AND id > ? ORDER BY id",
+                (lote_id, desde)
+            ).fetchall()
+            for fila in filas:
+                desde = fila['id']
+                datos = json.loads(fila['datos'])
+                yield fila['id'], datos
+                if datos['tipo'] == 'lote' and datos['estado'] == 'finalizado':
+                    return
+
+            lote = self.obtener(lote_id)
+            if lote is None:
+                return
+            if not filas:
+                with self._nuevos_eventos:
+                    self._nuevos_eventos.wait(intervalo)
+                yield None, None
+
+    def resumen(self, lote_id):
+        """
+        Reporte del lote: totales por estado, duración e ítems
+        """
+        lote = self.obtener(lote_id)
+        if lote is None:
+            return None
+
+        items = [
+            dict(fila) for fila in conectar(self.ruta_db).execute(
+                """
+                SELECT posicion, archivo, image_hash, estado, etapa, codigo_guia, codigo, pdf_filename,
+                    mensaje, duracion
+                FROM lote_items WHERE lote_id = ? ORDER BY posicion
+                """,
+                (lote_id,)
+            )
+        ]
+        totales = {}
+        for item in items:
+            totales[item['estado']] = totales.get(item['estado'], 0) + 1
+        duraciones = [item['duracion'] for item in items if item['duracion']]
+
+        return {
+            'lote_id': lote_id,
+            'origen': lote['origen'],
+            'estado': lote['estado'],
+            'total': lote['total'],
+            'totales': totales,
+            'duracion': round((lote['finalizado'] or time.time()) - lote['creado'], 3),
+            'duracion_promedio_item': round(sum(duraciones) / len(duraciones), 3) if duraciones else None,
+            'items': items
+        }
@@ -9,12 +9,80 @@ app.config.update(
     QR_FOLDER=os.path.join('static', 'qr'),
     IMAGES_FOLDER=os.path.join('static', 'images'),
     EXCEL_FOLDER=os.path.join('static', 'excels'),
-    SECRET_KEY='tu_clave_secreta'  # Cambia esto
+    SECRET_KEY='tu_clave_secreta',  # Cambia esto
+    # Cola de trabajos OCR
+    OCR_WORKERS=int(os.getenv('OCR_WORKERS', 4)),
+    OCR_QUEUE_MAX=int(os.getenv('OCR_QUEUE_MAX', 50)),
+    OCR_JOB_TIMEOUT=int(os.getenv('OCR_JOB_TIMEOUT', 60)),
+    # Caché de resultados OCR por hash de imagen
+    DATA_FOLDER=os.path.join(app.root_path, 'data'),
+    OCR_CACHE_TTL=int(os.getenv('OCR_CACHE_TTL', 7 * 24 * 3600)),
+    OCR_CACHE_MAX_ENTRIES=int(os.getenv('OCR_CACHE_MAX_ENTRIES', 5000)),
+    # Cliente HTTP de webhooks
+    WEBHOOK_POOL_SIZE=int(os.getenv('WEBHOOK_POOL_SIZE', 20)),
+    WEBHOOK_RETRIES=int(os.getenv('WEBHOOK_RETRIES', 2)),
+    WEBHOOK_BREAKER_THRESHOLD=int(os.getenv('WEBHOOK_BREAKER_THRESHOLD', 5)),
+    WEBHOOK_BREAKER_COOLDOWN=int(os.getenv('WEBHOOK_BREAKER_COOLDOWN', 30)),
+    # Pool de renderizado de PDFs
+    PDF_WORKERS=int(os.getenv('PDF_WORKERS', min(4, os.cpu_count() or 1))),
+    PDF_RENDER_TIMEOUT=int(os.getenv('PDF_RENDER_TIMEOUT', 60)),
+    PDF_WARMUP=os.getenv('PDF_WARMUP', '1') == '1',
+    # Límites de subida: petición completa (lotes incluidos) y cada archivo
+    MAX_CONTENT_LENGTH=int(os.getenv('MAX_CONTENT_LENGTH', 256 * 1024 * 1024)),
+    MAX_UPLOAD_SIZE=int(os.getenv('MAX_UPLOAD_SIZE', 20 * 1024 * 1024)),
+    # Normalización de imágenes antes de OCR y pesaje
+    IMAGE_PREP_ENABLED=os.getenv('IMAGE_PREP_ENABLED', '1') == '1',
+    IMAGE_PREP_WORKERS=int(os.getenv('IMAGE_PREP_WORKERS', 2)),
+    IMAGE_PREP_MAX_EDGE=int(os.getenv('IMAGE_PREP_MAX_EDGE', 1600)),
+    IMAGE_PREP_QUALITY=int(os.getenv('IMAGE_PREP_QUALITY', 80)),
+    IMAGE_PREP_GRAYSCALE=os.getenv('IMAGE_PREP_GRAYSCALE', '1') == '1',
+    # Retención de artefactos generados (PDFs, guías HTML, QR)
+    RETENTION_ENABLED=os.getenv('RETENTION_ENABLED', '1') == '1',
+    RETENTION_INTERVAL=int(os.getenv('RETENTION_INTERVAL', 6 * 3600)),
+    RETENTION_TMP_HOURS=int(os.getenv('RETENTION_TMP_HOURS', 24)),
+    RETENTION_DAYS=int(os.getenv('RETENTION_DAYS', 90)),
+    RETENTION_ORPHAN_GRACE_DAYS=int(os.getenv('RETENTION_ORPHAN_GRACE_DAYS', 7)),
+    RETENTION_MAX_FILES=int(os.getenv('RETENTION_MAX_FILES', 5000)),
+    RETENTION_ARCHIVE=os.getenv('RETENTION_ARCHIVE', '1') == '1',
+    ARCHIVE_FOLDER=os.path.join(app.root_path, 'data', 'archivo'),
+    # Ingesta de lotes de tiquetes
+    BATCH_WORKERS=int(os.getenv('BATCH_WORKERS', 3)),
+    BATCH_MAX_ITEMS=int(os.getenv('BATCH_MAX_ITEMS', 200)),
+    # Caché en memoria de códigos QR de seguimiento
+    QR_CACHE_MAX_ENTRIES=int(os.getenv('QR_CACHE_MAX_ENTRIES', 256)),
+    # Caché de páginas de guía renderizadas desde el almacén
+    GUIA_RENDER_TTL=int(os.getenv('GUIA_RENDER_TTL', 30)),
+    GUIA_RENDER_MAX_ENTRIES=int(os.getenv('GUIA_RENDER_MAX_ENTRIES', 500)),
+    # Caché de plantillas: bytecode de Jinja en disco y fragmentos estáticos en memoria
+    TEMPLATE_BYTECODE_CACHE=os.getenv('TEMPLATE_BYTECODE_CACHE', '1') == '1',
+    FRAGMENT_CACHE_TTL=int(os.getenv('FRAGMENT_CACHE_TTL', 3600)),
+    # Las imágenes subidas se nombran por su hash, así que nunca cambian
+    UPLOAD_CACHE_MAX_AGE=int(os.getenv('UPLOAD_CACHE_MAX_AGE', 365 * 24 * 3600)),
+    # Códigos de autorización de pesaje virtual
+    AUTORIZACION_TTL=int(os.getenv('AUTORIZACION_TTL', 3600)),
+    AUTORIZACION_MAX_INTENTOS=int(os.getenv('AUTORIZACION_MAX_INTENTOS', 5)),
+    AUTORIZACION_SWEEP_INTERVAL=int(os.getenv('AUTORIZACION_SWEEP_INTERVAL', 300)),
+    # Tablero del patio: eventos recientes en memoria y frecuencia de lectura de guia_eventos
+    PATIO_BUFFER_SIZE=int(os.getenv('PATIO_BUFFER_SIZE', 200)),
+    PATIO_POLL_INTERVAL=float(os.getenv('PATIO_POLL_INTERVAL', 1.0)),
+    PATIO_HORAS=int(os.getenv('PATIO_HORAS', 24)),
+    # Pantallas SSE por proceso: cada una ocupa un hilo del servidor (GUNICORN_THREADS)
+    PATIO_MAX_CLIENTES=int(os.getenv('PATIO_MAX_CLIENTES', 4)),
+    # Snapshots de la base maestra de proveedores; cada proceso revisa si hay uno nuevo
+    BASE_MAESTRA_FOLDER=os.path.join(app.root_path, 'debug'),
+    BASE_MAESTRA_RELOAD_INTERVAL=int(os.getenv('BASE_MAESTRA_RELOAD_INTERVAL', 30)),
+    # Pasos paralelos del registro y notificaciones no críticas con reintentos
+    ORCHESTRATOR_WORKERS=int(os.getenv('ORCHESTRATOR_WORKERS', 8)),
+    OUTBOX_MAX_ATTEMPTS=int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10)),
+    OUTBOX_BACKOFF=int(os.getenv('OUTBOX_BACKOFF', 30)),
+    # Apagado ordenado: espera máxima por los trabajos OCR encolados
+    SHUTDOWN_TIMEOUT=int(os.getenv('SHUTDOWN_TIMEOUT', 25)),
+    # Sin SERVER_NAME se atiende cualquier Host (clientes de la red, balanceador);
+    # las URL de los QR y las construidas fuera de una petición usan URL_PUBLICA
+    SERVER_NAME=os.getenv('SERVER_NAME') or None,
+    URL_PUBLICA=os.getenv('URL_PUBLICA', 'http://localhost:5002')
 )
 
-# Configuración del servidor
-app.config['SERVER_NAME'] = 'localhost:5002'  # O tu dominio en producción
-
 # Crear directorios si no existen
 for folder in [
     app.config['UPLOAD_FOLDER'], 
@@ -22,6 +90,7 @@ for folder in [
     app.config['GUIAS_FOLDER'],
     app.config['QR_FOLDER'],
     app.config['IMAGES_FOLDER'],
-    app.config['EXCEL_FOLDER']
+    app.config['EXCEL_FOLDER'],
+    app.config['DATA_FOLDER']
 ]:
     os.makedirs(folder, exist_ok=True)
\ No newline at end of file
@@ -0,0 +1,36 @@
+# db.py
+
+import os
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def conectar(ruta):
+    """
+    Retorna una conexión SQLite por hilo para la ruta dada, en modo WAL
+    para permitir lecturas concurrentes mientras otro proceso escribe
+    """
+    conexiones = getattr(_local, 'conexiones', None)
+    if conexiones is None:
+        conexiones = _local.conexiones = {}
+
+    # Las conexiones no sobreviven a un fork, se identifican por proceso
+    clave = (ruta, os.getpid())
+    conexion = conexiones.get(clave)
+    if conexion is None:
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        conexion = sqlite3.connect(ruta, timeout=30, isolation_level=None)
+        conexion.row_factory = sqlite3.Row
+        conexion.execute('PRAGMA journal_mode=WAL')
+        conexion.execute('PRAGMA synchronous=NORMAL')
+        conexion.execute('PRAGMA busy_timeout=30000')
+        conexiones[clave] = conexion
+        logger.debug(f"Conexión SQLite abierta: {ruta}")
+    return conexion
@@ -0,0 +1,61 @@
+# fechas.py
+
+import re
+from datetime import date
+from functools import lru_cache
+
+# Variantes de fecha que entrega el OCR: 14-01-2025, 14/01/2025, 14.01.2025,
+# 14 - 1 - 25, 2025-01-14, 2025/01/14. Un solo match decide el formato
+RE_FECHA = re.compile(
+    r'^\s*(?:'
+    r'(?P<anio_iso>\d{4})\s*(?P<sep_iso>[-/.])\s*(?P<mes_iso>\d{1,2})\s*(?P=sep_iso)\s*(?P<dia_iso>\d{1,2})'
+    r'|'
+    r'(?P<dia>\d{1,2})\s*(?P<sep>[-/. ])\s*(?P<mes>\d{1,2})\s*(?P=sep)\s*(?P<anio>\d{4}|\d{2})'
+    r')\s*$'
+)
+
+
+@lru_cache(maxsize=1024)
+def _parsear(texto):
+    coincidencia = RE_FECHA.match(texto)
+    if coincidencia is None:
+        return None
+
+    if coincidencia.group('anio_iso'):
+        anio, mes, dia = coincidencia.group('anio_iso', 'mes_iso', 'dia_iso')
+    else:
+        dia, mes, anio = coincidencia.group('dia', 'mes', 'anio')
+        if len(anio) == 2:
+            anio = f"20{anio}"
+
+    try:
+        return date(int(anio), int(mes), int(dia))
+    except ValueError:
+        # Día o mes fuera de rango (por ejemplo 31-02-2025)
+        return None
+
+
+def parsear_fecha(texto):
+    """
+    Retorna la fecha (date) del texto leído por el OCR o None si no tiene un
+    formato conocido. Los resultados se memorizan por texto
+    """
+    if not texto or not isinstance(texto, str):
+        return None
+    return _parsear(texto)
+
+
+def normalizar_fecha(texto, default=None):
+    """
+    Retorna la fecha como dd/mm/aaaa, o default si no se pudo interpretar
+    """
+    fecha = parsear_fecha(texto)
+    return fecha.strftime("%d/%m/%Y") if fecha else default
+
+
+def estadisticas_cache():
+    """
+    Aciertos y fallos de la caché de fechas
+    """
+    info = _parsear.cache_info()
+    return {'aciertos': info.hits, 'fallos': info.misses, 'entradas': info.currsize, 'max_entradas': info.maxsize}
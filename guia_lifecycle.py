@@ -0,0 +1,140 @@
+# guia_lifecycle.py
+
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class TransicionInvalidaError(ValueError):
+    """
+    Se lanza cuando un evento no se puede aplicar en el estado actual de la
+    guía o le faltan datos. status es el código HTTP a retornar
+    """
+
+    def __init__(self, mensaje, status=409):
+        super().__init__(mensaje)
+        self.status = status
+
+
+def _numero(valor):
+    try:
+        return float(str(valor).replace(',', '.'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _calcular_peso_neto(datos, cambios):
+    peso_bruto = _numero(cambios.get('peso_bruto', datos.get('peso_bruto')))
+    peso_tara = _numero(cambios.get('peso_tara'))
+    if peso_bruto is not None and peso_tara is not None:
+        cambios['peso_neto'] = f"{peso_bruto - peso_tara:g}"
+    return cambios
+
+
+# evento -> (estados desde los que se puede aplicar, estado resultante,
+# campos requeridos, cálculo adicional sobre los cambios)
+TRANSICIONES = {
+    'revision': (('',), 'revision', (), None),
+    'registro': (('', 'revision'), 'pesaje', (), None),
+    'pesaje_inicial': (('pesaje', 'pesaje_completado'), 'pesaje_completado', ('peso_bruto',), None),
+    'clasificacion': (('pesaje_completado', 'clasificacion_completada'), 'clasificacion_completada', (), None),
+    'pesaje_tara': (
+        ('clasificacion_completada', 'pesaje_tara_completado'),
+        'pesaje_tara_completado',
+        ('peso_tara',),
+        _calcular_peso_neto
+    ),
+    'salida': (('pesaje_tara_completado',), 'cerrada', (), None),
+}
+
+# Etapas del proceso en orden, y el estado en que queda la guía al completar cada una
+ETAPAS = ('registro', 'pesaje_inicial', 'clasificacion', 'pesaje_tara', 'salida')
+ESTADOS_ETAPA = {etapa: TRANSICIONES[etapa][1] for etapa in ETAPAS}
+# Etapas posteriores al registro; el registro solo ocurre a través de /register
+ETAPAS_POSTERIORES = ETAPAS[1:]
+
+
+def etapas_completadas(estado):
+    """
+    Etapas ya completadas por una guía en el estado dado
+    """
+    estados = [ESTADOS_ETAPA[etapa] for etapa in ETAPAS]
+    if estado not in estados:
+        return []
+    return list(ETAPAS[:estados.index(estado) + 1])
+
+
+def validar_estado(evento, estado):
+    """
+    Valida que el evento se pueda aplicar a una guía en el estado dado
+    """
+    if evento not in TRANSICIONES:
+        raise TransicionInvalidaError(f"Evento desconocido: {evento}", status=400)
+
+    if estado not in TRANSICIONES[evento][0]:
+        raise TransicionInvalidaError(
+            f"No se puede aplicar {evento} a una guía en estado '{estado or 'borrador'}'"
+        )
+
+
+def validar_transicion(evento, estado, datos, cambios):
+    """
+    Valida el evento contra el estado actual de la guía y retorna el estado
+    nuevo y los cambios a aplicar
+    """
+    validar_estado(evento, estado)
+
+    origenes, destino, requeridos, calcular = TRANSICIONES[evento]
+
+    faltantes = [campo for campo in requeridos if not cambios.get(campo)]
+    if faltantes:
+        raise TransicionInvalidaError(f"Faltan datos para {evento}: {', '.join(faltantes)}", status=400)
+
+    if calcular:
+        cambios = calcular(datos, cambios)
+    return destino, cambios
+
+
+class GuiaLifecycle:
+    """
+    Ciclo de vida de una guía (registro, pesaje inicial, clasificación,
+    pesaje tara, salida). Cada etapa se registra como un evento en el
+    historial del almacén, validado contra el estado actual dentro de la
+    misma transacción, y la vista del estado actual se actualiza con él
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def verificar(self, guia, evento):
+        """
+        Verifica, antes de efectos como webhooks o PDFs, que el evento se
+        pueda aplicar a la guía en su estado actual. aplicar() vuelve a
+        validarlo dentro de la transacción
+        """
+        validar_estado(evento, guia.get('estado_actual', ''))
+
+    def aplicar(self, codigo_guia, evento, datos=None, en_transaccion=None):
+        """
+        Aplica el evento a la guía y retorna la guía resultante, o None si no
+        existe. Lanza TransicionInvalidaError si el evento no es válido.
+        en_transaccion se pasa a GuiaStore.registrar_evento
+        """
+        ahora = datetime.now()
+        cambios = dict(datos or {})
+        cambios.pop('estado', None)
+        cambios.pop('estado_actual', None)
+        cambios.setdefault(f'fecha_{evento}', ahora.strftime("%Y-%m-%d"))
+        cambios.setdefault(f'hora_{evento}', ahora.strftime("%H:%M:%S"))
+
+        guia = self.store.registrar_evento(
+            codigo_guia,
+            evento,
+            cambios,
+            transicion=lambda estado, actuales, cambios: validar_transicion(evento, estado, actuales, cambios),
+            en_transaccion=en_transaccion
+        )
+        if guia is not None:
+            logger.info(f"Guía {codigo_guia}: {evento} -> {guia['estado_actual']}")
+        return guia
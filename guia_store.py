@@ -0,0 +1,346 @@
+# guia_store.py
+
+import json
+import sqlite3
+import time
+import uuid
+import logging
+import traceback
+
+from db import conectar
+
+logger = logging.getLogger(__name__)
+
+
+class GuiaStore:
+    """
+    Almacén local del estado de las guías, indexado por codigo_guia.
+    Reemplaza el estado guardado en la cookie de sesión para que varias
+    estaciones (portería, báscula, clasificación) trabajen sobre la misma guía.
+    Cada cambio se agrega a un historial de eventos (guia_eventos) y se
+    aplica en la misma transacción a la tabla guias, que es la vista
+    materializada del estado actual
+    """
+
+    # Llaves que identifican la guía y no se mezclan dentro de los datos
+    LLAVES_IDENTIDAD = ('codigo_guia',)
+
+    def __init__(self, ruta_db):
+        self.ruta_db = ruta_db
+        self._suscriptores = []
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conexion = conectar(self.ruta_db)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS guias (
+                codigo_guia TEXT PRIMARY KEY,
+                codigo TEXT NOT NULL DEFAULT '',
+                estado TEXT NOT NULL DEFAULT '',
+                datos TEXT NOT NULL DEFAULT '{}',
+                creado REAL NOT NULL,
+                actualizado REAL NOT NULL
+            )
+        """)
+        conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_guias_codigo ON guias (codigo, actualizado)"
+        )
+        conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_guias_actualizado ON guias (actualizado)"
+        )
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS guia_eventos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                codigo_guia TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                estado_anterior TEXT NOT NULL DEFAULT '',
+                estado TEXT NOT NULL DEFAULT '',
+                datos TEXT NOT NULL DEFAULT '{}',
+                creado REAL NOT NULL
+            )
+        """)
+        conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_guia_eventos_guia ON guia_eventos (codigo_guia, id)"
+        )
+        # Las guías creadas antes del historial arrancan con su estado actual
+        conexion.execute("""
+            INSERT INTO guia_eventos (codigo_guia, tipo, estado_anterior, estado, datos, creado)
+            SELECT codigo_guia, 'creacion', '', estado, datos, actualizado FROM guias
+            WHERE NOT EXISTS (
+                SELECT 1 FROM guia_eventos WHERE guia_eventos.codigo_guia = guias.codigo_guia
+            )
+        """)
+
+    def suscribir(self, funcion):
+        """
+        Registra funcion(codigo_guia), llamada en este proceso después de
+        cada cambio de una guía (por ejemplo para invalidar cachés)
+        """
+        self._suscriptores.append(funcion)
+
+    def _notificar(self, codigo_guia):
+        for funcion in self._suscriptores:
+            try:
+                funcion(codigo_guia)
+            except Exception as e:
+                logger.error(f"Error notificando cambio de la guía {codigo_guia}: {str(e)}")
+
+    def _fila_a_guia(self, fila):
+        guia = json.loads(fila['datos'])
+        guia.update({
+            'codigo_guia': fila['codigo_guia'],
+            'codigo': fila['codigo'] or guia.get('codigo', ''),
+            'estado_actual': fila['estado'] or guia.get('estado_actual', ''),
+            'actualizado': fila['actualizado']
+        })
+        return guia
+
+    def crear(self, datos=None, codigo_guia=None):
+        """
+        Crea una guía y retorna su codigo_guia. Sin código explícito se crea
+        un borrador con identificador temporal hasta el registro
+        """
+        datos = dict(datos or {})
+        codigo_guia = codigo_guia or f"borrador_{uuid.uuid4().hex}"
+        ahora = time.time()
+        datos_json = json.dumps(datos, ensure_ascii=False)
+
+        conexion = conectar(self.ruta_db)
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            conexion.execute(
+                """
+                INSERT INTO guias (codigo_guia, codigo, estado, datos, creado, actualizado)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (codigo_guia, datos.get('codigo', ''), datos.get('estado_actual', ''), datos_json, ahora, ahora)
+            )
+            self._agregar_evento(
+                conexion, codigo_guia, 'creacion', '', datos.get('estado_actual', ''), datos_json, ahora
+            )
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+        logger.info(f"Guía creada: {codigo_guia}")
+        return codigo_guia
+
+    def _agregar_evento(self, conexion, codigo_guia, tipo, estado_anterior, estado, datos_json, creado):
+        return conexion.execute(
+            """
+            INSERT INTO guia_eventos (codigo_guia, tipo, estado_anterior, estado, datos, creado)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (codigo_guia, tipo, estado_anterior, estado, datos_json, creado)
+        ).lastrowid
+
+    def obtener(self, codigo_guia):
+        """
+        Retorna los datos de la guía o None si no existe
+        """
+        if not codigo_guia:
+            return None
+        fila = conectar(self.ruta_db).execute(
+            "SELECT * FROM guias WHERE codigo_guia = ?", (codigo_guia,)
+        ).fetchone()
+        return self._fila_a_guia(fila) if fila else None
+
+    def ultima_por_codigo(self, codigo):
+        """
+        Retorna la guía más reciente del proveedor con el código dado
+        """
+        if not codigo:
+            return None
+        fila = conectar(self.ruta_db).execute(
+            "SELECT * FROM guias WHERE codigo = ? ORDER BY actualizado DESC LIMIT 1",
+            (codigo,)
+        ).fetchone()
+        return self._fila_a_guia(fila) if fila else None
+
+    def iterar(self, actualizado_desde=None):
+        """
+        Recorre todas las guías, opcionalmente solo las actualizadas desde la fecha dada
+        """
+        consulta = "SELECT * FROM guias"
+        parametros = ()
+        if actualizado_desde is not None:
+            consulta += " WHERE actualizado >= ?"
+            parametros = (actualizado_desde,)
+        for fila in conectar(self.ruta_db).execute(consulta, parametros):
+            yield self._fila_a_guia(fila)
+
+    def actualizar(self, codigo_guia, cambios):
+        """
+        Mezcla los cambios en los datos de la guía dentro de una transacción,
+        de modo que estaciones concurrentes no pisen las llaves de las otras
+        """
+        return self.registrar_evento(codigo_guia, 'actualizacion', cambios) is not None
+
+    def registrar_evento(self, codigo_guia, tipo, cambios=None, transicion=None, en_transaccion=None):
+        """
+        Agrega un evento al historial de la guía y aplica sus cambios al estado
+        actual en la misma transacción. transicion(estado, datos, cambios), si
+        se da, valida el evento contra el estado actual y retorna el estado
+        nuevo y los cambios a aplicar, o lanza una excepción.
+        en_transaccion(conexion), si se da, escribe en la misma transacción
+        (por ejemplo una notificación del outbox) antes de confirmarla.
+        Retorna la guía resultante o None si no existe
+        """
+        cambios = {
+            llave: valor for llave, valor in (cambios or {}).items()
+            if llave not in self.LLAVES_IDENTIDAD
+        }
+        conexion = conectar(self.ruta_db)
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            fila = conexion.execute(
+                "SELECT * FROM guias WHERE codigo_guia = ?",
+                (codigo_guia,)
+            ).fetchone()
+            if fila is None:
+                conexion.execute("ROLLBACK")
+                logger.warning(f"Guía no encontrada para actualizar: {codigo_guia}")
+                return None
+
+            datos = json.loads(fila['datos'])
+            if transicion:
+                estado, cambios = transicion(fila['estado'], datos, cambios)
+            else:
+                estado = cambios.get('estado_actual', fila['estado'])
+            codigo = cambios.get('codigo', fila['codigo'])
+            datos.update(cambios)
+
+            ahora = time.time()
+            self._agregar_evento(
+                conexion, codigo_guia, tipo, fila['estado'], estado,
+                json.dumps(cambios, ensure_ascii=False), ahora
+            )
+            conexion.execute(
+                """
+                UPDATE guias SET codigo = ?, estado = ?, datos = ?, actualizado = ?
+                WHERE codigo_guia = ?
+                """,
+                (codigo, estado, json.dumps(datos, ensure_ascii=False), ahora, codigo_guia)
+            )
+            if en_transaccion:
+                en_transaccion(conexion)
+            conexion.execute("COMMIT")
+
+        except Exception as e:
+            conexion.execute("ROLLBACK")
+            # Las transiciones inválidas (ValueError) son errores del cliente
+            if not isinstance(e, ValueError):
+                logger.error(f"Error registrando evento {tipo} de la guía {codigo_guia}: {str(e)}")
+                logger.error(traceback.format_exc())
+            raise
+
+        self._notificar(codigo_guia)
+        datos.update({
+            'codigo_guia': codigo_guia,
+            'codigo': codigo or datos.get('codigo', ''),
+            'estado_actual': estado,
+            'actualizado': ahora
+        })
+        return datos
+
+    def historial(self, codigo_guia):
+        """
+        Eventos de la guía en orden
+        """
+        filas = conectar(self.ruta_db).execute(
+            "SELECT * FROM guia_eventos WHERE codigo_guia = ? ORDER BY id", (codigo_guia,)
+        ).fetchall()
+        return [dict(fila, datos=json.loads(fila['datos'])) for fila in filas]
+
+    def eventos_desde(self, desde=0, limite=500):
+        """
+        Eventos de todas las guías posteriores al id dado, sin sus datos,
+        con el código del proveedor de la guía
+        """
+        filas = conectar(self.ruta_db).execute(
+            """
+            SELECT e.id, e.codigo_guia, e.tipo, e.estado_anterior, e.estado, e.creado,
+                COALESCE(g.codigo, '') AS codigo
+            FROM guia_eventos e LEFT JOIN guias g ON g.codigo_guia = e.codigo_guia
+            WHERE e.id > ? ORDER BY e.id LIMIT ?
+            """,
+            (desde, limite)
+        ).fetchall()
+        return [dict(fila) for fila in filas]
+
+    def ultimo_evento(self):
+        return conectar(self.ruta_db).execute("SELECT COALESCE(MAX(id), 0) FROM guia_eventos").fetchone()[0]
+
+    def activas(self, actualizado_desde):
+        """
+        Resumen de las guías registradas que no han salido, actualizadas desde el timestamp dado
+        """
+        filas = conectar(self.ruta_db).execute(
+            """
+            SELECT codigo_guia, codigo, estado, actualizado FROM guias
+            WHERE actualizado >= ? AND estado NOT IN ('', 'revision', 'cerrada')
+            ORDER BY actualizado DESC
+            """,
+            (actualizado_desde,)
+        ).fetchall()
+        return [dict(fila) for fila in filas]
+
+    def reconstruir(self, codigo_guia):
+        """
+        Reconstruye el estado de la guía aplicando su historial de eventos,
+        para verificar o reparar la tabla materializada
+        """
+        eventos = self.historial(codigo_guia)
+        if not eventos:
+            return None
+        datos = {}
+        for evento in eventos:
+            datos.update(evento['datos'])
+        datos.update({
+            'codigo_guia': codigo_guia,
+            'estado_actual': eventos[-1]['estado'],
+            'actualizado': eventos[-1]['creado']
+        })
+        return datos
+
+    def renombrar(self, codigo_guia, nuevo_codigo_guia):
+        """
+        Asigna el codigo_guia definitivo a un borrador al momento del registro.
+        Si ya existe una guía con ese código (dos tiquetes del mismo proveedor
+        en el mismo segundo) se agrega un sufijo y se retorna el código usado.
+        El historial del borrador pasa a la guía con su nuevo código
+        """
+        conexion = conectar(self.ruta_db)
+        candidato = nuevo_codigo_guia
+        for intento in range(2, 100):
+            conexion.execute("BEGIN IMMEDIATE")
+            try:
+                ahora = time.time()
+                conexion.execute(
+                    "UPDATE guias SET codigo_guia = ?, actualizado = ? WHERE codigo_guia = ?",
+                    (candidato, ahora, codigo_guia)
+                )
+            except sqlite3.IntegrityError:
+                conexion.execute("ROLLBACK")
+                candidato = f"{nuevo_codigo_guia}_{intento}"
+                continue
+            conexion.execute(
+                "UPDATE guia_eventos SET codigo_guia = ? WHERE codigo_guia = ?",
+                (candidato, codigo_guia)
+            )
+            estado = conexion.execute(
+                "SELECT estado FROM guias WHERE codigo_guia = ?", (candidato,)
+            ).fetchone()
+            estado = estado['estado'] if estado else ''
+            self._agregar_evento(
+                conexion, candidato, 'renombrado', estado, estado,
+                '{}', ahora
+            )
+            conexion.execute("COMMIT")
+            break
+        else:
+            raise ValueError(f"No se pudo asignar un código único a la guía {codigo_guia}")
+        logger.info(f"Guía {codigo_guia} renombrada a {candidato}")
+        self._notificar(codigo_guia)
+        return candidato
@@ -0,0 +1,58 @@
+# gunicorn.conf.py
+#
+# Perfil de producción: pocos procesos con hilos para las peticiones que
+# esperan a los webhooks, y la aplicación cargada una vez antes del fork.
+# Cada worker crea su propio pool de PDFs (PDF_WORKERS procesos) y sus hilos
+# OCR, de normalización de imágenes y del orquestador; el estado compartido
+# (guías, códigos de autorización, lotes, caché OCR) vive en SQLite bajo
+# data/. En total corren workers × (1 + PDF_WORKERS) procesos, así que por
+# defecto los núcleos se reparten entre los pools de PDFs de los workers.
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+
+import os
+import multiprocessing
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5002')
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+worker_class = 'gthread'
+
+# La configuración se lee antes de cargar la aplicación: el valor por defecto
+# de PDF_WORKERS queda en núcleos / workers en lugar de min(4, núcleos) por worker
+os.environ.setdefault('PDF_WORKERS', str(max(1, multiprocessing.cpu_count() // workers)))
+
+# La aplicación (plantillas, índice de la base maestra, tablas SQLite) se carga
+# una sola vez; los pools y los hilos de fondo se crean en cada worker
+preload_app = True
+
+# Los webhooks de OCR y pesaje pueden tardar hasta 60s
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Reciclar workers de vez en cuando acota el crecimiento de memoria
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = os.getenv('GUNICORN_ERROR_LOG', '-')
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    """
+    Arranca los servicios de fondo del worker (precalentado de PDFs,
+    limpieza de códigos, retención) sin esperar la primera petición
+    """
+    from apptiquetes import iniciar_servicios
+    iniciar_servicios()
+
+
+def worker_exit(server, worker):
+    """
+    Apagado ordenado del worker: termina los trabajos OCR encolados, detiene
+    los hilos de fondo y cierra el pool de PDFs
+    """
+    from apptiquetes import detener_servicios
+    detener_servicios()
@@ -0,0 +1,138 @@
+# image_prep.py
+
+import os
+import time
+import logging
+import threading
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+
+def normalizar_imagen(origen, max_lado=1600, calidad=80, escala_grises=True):
+    """
+    Aplica la orientación EXIF, reduce la imagen a max_lado en su lado mayor,
+    la convierte a escala de grises y la recomprime como JPEG. origen puede
+    ser una ruta o un archivo abierto. Retorna (ancho, alto) y un buffer en
+    memoria con el JPEG, listo para enviarse
+    """
+    modo = 'L' if escala_grises else 'RGB'
+    with Image.open(origen) as img:
+        # En JPEG se decodifica directamente a una escala reducida
+        ancho, alto = img.size
+        escala = min(1.0, max_lado / max(ancho, alto))
+        img.draft(modo, (int(ancho * escala), int(alto * escala)))
+
+        img = ImageOps.exif_transpose(img)
+        if img.mode != modo:
+            img = img.convert(modo)
+        img.thumbnail((max_lado, max_lado), Image.LANCZOS)
+
+        buffer = BytesIO()
+        img.save(buffer, 'JPEG', quality=calidad, optimize=True)
+
+    buffer.seek(0)
+    return img.size, buffer
+
+
+class ImageNormalizer:
+    """
+    Normalización de imágenes antes de enviarlas a los webhooks de OCR y
+    pesaje, en un pool acotado de hilos. El original se conserva intacto
+    para auditoría; la versión normalizada solo existe en memoria mientras
+    se envía (los reenvíos de la misma imagen los evita la caché OCR)
+    """
+
+    def __init__(self, max_workers=2, max_lado=1600, calidad=80, escala_grises=True,
+                 habilitado=True, timeout=30):
+        self.max_workers = max_workers
+        self.max_lado = max_lado
+        self.calidad = calidad
+        self.escala_grises = escala_grises
+        self.habilitado = habilitado
+        self.timeout = timeout
+
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._contadores = {'normalizadas': 0, 'fallidas': 0}
+        self._bytes = {'originales': 0, 'normalizados': 0}
+        self._duraciones = deque(maxlen=200)
+
+    def _obtener_executor(self):
+        # El pool se crea de forma perezosa y de nuevo tras un fork del servidor
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='normalizador'
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def abrir(self, ruta_original, archivo=None):
+        """
+        Retorna (nombre, archivo abierto) de la imagen a enviar: la normalizada,
+        o la original si la normalización está deshabilitada o falla. Si se
+        pasa el archivo original ya abierto, es el que se retorna en ese caso;
+        el hilo de normalización lee la ruta con su propio handle, porque tras
+        un timeout puede seguir leyendo mientras se envía el original
+        """
+        if not self.habilitado:
+            return self._original(ruta_original, archivo)
+
+        inicio = time.perf_counter()
+        try:
+            future = self._obtener_executor().submit(
+                normalizar_imagen,
+                ruta_original,
+                self.max_lado,
+                self.calidad,
+                self.escala_grises
+            )
+            tamano, buffer = future.result(timeout=self.timeout)
+        except Exception as e:
+            logger.error(f"Error normalizando {ruta_original}, se enviará el original: {str(e)}")
+            with self._lock:
+                self._contadores['fallidas'] += 1
+            return self._original(ruta_original, archivo)
+
+        duracion = time.perf_counter() - inicio
+        bytes_original = os.path.getsize(ruta_original)
+        bytes_normalizado = buffer.getbuffer().nbytes
+        with self._lock:
+            self._contadores['normalizadas'] += 1
+            self._bytes['originales'] += bytes_original
+            self._bytes['normalizados'] += bytes_normalizado
+            self._duraciones.append(duracion)
+
+        logger.info(f"Imagen normalizada {os.path.basename(ruta_original)}: "
+                    f"{bytes_original} -> {bytes_normalizado} bytes, {tamano[0]}x{tamano[1]} "
+                    f"en {duracion:.3f}s")
+        nombre = os.path.splitext(os.path.basename(ruta_original))[0]
+        return f"{nombre}.jpg", buffer
+
+    def _original(self, ruta_original, archivo):
+        if archivo is not None:
+            archivo.seek(0)
+            return os.path.basename(ruta_original), archivo
+        return os.path.basename(ruta_original), open(ruta_original, 'rb')
+
+    def metrics(self):
+        with self._lock:
+            duraciones = list(self._duraciones)
+            return {
+                'habilitado': self.habilitado,
+                'max_lado': self.max_lado,
+                'calidad': self.calidad,
+                'escala_grises': self.escala_grises,
+                'contadores': dict(self._contadores),
+                'bytes': dict(self._bytes),
+                'reduccion': round(1 - self._bytes['normalizados'] / self._bytes['originales'], 3)
+                if self._bytes['originales'] else None,
+                'duracion_promedio': round(sum(duraciones) / len(duraciones), 3) if duraciones else None
+            }
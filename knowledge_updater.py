@@ -1,15 +1,22 @@
 # knowledge_updater.py
 
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, current_app
 import os
 import json
+import time
+import hashlib
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from openai import OpenAI
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2 import service_account
 from dotenv import load_dotenv
+from base_maestra import provider_index
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, 
@@ -27,6 +34,19 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ASSISTANT_ID = os.getenv('ASSISTANT_ID')
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 SERVICE_ACCOUNT_FILE = 'config/service-account.json'
+SYNC_STATE_FILE = os.path.join('logs', 'sync_state.json')
+SHEETS_HTTP_TIMEOUT = int(os.getenv('SHEETS_HTTP_TIMEOUT', 30))
+SHEETS_MAX_WORKERS = int(os.getenv('SHEETS_MAX_WORKERS', 4))
+
+# Lista de hojas específicas a monitorear
+SHEETS_TO_MONITOR = [
+    {'name': 'Asociados', 'range': 'A:Z', 'tipo': 'asociado'},
+    {'name': 'Saf', 'range': 'A:Z', 'tipo': 'saf'},
+    {'name': 'Pepa', 'range': 'A:Z', 'tipo': 'pepa'},
+]
+
+# Tiempos de la última lectura de hojas, en milisegundos
+last_fetch_timings = {}
 
 # Inicializar clientes
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
@@ -36,11 +56,26 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
 try:
     creds = service_account.Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    sheets_service = build('sheets', 'v4', credentials=creds)
+    # Sesión HTTP reutilizable (keep-alive) para todas las peticiones del servicio
+    sheets_service = build(
+        'sheets', 'v4',
+        http=AuthorizedHttp(creds, http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT)),
+        cache_discovery=False
+    )
 except Exception as e:
     logger.error(f"Error inicializando Google Sheets: {str(e)}")
+    creds = None
     sheets_service = None
 
+# httplib2 no es seguro entre hilos: una sesión reutilizable por hilo del pool
+_thread_local = threading.local()
+
+def _thread_http():
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = _thread_local.http = AuthorizedHttp(creds, http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT))
+    return http
+
 def cleanup_old_files():
     """
     Limpia archivos antiguos del asistente
@@ -64,78 +99,138 @@ def cleanup_old_files():
     except Exception as e:
         logger.error(f"Error en limpieza de archivos: {str(e)}")
 
+def _range_name(sheet):
+    return f"'{sheet['name']}'!{sheet['range']}"
+
+def _fetch_batch():
+    """
+    Lee todas las hojas con una sola llamada a values().batchGet
+    """
+    inicio = time.perf_counter()
+    result = sheets_service.spreadsheets().values().batchGet(
+        spreadsheetId=SPREADSHEET_ID,
+        ranges=[_range_name(sheet) for sheet in SHEETS_TO_MONITOR]
+    ).execute()
+    duracion = round((time.perf_counter() - inicio) * 1000, 1)
+    
+    value_ranges = result.get('valueRanges', [])
+    timings = {'batch_get': duracion}
+    values_by_sheet = {}
+    for sheet, value_range in zip(SHEETS_TO_MONITOR, value_ranges):
+        values_by_sheet[sheet['name']] = value_range.get('values', [])
+    
+    return values_by_sheet, timings
+
+def _fetch_sheet(sheet):
+    inicio = time.perf_counter()
+    result = sheets_service.spreadsheets().values().get(
+        spreadsheetId=SPREADSHEET_ID,
+        range=_range_name(sheet)
+    ).execute(http=_thread_http())
+    return result.get('values', []), round((time.perf_counter() - inicio) * 1000, 1)
+
+def _fetch_concurrent():
+    """
+    Lee las hojas en paralelo con un pool acotado cuando batchGet no está disponible
+    """
+    values_by_sheet = {}
+    timings = {}
+    workers = max(1, min(SHEETS_MAX_WORKERS, len(SHEETS_TO_MONITOR)))
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_fetch_sheet, sheet): sheet for sheet in SHEETS_TO_MONITOR}
+        for future, sheet in futures.items():
+            try:
+                values_by_sheet[sheet['name']], timings[sheet['name']] = future.result()
+            except Exception as e:
+                logger.error(f"Error leyendo hoja {sheet['name']}: {str(e)}")
+                values_by_sheet[sheet['name']] = []
+    
+    return values_by_sheet, timings
+
+def _process_sheet(sheet, values):
+    """
+    Convierte las filas de una hoja en registros de proveedor
+    """
+    records = []
+    
+    headers = [str(col).strip().lower() for col in values[0]]
+    
+    # Log de headers para debugging
+    logger.info(f"Headers in {sheet['name']}: {headers}")
+    
+    # Mapeo de nombres de columnas
+    column_mapping = {
+        'código': ['código', 'id', 'identificacion'],
+        'nombre': ['nombres', 'nombre 1', 'razon social'],
+        'placa': ['vehículo', 'matrícula']
+    }
+    
+    # Obtener indices de columnas requeridas
+    column_indices = {}
+    for required_col, alternatives in column_mapping.items():
+        for alt_col in alternatives:
+            if alt_col.lower() in headers:
+                column_indices[required_col] = headers.index(alt_col.lower())
+                break
+                
+    # Procesar datos
+    for row in values[1:]:
+        if len(row) > max(column_indices.values()):
+            data_dict = {
+                'codigo': row[column_indices['código']] if 'código' in column_indices else '',
+                'nombre': row[column_indices['nombre']] if 'nombre' in column_indices else '',
+                'placa': row[column_indices['placa']] if 'placa' in column_indices else '',
+                'tipo_proveedor': sheet["tipo"]
+            }
+            
+            # Solo agregar si al menos uno de los campos tiene valor
+            if any(data_dict.values()):
+                records.append(data_dict)
+    
+    return records
+
 def get_sheet_data():
     """
     Obtiene los datos actualizados de todas las hojas relevantes
     """
+    global last_fetch_timings
+    
     if not sheets_service:
         logger.error("Servicio de Google Sheets no inicializado")
         return None
         
     try:
-        # Lista de hojas específicas a monitorear
-        SHEETS_TO_MONITOR = [
-            {'name': 'Asociados', 'range': 'A:Z', 'tipo': 'asociado'},
-            {'name': 'Saf', 'range': 'A:Z', 'tipo': 'saf'},
-            {'name': 'Pepa', 'range': 'A:Z', 'tipo': 'pepa'},
-        ]
+        inicio = time.perf_counter()
+        
+        try:
+            values_by_sheet, timings = _fetch_batch()
+        except Exception as e:
+            logger.warning(f"batchGet no disponible ({str(e)}), leyendo hojas en paralelo")
+            values_by_sheet, timings = _fetch_concurrent()
         
         all_data = []
         
         for sheet in SHEETS_TO_MONITOR:
             try:
-                # Construir el rango usando el método correcto
-                range_name = f"'{sheet['name']}'!{sheet['range']}"
-                
-                result = sheets_service.spreadsheets().values().get(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=range_name
-                ).execute()
-                
-                values = result.get('values', [])
+                values = values_by_sheet.get(sheet['name'], [])
                 if not values:
                     logger.warning(f'No data found in sheet: {sheet["name"]}')
                     continue
-                    
-                headers = [str(col).strip().lower() for col in values[0]]
-                
-                # Log de headers para debugging
-                logger.info(f"Headers in {sheet['name']}: {headers}")
                 
-                # Mapeo de nombres de columnas
-                column_mapping = {
-                    'código': ['código', 'id', 'identificacion'],
-                    'nombre': ['nombres', 'nombre 1', 'razon social'],
-                    'placa': ['vehículo', 'matrícula']
-                }
-                
-                # Obtener indices de columnas requeridas
-                column_indices = {}
-                for required_col, alternatives in column_mapping.items():
-                    for alt_col in alternatives:
-                        if alt_col.lower() in headers:
-                            column_indices[required_col] = headers.index(alt_col.lower())
-                            break
-                            
-                # Procesar datos
-                for row in values[1:]:
-                    if len(row) > max(column_indices.values()):
-                        data_dict = {
-                            'codigo': row[column_indices['código']] if 'código' in column_indices else '',
-                            'nombre': row[column_indices['nombre']] if 'nombre' in column_indices else '',
-                            'placa': row[column_indices['placa']] if 'placa' in column_indices else '',
-                            'tipo_proveedor': sheet["tipo"]
-                        }
-                        
-                        # Solo agregar si al menos uno de los campos tiene valor
-                        if any(data_dict.values()):
-                            all_data.append(data_dict)
+                inicio_hoja = time.perf_counter()
+                all_data.extend(_process_sheet(sheet, values))
+                timings[f"procesar_{sheet['name']}"] = round((time.perf_counter() - inicio_hoja) * 1000, 1)
                 
                 logger.info(f"Procesados {len(values)-1} registros de {sheet['name']}")
                 
             except Exception as e:
                 logger.error(f"Error procesando hoja {sheet['name']}: {str(e)}")
                 continue
+        
+        timings['total'] = round((time.perf_counter() - inicio) * 1000, 1)
+        last_fetch_timings = timings
+        logger.info(f"Tiempos de lectura de hojas (ms): {timings}")
                 
         if not all_data:
             logger.error("No se encontraron datos válidos en ninguna hoja")
@@ -178,15 +273,109 @@ def format_assistant_data(data):
     
     return formatted_data
 
+def fingerprint_row(row):
+    """
+    Huella SHA-1 del contenido de una fila
+    """
+    contenido = json.dumps(row, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(contenido.encode('utf-8')).hexdigest()
+
+def build_fingerprints(data):
+    """
+    Calcula la huella de cada fila y de cada hoja. Las filas se identifican
+    por tipo de proveedor y código; las que no tienen código, por su contenido
+    """
+    filas = {}
+    hojas = {}
+    
+    for row in data:
+        tipo = row.get('tipo_proveedor', '')
+        huella = fingerprint_row(row)
+        codigo = str(row.get('codigo', '')).strip()
+        base = f"{tipo}:{codigo}" if codigo else f"{tipo}:~{huella}"
+        
+        # Desambiguar códigos repetidos dentro de la misma hoja
+        llave, n = base, 1
+        while llave in filas:
+            n += 1
+            llave = f"{base}#{n}"
+        
+        filas[llave] = huella
+        hojas.setdefault(tipo, hashlib.sha1())
+        hojas[tipo].update(f"{llave}={huella};".encode('utf-8'))
+    
+    return {
+        'filas': filas,
+        'hojas': {tipo: sha.hexdigest() for tipo, sha in hojas.items()}
+    }
+
+def load_sync_state():
+    """
+    Carga el estado de la última sincronización
+    """
+    try:
+        if os.path.exists(SYNC_STATE_FILE):
+            with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        logger.error(f"Error leyendo estado de sincronización: {str(e)}")
+    return {}
+
+def save_sync_state(state):
+    """
+    Guarda el estado de sincronización de forma atómica
+    """
+    os.makedirs(os.path.dirname(SYNC_STATE_FILE), exist_ok=True)
+    temp_path = f"{SYNC_STATE_FILE}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temp_path, SYNC_STATE_FILE)
+
+def compute_changes(data, fingerprints, previous_state):
+    """
+    Compara las huellas actuales con las de la última sincronización y
+    retorna un conjunto de cambios compacto
+    """
+    hojas_anteriores = previous_state.get('hojas', {})
+    filas_anteriores = previous_state.get('filas', {})
+    
+    hojas_modificadas = sorted(
+        tipo for tipo in set(fingerprints['hojas']) | set(hojas_anteriores)
+        if fingerprints['hojas'].get(tipo) != hojas_anteriores.get(tipo)
+    )
+    
+    cambios = {
+        'sin_cambios': not hojas_modificadas,
+        'hojas_modificadas': hojas_modificadas,
+        'agregados': [],
+        'modificados': [],
+        'eliminados': []
+    }
+    if not hojas_modificadas:
+        return cambios
+    
+    filas_por_llave = dict(zip(fingerprints['filas'].keys(), data))
+    for llave, huella in fingerprints['filas'].items():
+        if llave.split(':', 1)[0] not in hojas_modificadas:
+            continue
+        if llave not in filas_anteriores:
+            cambios['agregados'].append(filas_por_llave[llave])
+        elif filas_anteriores[llave] != huella:
+            cambios['modificados'].append(filas_por_llave[llave])
+    
+    cambios['eliminados'] = [
+        llave for llave in filas_anteriores
+        if llave.split(':', 1)[0] in hojas_modificadas and llave not in fingerprints['filas']
+    ]
+    
+    return cambios
+
 @knowledge_bp.route('/update-assistant-knowledge', methods=['POST'])
 def update_assistant_knowledge():
     """
     Actualiza la base de conocimiento del asistente
     """
     try:
-        # Limpiar archivos antiguos
-        cleanup_old_files()
-        
         # Obtener datos actualizados de Google Sheets
         sheet_data = get_sheet_data()
         
@@ -196,6 +385,35 @@ def update_assistant_knowledge():
                 'message': 'No se pudieron obtener los datos de Google Sheets'
             }), 500
 
+        fingerprints = build_fingerprints(sheet_data)
+
+        # Refrescar el índice local de la base maestra; el snapshot lo
+        # propaga a los demás procesos del servidor y solo se escribe si
+        # cambió alguna hoja
+        provider_index.guardar_snapshot(
+            current_app.config['BASE_MAESTRA_FOLDER'],
+            sheet_data,
+            huella=hashlib.sha1(json.dumps(fingerprints['hojas'], sort_keys=True).encode('utf-8')).hexdigest()
+        )
+
+        # Comparar contra la última sincronización
+        force = request.args.get('force', '').lower() in ('1', 'true', 'si')
+        previous_state = load_sync_state()
+        changes = compute_changes(sheet_data, fingerprints, previous_state)
+        
+        if changes['sin_cambios'] and previous_state.get('file_id') and not force:
+            logger.info("Base maestra sin cambios, se omite la carga al asistente")
+            return jsonify({
+                'success': True,
+                'message': 'La base de conocimiento ya está actualizada',
+                'records': len(sheet_data),
+                'sin_cambios': True,
+                'file_id': previous_state.get('file_id')
+            })
+
+        # Limpiar archivos antiguos
+        cleanup_old_files()
+
         # Formatear datos para el asistente
         formatted_data = format_assistant_data(sheet_data)
         
@@ -220,18 +438,35 @@ def update_assistant_knowledge():
             file_ids=[file.id]
         )
 
-        # Registro de actualización
+        # Guardar huellas de esta sincronización
+        save_sync_state({
+            'timestamp': datetime.now().isoformat(),
+            'file_id': file.id,
+            'hojas': fingerprints['hojas'],
+            'filas': fingerprints['filas']
+        })
+
+        # Registro de actualización con el conjunto de cambios
+        changes_summary = {
+            'hojas_modificadas': changes['hojas_modificadas'],
+            'agregados': len(changes['agregados']),
+            'modificados': len(changes['modificados']),
+            'eliminados': len(changes['eliminados'])
+        }
         update_log = {
             'timestamp': datetime.now().isoformat(),
             'records_count': len(sheet_data),
             'file_id': file.id,
-            'assistant_id': assistant.id
+            'assistant_id': assistant.id,
+            'cambios': changes_summary
         }
         
         log_dir = 'logs'
         os.makedirs(log_dir, exist_ok=True)
         with open(os.path.join(log_dir, 'updates_log.json'), 'a') as f:
             f.write(json.dumps(update_log) + '\n')
+        with open(os.path.join(log_dir, 'changes_log.json'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'timestamp': update_log['timestamp'], **changes}, ensure_ascii=False) + '\n')
 
         logger.info(f"Base de conocimiento actualizada: {len(sheet_data)} registros")
         
@@ -243,7 +478,9 @@ def update_assistant_knowledge():
             'message': 'Base de conocimiento actualizada correctamente',
             'records': len(sheet_data),
             'assistant_id': assistant.id,
-            'file_id': file.id
+            'file_id': file.id,
+            'sin_cambios': False,
+            'cambios': changes_summary
         })
         
     except Exception as e:
@@ -278,7 +515,8 @@ def test_update():
             'success': True,
             'message': 'Prueba de actualización completada',
             'total_records': formatted_data['metadata']['total_records'],
-            'records_by_type': formatted_data['metadata']['records_by_type']
+            'records_by_type': formatted_data['metadata']['records_by_type'],
+            'timings_ms': last_fetch_timings
         })
     
     except Exception as e:
@@ -0,0 +1,165 @@
+# ocr_cache.py
+
+import json
+import time
+import hashlib
+import logging
+import threading
+import traceback
+
+from db import conectar
+
+logger = logging.getLogger(__name__)
+
+
+def hash_archivo(ruta, tamano_bloque=1024 * 1024):
+    """
+    Calcula el hash SHA-256 del contenido de un archivo leyéndolo por bloques
+    """
+    sha = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(tamano_bloque), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+
+class OCRCache:
+    """
+    Caché persistente de resultados OCR indexada por el hash del contenido
+    de la imagen, con expiración por TTL y desalojo LRU por número de entradas
+    """
+
+    def __init__(self, ruta_db, ttl=7 * 24 * 3600, max_entradas=5000):
+        self.ruta_db = ruta_db
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._estadisticas = {'aciertos': 0, 'fallos': 0, 'expirados': 0, 'desalojados': 0}
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conexion = conectar(self.ruta_db)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_cache (
+                hash TEXT PRIMARY KEY,
+                markdown TEXT NOT NULL,
+                parsed_data TEXT NOT NULL,
+                creado REAL NOT NULL,
+                ultimo_acceso REAL NOT NULL,
+                aciertos INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ocr_cache_acceso ON ocr_cache (ultimo_acceso)"
+        )
+
+    def _contar(self, estadistica, cantidad=1):
+        with self._lock:
+            self._estadisticas[estadistica] += cantidad
+
+    def get(self, image_hash):
+        """
+        Retorna {'markdown', 'parsed_data'} si el hash está en caché y vigente
+        """
+        try:
+            conexion = conectar(self.ruta_db)
+            fila = conexion.execute(
+                "SELECT markdown, parsed_data, creado FROM ocr_cache WHERE hash = ?",
+                (image_hash,)
+            ).fetchone()
+
+            if fila is None:
+                self._contar('fallos')
+                return None
+
+            ahora = time.time()
+            if ahora - fila['creado'] > self.ttl:
+                conexion.execute("DELETE FROM ocr_cache WHERE hash = ?", (image_hash,))
+                self._contar('expirados')
+                self._contar('fallos')
+                return None
+
+            conexion.execute(
+                "UPDATE ocr_cache SET ultimo_acceso = ?, aciertos = aciertos + 1 WHERE hash = ?",
+                (ahora, image_hash)
+            )
+            self._contar('aciertos')
+            logger.info(f"Resultado OCR obtenido de caché: {image_hash[:12]}")
+            return {
+                'markdown': fila['markdown'],
+                'parsed_data': json.loads(fila['parsed_data'])
+            }
+
+        except Exception as e:
+            logger.error(f"Error leyendo caché OCR: {str(e)}")
+            logger.error(traceback.format_exc())
+            return None
+
+    def set(self, image_hash, markdown, parsed_data):
+        """
+        Guarda el markdown del webhook y los datos parseados para el hash dado
+        """
+        try:
+            ahora = time.time()
+            conexion = conectar(self.ruta_db)
+            conexion.execute(
+                """
+                INSERT OR REPLACE INTO ocr_cache
+                    (hash, markdown, parsed_data, creado, ultimo_acceso, aciertos)
+                VALUES (?, ?, ?, ?, ?, 0)
+                """,
+                (image_hash, markdown, json.dumps(parsed_data, ensure_ascii=False), ahora, ahora)
+            )
+            self._desalojar(conexion)
+        except Exception as e:
+            logger.error(f"Error guardando en caché OCR: {str(e)}")
+            logger.error(traceback.format_exc())
+
+    def _desalojar(self, conexion):
+        """
+        Elimina entradas expiradas y las menos usadas recientemente si se supera el límite
+        """
+        expiradas = conexion.execute(
+            "DELETE FROM ocr_cache WHERE creado < ?", (time.time() - self.ttl,)
+        ).rowcount
+        if expiradas:
+            self._contar('expirados', expiradas)
+
+        total = conexion.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+        exceso = total - self.max_entradas
+        if exceso > 0:
+            conexion.execute(
+                """
+                DELETE FROM ocr_cache WHERE hash IN (
+                    SELECT hash FROM ocr_cache ORDER BY ultimo_acceso ASC LIMIT ?
+                )
+                """,
+                (exceso,)
+            )
+            self._contar('desalojados', exceso)
+            logger.info(f"Caché OCR: {exceso} entradas desalojadas por LRU")
+
+    def respuestas(self, limite=None):
+        """
+        Markdown de las respuestas guardadas, las más recientes primero
+        """
+        filas = conectar(self.ruta_db).execute(
+            "SELECT markdown FROM ocr_cache ORDER BY creado DESC LIMIT ?",
+            (limite if limite else -1,)
+        ).fetchall()
+        return [fila['markdown'] for fila in filas]
+
+    def stats(self):
+        """
+        Estadísticas de uso de la caché
+        """
+        conexion = conectar(self.ruta_db)
+        total = conexion.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+        with self._lock:
+            estadisticas = dict(self._estadisticas)
+        estadisticas.update({
+            'entradas': total,
+            'max_entradas': self.max_entradas,
+            'ttl': self.ttl
+        })
+        return estadisticas
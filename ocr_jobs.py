@@ -0,0 +1,307 @@
+# ocr_jobs.py
+
+import os
+import time
+import uuid
+import queue
+import threading
+import logging
+import traceback
+from collections import deque
+
+import requests
+
+from parser import parse_markdown_response
+
+logger = logging.getLogger(__name__)
+
+
+class ColaLlenaError(Exception):
+    """
+    Se lanza cuando la cola de trabajos OCR alcanzó su capacidad máxima
+    """
+    pass
+
+
+def solicitar_ocr(webhook_client, endpoint, image_path, image_filename, timeout, cache=None, image_hash=None,
+                  normalizador=None):
+    """
+    Envía la imagen al webhook OCR (normalizada si hay normalizador) y parsea
+    la respuesta. Retorna (estado, resultado, mensaje)
+    """
+    estado, resultado, mensaje = 'error', None, ''
+    try:
+        if not os.path.exists(image_path):
+            raise FileNotFoundError("Archivo no encontrado.")
+
+        if normalizador:
+            image_filename, archivo = normalizador.abrir(image_path)
+        else:
+            archivo = open(image_path, 'rb')
+
+        with archivo as f:
+            files = {'file': (image_filename, f, 'multipart/form-data')}
+            response = webhook_client.post(endpoint, files=files, timeout=timeout)
+
+        logger.info(f"Respuesta del Webhook OCR para {image_filename}: {response.status_code}")
+
+        response_text = response.text.strip()
+        if response.status_code != 200:
+            mensaje = f"Error del webhook: {response.text}"
+        elif not response_text:
+            mensaje = "Respuesta vacía del webhook."
+        else:
+            resultado = parse_markdown_response(response_text)
+            if resultado:
+                estado = 'completado'
+                if cache and image_hash:
+                    cache.set(image_hash, response_text, resultado)
+            else:
+                mensaje = "No se pudieron parsear los datos."
+
+    except requests.exceptions.Timeout:
+        estado, mensaje = 'expirado', f"El webhook no respondió en {timeout} segundos."
+    except Exception as e:
+        logger.error(f"Error procesando OCR de {image_filename}: {str(e)}")
+        mensaje = f"Error al procesar la imagen: {str(e)}"
+
+    return estado, resultado, mensaje
+
+
+class OCRJobQueue:
+    """
+    Cola de trabajos OCR con un pool acotado de workers que envían las
+    imágenes al webhook de procesamiento sin bloquear los hilos de Flask.
+    El estado de los trabajos vive en el proceso que los encoló; al_finalizar,
+    si se da, recibe cada trabajo terminado para guardarlo donde lo vean
+    los demás procesos del servidor
+    """
+
+    ESTADOS_FINALES = ('completado', 'error', 'expirado')
+
+    def __init__(self, app, webhook_client, endpoint='process', max_workers=4, max_queue=50, timeout=60,
+                 retencion=3600, cache=None, normalizador=None, al_finalizar=None):
+        self.app = app
+        self.webhook_client = webhook_client
+        self.endpoint = endpoint
+        self.cache = cache
+        self.normalizador = normalizador
+        self.al_finalizar = al_finalizar
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retencion = retencion
+
+        self._cola = queue.Queue(maxsize=max_queue)
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        self._pid = None
+
+        # Métricas
+        self._en_proceso = 0
+        self._contadores = {
+            'encolados': 0,
+            'completados': 0,
+            'fallidos': 0,
+            'expirados': 0,
+            'rechazados': 0
+        }
+        self._latencias = deque(maxlen=200)
+        self._esperas = deque(maxlen=200)
+        self._finalizados = deque(maxlen=1000)
+
+    def _asegurar_workers(self):
+        """
+        Inicia los workers de forma perezosa (y de nuevo tras un fork)
+        """
+        if self._pid == os.getpid() and self._workers:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._workers:
+                return
+            self._pid = os.getpid()
+            self._workers = []
+            for i in range(self.max_workers):
+                worker = threading.Thread(
+                    target=self._ejecutar_worker,
+                    name=f"ocr-worker-{i}",
+                    daemon=True
+                )
+                worker.start()
+                self._workers.append(worker)
+            logger.info(f"Pool OCR iniciado con {self.max_workers} workers (pid {self._pid})")
+
+    def enqueue(self, image_path, image_filename, image_hash=None, contexto=None):
+        """
+        Encola un trabajo OCR y retorna su identificador. contexto se
+        conserva en el trabajo para al_finalizar
+        """
+        self._asegurar_workers()
+        self._limpiar_trabajos()
+
+        job_id = uuid.uuid4().hex
+        trabajo = {
+            'id': job_id,
+            'image_path': image_path,
+            'image_filename': image_filename,
+            'image_hash': image_hash,
+            'contexto': contexto,
+            'estado': 'en_cola',
+            'creado': time.time(),
+            'iniciado': None,
+            'finalizado': None,
+            'resultado': None,
+            'mensaje': ''
+        }
+
+        with self._lock:
+            self._trabajos[job_id] = trabajo
+
+        try:
+            self._cola.put_nowait(job_id)
+        except queue.Full:
+            with self._lock:
+                self._trabajos.pop(job_id, None)
+                self._contadores['rechazados'] += 1
+            logger.warning(f"Cola OCR llena, trabajo rechazado para {image_filename}")
+            raise ColaLlenaError("La cola de procesamiento está llena, intente de nuevo en unos segundos.")
+
+        with self._lock:
+            self._contadores['encolados'] += 1
+
+        logger.info(f"Trabajo OCR {job_id} encolado para {image_filename} (profundidad: {self._cola.qsize()})")
+        return job_id
+
+    def get(self, job_id):
+        """
+        Retorna una copia del estado del trabajo o None si no existe
+        """
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            return dict(trabajo) if trabajo else None
+
+    def _ejecutar_worker(self):
+        while True:
+            job_id = self._cola.get()
+            try:
+                self._procesar(job_id)
+            except Exception as e:
+                logger.error(f"Error inesperado en worker OCR: {str(e)}")
+                logger.error(traceback.format_exc())
+            finally:
+                self._cola.task_done()
+
+    def _procesar(self, job_id):
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            if not trabajo:
+                return
+            inicio = time.time()
+            espera = inicio - trabajo['creado']
+            self._esperas.append(espera)
+
+            # Si el trabajo esperó más que su timeout ya nadie lo está esperando
+            expirado = espera > self.timeout
+            if expirado:
+                self._finalizar(trabajo, 'expirado', mensaje="El trabajo expiró antes de ser procesado.")
+            else:
+                trabajo['estado'] = 'procesando'
+                trabajo['iniciado'] = inicio
+                self._en_proceso += 1
+
+        if expirado:
+            self._notificar(dict(trabajo))
+            return
+
+        estado, resultado, mensaje = solicitar_ocr(
+            self.webhook_client,
+            self.endpoint,
+            trabajo['image_path'],
+            trabajo['image_filename'],
+            self.timeout,
+            cache=self.cache,
+            image_hash=trabajo['image_hash'],
+            normalizador=self.normalizador
+        )
+
+        # El resultado se guarda antes de marcar el trabajo como terminado,
+        # para que quien consulte el estado ya lo encuentre
+        self._notificar(dict(trabajo, estado=estado, resultado=resultado, mensaje=mensaje))
+
+        with self._lock:
+            self._en_proceso -= 1
+            self._latencias.append(time.time() - inicio)
+            self._finalizar(trabajo, estado, resultado, mensaje)
+
+    def _notificar(self, trabajo):
+        if not self.al_finalizar:
+            return
+        try:
+            self.al_finalizar(trabajo)
+        except Exception as e:
+            logger.error(f"Error guardando el resultado del trabajo OCR {trabajo['id']}: {str(e)}")
+            logger.error(traceback.format_exc())
+
+    def esperar(self, timeout):
+        """
+        Espera hasta timeout segundos a que se procesen los trabajos
+        encolados, para un apagado ordenado. Retorna True si la cola quedó vacía
+        """
+        limite = time.time() + timeout
+        while self._cola.unfinished_tasks and time.time() < limite:
+            time.sleep(0.1)
+        return not self._cola.unfinished_tasks
+
+    def _finalizar(self, trabajo, estado, resultado=None, mensaje=''):
+        # Debe llamarse con el lock tomado
+        trabajo['estado'] = estado
+        trabajo['resultado'] = resultado
+        trabajo['mensaje'] = mensaje
+        trabajo['finalizado'] = time.time()
+        self._finalizados.append(trabajo['finalizado'])
+
+        if estado == 'completado':
+            self._contadores['completados'] += 1
+        elif estado == 'expirado':
+            self._contadores['expirados'] += 1
+        else:
+            self._contadores['fallidos'] += 1
+
+        logger.info(f"Trabajo OCR {trabajo['id']} finalizado: {estado} {mensaje}")
+
+    def _limpiar_trabajos(self):
+        """
+        Elimina trabajos finalizados más antiguos que el periodo de retención
+        """
+        limite = time.time() - self.retencion
+        with self._lock:
+            antiguos = [
+                job_id for job_id, trabajo in self._trabajos.items()
+                if trabajo['estado'] in self.ESTADOS_FINALES and trabajo['finalizado'] < limite
+            ]
+            for job_id in antiguos:
+                del self._trabajos[job_id]
+
+    def metrics(self):
+        """
+        Métricas de profundidad de cola, concurrencia y throughput
+        """
+        ahora = time.time()
+        with self._lock:
+            latencias = sorted(self._latencias)
+            esperas = list(self._esperas)
+            ultimo_minuto = len([t for t in self._finalizados if t >= ahora - 60])
+
+            return {
+                'profundidad_cola': self._cola.qsize(),
+                'capacidad_cola': self._cola.maxsize,
+                'en_proceso': self._en_proceso,
+                'max_workers': self.max_workers,
+                'timeout': self.timeout,
+                'trabajos_registrados': len(self._trabajos),
+                'contadores': dict(self._contadores),
+                'throughput_ultimo_minuto': ultimo_minuto,
+                'latencia_promedio': round(sum(latencias) / len(latencias), 3) if latencias else None,
+                'latencia_p95': round(latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))], 3) if latencias else None,
+                'espera_promedio': round(sum(esperas) / len(esperas), 3) if esperas else None
+            }
@@ -0,0 +1,65 @@
+# orquestador.py
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Orquestador:
+    """
+    Ejecuta en paralelo los pasos independientes de una operación (webhook
+    de registro, QR y PDF), cada uno dentro del contexto de la aplicación,
+    de modo que la latencia es la del paso más lento y no la suma de todos.
+    Las notificaciones no críticas no pasan por aquí sino por el outbox
+    """
+
+    def __init__(self, app, max_workers=8):
+        self.app = app
+        self.max_workers = max_workers
+
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _obtener_executor(self):
+        # El pool se crea de forma perezosa y de nuevo tras un fork del servidor
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='orquestador')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _en_contexto(self, funcion):
+        # Sin SERVER_NAME, url_for requiere una petición: se usa una a URL_PUBLICA
+        with self.app.test_request_context(base_url=self.app.config['URL_PUBLICA']):
+            return funcion()
+
+    def en_paralelo(self, **pasos):
+        """
+        Ejecuta los pasos (nombre=función sin argumentos) al mismo tiempo y
+        retorna sus resultados por nombre. Se espera a todos; si alguno
+        falla se relanza el error del primero que falló en el orden dado
+        """
+        executor = self._obtener_executor()
+        futuros = {nombre: executor.submit(self._en_contexto, funcion) for nombre, funcion in pasos.items()}
+
+        resultados, error = {}, None
+        for nombre, futuro in futuros.items():
+            try:
+                resultados[nombre] = futuro.result()
+            except Exception as e:
+                logger.error(f"Error en el paso {nombre}: {str(e)}")
+                error = error or e
+        if error:
+            raise error
+        return resultados
+
+    def cerrar(self):
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
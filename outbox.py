@@ -0,0 +1,199 @@
+# outbox.py
+
+import os
+import json
+import time
+import logging
+import threading
+import traceback
+
+from db import conectar
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Notificaciones no críticas a webhooks (por ejemplo REGISTRO_PESO) que
+    se envían en segundo plano. Cada notificación se guarda primero en
+    SQLite y un hilo por proceso la envía, reintentando con espera
+    exponencial hasta max_intentos; así sobrevive a fallos del webhook y a
+    reinicios del servidor. Un proceso reserva las notificaciones vencidas
+    antes de enviarlas para que otro no las envíe al mismo tiempo. La
+    entrega es al menos una vez. La tabla puede vivir en la base de otro
+    almacén para encolar en sus transacciones
+    """
+
+    def __init__(self, ruta_db, webhook_client, intervalo=5, max_intentos=10, backoff=30, backoff_max=3600,
+                 lote=20, reserva=120, retencion=7 * 24 * 3600):
+        self.ruta_db = ruta_db
+        self.webhook_client = webhook_client
+        self.intervalo = intervalo
+        self.max_intentos = max_intentos
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.lote = lote
+        # Segundos que una notificación queda reservada por el proceso que la envía
+        self.reserva = reserva
+        self.retencion = retencion
+
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._pid = None
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conexion = conectar(self.ruta_db)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                endpoint TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                proximo_intento REAL NOT NULL,
+                ultimo_error TEXT NOT NULL DEFAULT '',
+                creado REAL NOT NULL,
+                enviado REAL
+            )
+        """)
+        conexion.execute(
+            "CREATE INDEX IF NOT EXISTS idx_outbox_pendientes ON outbox (estado, proximo_intento)"
+        )
+
+    def iniciar(self):
+        """
+        Inicia el hilo de envío de forma perezosa (y de nuevo tras un fork)
+        """
+        if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+                return
+            self._pid = os.getpid()
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._enviador, name='outbox', daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._despertar.set()
+
+    def encolar(self, endpoint, payload, conexion=None):
+        """
+        Guarda la notificación para enviarla en segundo plano y retorna su id.
+        Con conexion (a la misma base) se guarda dentro de la transacción en
+        curso, de modo que solo se envía si esa transacción se confirma
+        """
+        ahora = time.time()
+        id_notificacion = (conexion or conectar(self.ruta_db)).execute(
+            "INSERT INTO outbox (endpoint, payload, proximo_intento, creado) VALUES (?, ?, ?, ?)",
+            (endpoint, json.dumps(payload, ensure_ascii=False), ahora, ahora)
+        ).lastrowid
+        self.iniciar()
+        self._despertar.set()
+        return id_notificacion
+
+    def _enviador(self):
+        while not self._detener.is_set():
+            try:
+                # Mientras haya lotes completos se sigue enviando sin esperar
+                while self.procesar() == self.lote and not self._detener.is_set():
+                    pass
+                self._limpiar()
+            except Exception as e:
+                logger.error(f"Error enviando notificaciones pendientes: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+
+    def _reservar(self):
+        """
+        Toma las notificaciones vencidas y posterga su próximo intento
+        mientras se envían, para que ningún otro proceso las tome
+        """
+        conexion = conectar(self.ruta_db)
+        ahora = time.time()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            filas = conexion.execute(
+                """
+                SELECT id, endpoint, payload, intentos FROM outbox
+                WHERE estado = 'pendiente' AND proximo_intento <= ?
+                ORDER BY proximo_intento LIMIT ?
+                """,
+                (ahora, self.lote)
+            ).fetchall()
+            conexion.executemany(
+                "UPDATE outbox SET proximo_intento = ? WHERE id = ?",
+                [(ahora + self.reserva, fila['id']) for fila in filas]
+            )
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+        return filas
+
+    def procesar(self):
+        """
+        Envía las notificaciones vencidas. Retorna cuántas se intentaron
+        """
+        filas = self._reservar()
+        conexion = conectar(self.ruta_db)
+        for fila in filas:
+            error = ''
+            try:
+                response = self.webhook_client.post(fila['endpoint'], json=json.loads(fila['payload']))
+                if response.status_code != 200:
+                    error = f"HTTP {response.status_code}: {response.text[:200]}"
+            except Exception as e:
+                error = str(e)
+
+            ahora = time.time()
+            if not error:
+                conexion.execute(
+                    "UPDATE outbox SET estado = 'enviado', intentos = intentos + 1, enviado = ?, "
+                    "ultimo_error = '' WHERE id = ?",
+                    (ahora, fila['id'])
+                )
+                continue
+
+            intentos = fila['intentos'] + 1
+            estado = 'fallido' if intentos >= self.max_intentos else 'pendiente'
+            espera = min(self.backoff_max, self.backoff * (2 ** (intentos - 1)))
+            conexion.execute(
+                "UPDATE outbox SET estado = ?, intentos = ?, proximo_intento = ?, ultimo_error = ? WHERE id = ?",
+                (estado, intentos, ahora + espera, error, fila['id'])
+            )
+            if estado == 'fallido':
+                logger.error(f"Notificación {fila['id']} a {fila['endpoint']} descartada tras {intentos} intentos: {error}")
+            else:
+                logger.warning(f"Notificación {fila['id']} a {fila['endpoint']} falló ({error}), reintento en {espera}s")
+        return len(filas)
+
+    def _limpiar(self):
+        conectar(self.ruta_db).execute(
+            "DELETE FROM outbox WHERE estado = 'enviado' AND enviado < ?",
+            (time.time() - self.retencion,)
+        )
+
+    def metrics(self):
+        """
+        Notificaciones por endpoint y estado, y la más antigua pendiente
+        """
+        conexion = conectar(self.ruta_db)
+        filas = conexion.execute(
+            "SELECT endpoint, estado, COUNT(*) AS total FROM outbox GROUP BY endpoint, estado"
+        ).fetchall()
+        resumen = {}
+        for fila in filas:
+            resumen.setdefault(fila['endpoint'], {})[fila['estado']] = fila['total']
+        pendiente = conexion.execute(
+            "SELECT MIN(creado) FROM outbox WHERE estado = 'pendiente'"
+        ).fetchone()[0]
+        return {
+            'endpoints': resumen,
+            'pendiente_mas_antigua': round(time.time() - pendiente, 1) if pendiente else None
+        }
@@ -1,67 +1,195 @@
 # parser.py
 
-# parser.py
-
 import re
 import logging
+import unicodedata
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# En parser.py
+# Gramática de la respuesta del webhook OCR: una tabla markdown
+# Campo | Original | Sugerido seguida de una nota de validación
+RE_FILA_SEPARADORA = re.compile(r'^\|?\s*:?-{3,}:?\s*(?:\|\s*:?-{3,}:?\s*)*\|?$')
+RE_SEPARADOR_CELDA = re.compile(r'(?<!\\)\|')
+RE_PIPE_ESCAPADO = re.compile(r'\\\|')
+RE_NOTA = re.compile(
+    r'^\s*(?:\*\*|__)?\s*notas?(?:\s+de\s+validaci[oó]n)?\s*(?::\s*(?:\*\*|__)?|(?:\*\*|__)\s*:)\s*',
+    re.IGNORECASE
+)
+
+# Nombres aceptados para cada columna del encabezado (normalizados)
+ENCABEZADOS = {
+    'campo': ('campo', 'campos', 'field', 'dato', 'concepto'),
+    'original': ('original', 'valor original', 'valor leido', 'valor detectado', 'detectado', 'valor'),
+    'sugerido': ('sugerido', 'valor sugerido', 'sugerencia', 'valor corregido', 'corregido', 'correccion'),
+}
+
+
+def normalizar_nombre(texto):
+    """
+    Minúsculas, sin tildes, sin marcas de negrilla y con espacios simples,
+    para comparar encabezados y nombres de campo
+    """
+    texto = unicodedata.normalize('NFKD', texto.replace('*', '').strip().lower())
+    return ' '.join(''.join(c for c in texto if not unicodedata.combining(c)).split())
+
+
+_COLUMNAS = {
+    alias: columna
+    for columna, aliases in ENCABEZADOS.items()
+    for alias in aliases
+}
+
+
+class FilaTabla:
+    """
+    Fila de la tabla de la respuesta OCR
+    """
+
+    __slots__ = ('campo', 'original', 'sugerido')
+
+    def __init__(self, campo, original, sugerido):
+        self.campo = campo
+        self.original = original
+        self.sugerido = sugerido
+
+    def to_dict(self):
+        return {'campo': self.campo, 'original': self.original, 'sugerido': self.sugerido}
+
+    def __repr__(self):
+        return f"FilaTabla({self.campo!r}, {self.original!r}, {self.sugerido!r})"
+
+
+class RespuestaOCR:
+    """
+    Resultado del parseo de una respuesta OCR: filas de la tabla en orden,
+    nota de validación e índice de filas por nombre de campo normalizado
+    """
+
+    __slots__ = ('filas', 'nota', 'encabezado', '_indice')
+
+    def __init__(self, filas=None, nota='', encabezado=None):
+        self.filas = filas or []
+        self.nota = nota
+        self.encabezado = encabezado
+        self._indice = {normalizar_nombre(fila.campo): fila for fila in self.filas}
+
+    def __len__(self):
+        return len(self.filas)
+
+    def __iter__(self):
+        return iter(self.filas)
+
+    def fila(self, campo):
+        """
+        Fila del campo dado (sin distinguir mayúsculas ni tildes) o None
+        """
+        return self._indice.get(normalizar_nombre(campo))
+
+    def sugerido(self, campo, default=''):
+        fila = self.fila(campo)
+        return fila.sugerido if fila else default
+
+    def original(self, campo, default=''):
+        fila = self.fila(campo)
+        return fila.original if fila else default
+
+    def to_dict(self):
+        """
+        Estructura que usan la sesión, el almacén de guías y la caché OCR
+        """
+        return {
+            'table_data': [fila.to_dict() for fila in self.filas],
+            'nota': self.nota
+        }
+
+
+def _celdas(linea):
+    """
+    Divide una fila de la tabla respetando los pipes escapados (\\|) y
+    conservando las celdas vacías intermedias
+    """
+    celdas = RE_SEPARADOR_CELDA.split(linea)
+    if celdas and not celdas[0].strip():
+        celdas = celdas[1:]
+    if celdas and not celdas[-1].strip():
+        celdas = celdas[:-1]
+    return [RE_PIPE_ESCAPADO.sub('|', celda).strip() for celda in celdas]
+
+
+def _posiciones(encabezado):
+    """
+    Posición de cada columna según el encabezado, o None si no es el
+    encabezado de la tabla de campos
+    """
+    posiciones = {}
+    for posicion, celda in enumerate(encabezado):
+        columna = _COLUMNAS.get(normalizar_nombre(celda))
+        if columna and columna not in posiciones:
+            posiciones[columna] = posicion
+    if posiciones.get('campo') != 0:
+        return None
+    posiciones.setdefault('original', 1)
+    posiciones.setdefault('sugerido', 2)
+    return posiciones
+
+
+def parsear_respuesta(response_text):
+    """
+    Parsea en una sola pasada la respuesta markdown del webhook OCR y
+    retorna un RespuestaOCR. Las líneas antes del encabezado se ignoran y
+    todo lo que sigue al marcador de la nota forma parte de la nota
+    """
+    filas = []
+    nota = []
+    encabezado = None
+    posiciones = None
+    en_nota = False
+
+    for linea in (response_text or '').splitlines():
+        if en_nota:
+            nota.append(linea)
+            continue
+
+        marcador = RE_NOTA.match(linea)
+        if marcador:
+            en_nota = True
+            nota.append(linea[marcador.end():])
+            continue
+
+        linea = linea.strip()
+        if '|' not in linea or RE_FILA_SEPARADORA.match(linea):
+            continue
+
+        celdas = _celdas(linea)
+        if posiciones is None:
+            posiciones = _posiciones(celdas)
+            if posiciones is not None:
+                encabezado = celdas
+            continue
+
+        if len(celdas) <= max(posiciones.values()) or not celdas[posiciones['campo']]:
+            continue
+        filas.append(FilaTabla(
+            celdas[posiciones['campo']],
+            celdas[posiciones['original']],
+            celdas[posiciones['sugerido']]
+        ))
+
+    return RespuestaOCR(filas, '\n'.join(nota).strip(), encabezado)
+
 
 def parse_markdown_response(response_text):
     """
     Parsea una respuesta en formato markdown que incluye una tabla y nota de validación.
+    Retorna {'table_data': [...], 'nota': ''}
     """
-    parsed_data = {
-        'table_data': [],
-        'nota': ''
-    }
-    
     try:
-        # Separar la tabla de la nota
-        parts = response_text.split('**Nota de Validación:**')
-        table_text = parts[0].strip()
-        
-        # Procesar tabla
-        rows = table_text.split('\n')
-        header_found = False
-        
-        for row in rows:
-            row = row.strip()
-            if not row or '---' in row:
-                continue
-                
-            if '|' not in row:
-                continue
-                
-            # Procesar fila de la tabla
-            columns = [col.strip() for col in row.split('|') if col.strip()]
-            
-            if not header_found:
-                if 'Campo' in columns[0]:
-                    header_found = True
-                continue
-            
-            if len(columns) >= 3:
-                # Asegurarnos de que los datos se guarden correctamente
-                entry = {
-                    'campo': columns[0].strip(),
-                    'original': columns[1].strip(),
-                    'sugerido': columns[2].strip()
-                }
-                logger.debug(f"Agregando entrada a table_data: {entry}")
-                parsed_data['table_data'].append(entry)
-        
-        # Extraer nota de validación
-        if len(parts) > 1:
-            parsed_data['nota'] = parts[1].strip()
-        
-        logger.debug(f"Datos parseados completos: {parsed_data}")
-        
+        resultado = parsear_respuesta(response_text)
     except Exception as e:
         logger.error(f"Error parseando respuesta: {str(e)}")
         logger.error(f"Texto recibido: {response_text}")
-        
-    return parsed_data
\ No newline at end of file
+        return {'table_data': [], 'nota': ''}
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Respuesta parseada: {len(resultado)} filas, nota de {len(resultado.nota)} caracteres")
+    return resultado.to_dict()
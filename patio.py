@@ -0,0 +1,187 @@
+# patio.py
+
+import os
+import time
+import logging
+import threading
+import traceback
+from collections import deque
+
+from guia_lifecycle import etapas_completadas
+
+logger = logging.getLogger(__name__)
+
+
+class ClientesAgotadosError(Exception):
+    """
+    Se lanza cuando el proceso ya atiende el máximo de pantallas del patio
+    """
+    pass
+
+
+class DifusorPatio:
+    """
+    Canal compartido de cambios de estado de las guías para el tablero del
+    patio. Un único hilo por proceso lee los eventos nuevos de guia_eventos
+    (así ve también los cambios hechos en otros procesos) y los guarda en un
+    buffer circular; cada cliente SSE solo espera sobre ese buffer, de modo
+    que agregar pantallas no agrega consultas a la base de datos.
+
+    Cada cliente conectado ocupa un hilo del servidor mientras dure la
+    conexión, por eso se limitan a max_clientes por proceso
+    """
+
+    def __init__(self, store, capacidad=200, intervalo=1.0, max_clientes=4):
+        self.store = store
+        self.capacidad = capacidad
+        self.intervalo = intervalo
+        self.max_clientes = max_clientes
+
+        self._buffer = deque(maxlen=capacidad)
+        self._ultimo_id = 0
+        # Id del último evento que salió del buffer circular
+        self._descartado = 0
+        self._condicion = threading.Condition()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        self._clientes = 0
+        self._estadisticas = {'lecturas': 0, 'eventos': 0, 'errores': 0, 'rechazados': 0}
+
+        # Los cambios hechos en este proceso se difunden sin esperar el intervalo
+        store.suscribir(lambda codigo_guia: self._despertar.set())
+
+    def iniciar(self):
+        """
+        Inicia el hilo lector de forma perezosa (y de nuevo tras un fork)
+        """
+        if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+                return
+            self._pid = os.getpid()
+            self._detener.clear()
+            with self._condicion:
+                self._buffer.clear()
+                ultimo = self.store.ultimo_evento()
+                self._ultimo_id = self._descartado = max(ultimo - self.capacidad, 0)
+            self._leer()
+            self._hilo = threading.Thread(target=self._lector, name='difusor-patio', daemon=True)
+            self._hilo.start()
+            logger.info(f"Difusor del patio iniciado (pid {self._pid})")
+
+    def detener(self):
+        self._detener.set()
+        self._despertar.set()
+        # Los clientes conectados terminan su conexión en lugar de esperar el timeout del apagado
+        with self._condicion:
+            self._condicion.notify_all()
+
+    def _lector(self):
+        while not self._detener.is_set():
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            try:
+                # Si hubo más eventos que la capacidad se sigue leyendo sin esperar
+                while self._leer() == self.capacidad:
+                    pass
+            except Exception as e:
+                self._estadisticas['errores'] += 1
+                logger.error(f"Error leyendo eventos de guías: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def _leer(self):
+        eventos = self.store.eventos_desde(self._ultimo_id, limite=self.capacidad)
+        self._estadisticas['lecturas'] += 1
+        if not eventos:
+            return 0
+        with self._condicion:
+            for evento in eventos:
+                evento['etapas_completadas'] = etapas_completadas(evento['estado'])
+                if len(self._buffer) == self.capacidad:
+                    self._descartado = self._buffer[0]['id']
+                self._buffer.append(evento)
+            self._ultimo_id = eventos[-1]['id']
+            self._estadisticas['eventos'] += len(eventos)
+            self._condicion.notify_all()
+        return len(eventos)
+
+    def ultimo_id(self):
+        with self._condicion:
+            return self._ultimo_id
+
+    def conectar(self):
+        """
+        Reserva el lugar de un cliente. Lanza ClientesAgotadosError si el
+        proceso ya atiende max_clientes; el lugar se libera con desconectar()
+        """
+        self.iniciar()
+        with self._condicion:
+            if self._clientes >= self.max_clientes:
+                self._estadisticas['rechazados'] += 1
+                raise ClientesAgotadosError(
+                    "El tablero del patio alcanzó el máximo de pantallas conectadas, intente más tarde"
+                )
+            self._clientes += 1
+
+    def desconectar(self):
+        with self._condicion:
+            self._clientes -= 1
+
+    def eventos(self, desde=None, espera=15.0):
+        """
+        Genera los eventos del buffer posteriores a 'desde' (por defecto solo
+        los nuevos) y luego los que lleguen. Sin eventos durante 'espera'
+        segundos genera None para mantener viva la conexión. Si el cliente se
+        atrasó más que el buffer genera un evento 'resincronizar' para que
+        vuelva a pedir el estado completo. Termina al detener el difusor
+        """
+        self.iniciar()
+        with self._condicion:
+            if desde is None:
+                desde = self._ultimo_id
+        while not self._detener.is_set():
+            with self._condicion:
+                if desde < self._descartado:
+                    desde = self._ultimo_id
+                    pendientes = [{'id': desde, 'tipo': 'resincronizar'}]
+                else:
+                    pendientes = [evento for evento in self._buffer if evento['id'] > desde]
+                if not pendientes:
+                    self._condicion.wait(espera)
+                    if self._detener.is_set():
+                        return
+                    pendientes = [evento for evento in self._buffer if evento['id'] > desde]
+            if not pendientes:
+                yield None
+                continue
+            for evento in pendientes:
+                desde = evento['id']
+                yield evento
+
+    def estado(self, horas=24):
+        """
+        Guías en el patio (registradas y sin salida) con sus etapas, y el id
+        del último evento incluido, para que el tablero continúe desde ahí
+        """
+        self.iniciar()
+        ultimo = self.ultimo_id()
+        guias = self.store.activas(time.time() - horas * 3600)
+        for guia in guias:
+            guia['etapas_completadas'] = etapas_completadas(guia['estado'])
+        return {'ultimo_evento': ultimo, 'guias': guias}
+
+    def metrics(self):
+        with self._condicion:
+            return dict(
+                self._estadisticas,
+                clientes=self._clientes,
+                max_clientes=self.max_clientes,
+                buffer=len(self._buffer),
+                capacidad=self.capacidad,
+                ultimo_evento=self._ultimo_id,
+                pid=self._pid
+            )
@@ -0,0 +1,425 @@
+# pdf_renderer.py
+
+import os
+import time
+import logging
+import threading
+import mimetypes
+import multiprocessing
+from urllib.parse import urlparse, unquote
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+# Cachés por proceso de renderizado
+_static_folder = None
+_font_config = None
+_hojas_estilo = {}
+_recursos = {}
+_cache_imagenes = {}
+
+# Carpeta de recursos compartidos entre renders (sello, logo)
+CARPETA_COMPARTIDA = 'images'
+
+HTML_PRECALENTAMIENTO = """
+<html><body><p>Precalentamiento</p><img src="images/sello.png"></body></html>
+"""
+
+
+def inicializar(static_folder):
+    """
+    Inicializa las cachés del proceso: configuración de fuentes compartida
+    """
+    global _static_folder, _font_config
+    from weasyprint.text.fonts import FontConfiguration
+
+    _static_folder = static_folder
+    if _font_config is None:
+        _font_config = FontConfiguration()
+
+
+def _hoja_estilo(nombre):
+    """
+    Retorna la hoja de estilo compilada, recompilándola si el archivo cambió
+    """
+    from weasyprint import CSS
+
+    ruta = os.path.join(_static_folder, 'css', nombre)
+    mtime = os.path.getmtime(ruta)
+    cacheada = _hojas_estilo.get(ruta)
+    if cacheada is None or cacheada[0] != mtime:
+        cacheada = _hojas_estilo[ruta] = (mtime, CSS(filename=ruta, font_config=_font_config))
+    return cacheada[1]
+
+
+def _ruta_local(url):
+    """
+    Traduce una URL de un recurso de static a su ruta en disco
+    """
+    ruta = None
+    if url.startswith('file://'):
+        ruta = unquote(urlparse(url).path)
+    elif url.startswith(('http://', 'https://')):
+        path = unquote(urlparse(url).path)
+        if path.startswith('/static/'):
+            ruta = os.path.join(_static_folder, path[len('/static/'):])
+    if ruta and _static_folder and os.path.realpath(ruta).startswith(os.path.realpath(_static_folder)):
+        return ruta
+    return None
+
+
+def _es_compartido(ruta):
+    return os.path.realpath(ruta).startswith(
+        os.path.realpath(os.path.join(_static_folder, CARPETA_COMPARTIDA)) + os.sep
+    )
+
+
+def url_fetcher(url, timeout=10, ssl_context=None):
+    """
+    Lee los recursos de static desde disco en lugar de pedirlos al propio
+    servidor, y mantiene en memoria los compartidos invalidándolos por mtime
+    """
+    from weasyprint import default_url_fetcher
+
+    ruta = _ruta_local(url)
+    if not ruta or not os.path.isfile(ruta):
+        return default_url_fetcher(url, timeout=timeout, ssl_context=ssl_context)
+
+    mtime = os.path.getmtime(ruta)
+    cacheado = _recursos.get(ruta)
+    if cacheado is None or cacheado[0] != mtime:
+        with open(ruta, 'rb') as f:
+            contenido = f.read()
+        cacheado = (mtime, contenido, mimetypes.guess_type(ruta)[0])
+        if _es_compartido(ruta):
+            _recursos[ruta] = cacheado
+
+    return {'string': cacheado[1], 'mime_type': cacheado[2], 'redirected_url': url}
+
+
+def _depurar_cache_imagenes():
+    """
+    Conserva decodificadas solo las imágenes compartidas cuyo archivo no ha
+    cambiado. WeasyPrint guarda junto a cada imagen (clave URL) sus datos en
+    bytes bajo claves que empiezan por el id de la imagen; la imagen los
+    lee de forma perezosa, así que se conservan o descartan juntos
+    """
+    ids_conservados = set()
+    for clave, valor in list(_cache_imagenes.items()):
+        if isinstance(valor, (bytes, bytearray)):
+            continue
+        ruta = _ruta_local(clave)
+        if (not ruta or not _es_compartido(ruta) or not os.path.exists(ruta)
+                or _recursos.get(ruta, (None,))[0] != os.path.getmtime(ruta)
+                or getattr(valor, 'id', None) is None):
+            _cache_imagenes.pop(clave, None)
+        else:
+            ids_conservados.add(valor.id)
+
+    for clave, valor in list(_cache_imagenes.items()):
+        if isinstance(valor, (bytes, bytearray)) and not clave.startswith(tuple(ids_conservados)):
+            _cache_imagenes.pop(clave, None)
+
+
+def render_pdf(html, pdf_path, base_url, stylesheet=None):
+    """
+    Renderiza el HTML a PDF usando las cachés del proceso. Escribe en un
+    archivo temporal y lo renombra, de modo que la existencia del PDF implica
+    que está completo
+    """
+    from weasyprint import HTML
+
+    if _font_config is None or _static_folder != base_url:
+        inicializar(base_url)
+
+    inicio = time.perf_counter()
+    _depurar_cache_imagenes()
+    temp_path = f"{pdf_path}.{os.getpid()}.tmp"
+    HTML(string=html, base_url=base_url, url_fetcher=url_fetcher).write_pdf(
+        temp_path,
+        stylesheets=[_hoja_estilo(stylesheet)] if stylesheet else None,
+        font_config=_font_config,
+        cache=_cache_imagenes
+    )
+    os.replace(temp_path, pdf_path)
+    return time.perf_counter() - inicio
+
+
+def precalentar(stylesheets=()):
+    """
+    Render de prueba en memoria para cargar fuentes, hojas de estilo e
+    imágenes compartidas antes del primer tiquete del día
+    """
+    from weasyprint import HTML
+
+    inicio = time.perf_counter()
+    HTML(string=HTML_PRECALENTAMIENTO, base_url=_static_folder, url_fetcher=url_fetcher).write_pdf(
+        stylesheets=[_hoja_estilo(nombre) for nombre in stylesheets],
+        font_config=_font_config,
+        cache=_cache_imagenes
+    )
+    return time.perf_counter() - inicio
+
+
+class PDFRenderService:
+    """
+    Servicio de renderizado de PDFs en un pool de procesos. Las plantillas se
+    renderizan en la petición y WeasyPrint corre fuera del GIL del servidor
+    """
+
+    # Hojas de estilo compartidas, en static/css
+    STYLESHEETS = ('pdf_tiquete.css', 'pdf_pesaje.css')
+
+    def __init__(self, app, max_workers=2, timeout=60):
+        self.app = app
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._precalentado_pid = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._trabajos = {}
+        self._contadores = {'enviados': 0, 'completados': 0, 'fallidos': 0}
+        self._duraciones = []
+
+        app.extensions['pdf_renderer'] = self
+
+    def _obtener_executor(self):
+        # El pool se crea de forma perezosa y de nuevo tras un fork del servidor
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=inicializar,
+                    initargs=(self.app.static_folder,)
+                )
+                self._pid = os.getpid()
+                self._trabajos = {}
+                logger.info(f"Pool de PDFs iniciado con {self.max_workers} procesos")
+            return self._executor
+
+    def _ruta(self, pdf_filename):
+        return os.path.join(self.app.config['PDF_FOLDER'], pdf_filename)
+
+    # Marcador del trabajo en PDF_FOLDER, para que otros procesos del servidor
+    # sepan si el PDF está pendiente o falló aunque ya exista uno con ese nombre.
+    # Los abandonados los borra la retención de temporales (*.tmp)
+
+    def _marcador(self, pdf_filename):
+        return self._ruta(f"{pdf_filename}.pendiente.tmp")
+
+    def _marcar(self, pdf_filename, estado='pendiente'):
+        with open(self._marcador(pdf_filename), 'w') as f:
+            f.write(estado)
+
+    def _desmarcar(self, pdf_filename):
+        if os.path.exists(self._marcador(pdf_filename)):
+            os.remove(self._marcador(pdf_filename))
+
+    def _estado_marcador(self, pdf_filename):
+        try:
+            with open(self._marcador(pdf_filename)) as f:
+                return f.read().strip() or 'pendiente'
+        except FileNotFoundError:
+            return None
+
+    def warmup(self):
+        """
+        Precalienta cada proceso del pool sin bloquear (una vez por proceso del servidor)
+        """
+        if self._precalentado_pid == os.getpid():
+            return
+        self._precalentado_pid = os.getpid()
+        executor = self._obtener_executor()
+        for _ in range(self.max_workers):
+            future = executor.submit(precalentar, self.STYLESHEETS)
+            future.add_done_callback(
+                lambda f: logger.info(f"Proceso de PDFs precalentado en {f.result():.2f}s")
+                if not f.exception() else logger.error(f"Error precalentando PDFs: {f.exception()}")
+            )
+
+    def submit(self, html, pdf_filename, stylesheet=None):
+        """
+        Encola el renderizado y retorna el nombre del PDF como identificador del trabajo
+        """
+        pdf_path = self._ruta(pdf_filename)
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+        self._marcar(pdf_filename)
+
+        try:
+            future = self._obtener_executor().submit(
+                render_pdf, html, pdf_path, self.app.static_folder, stylesheet
+            )
+        except Exception:
+            self._desmarcar(pdf_filename)
+            raise
+        with self._lock:
+            # Olvidar trabajos terminados para que el registro no crezca sin límite
+            if len(self._trabajos) > 500:
+                self._trabajos = {k: f for k, f in self._trabajos.items() if not f.done()}
+            self._trabajos[pdf_filename] = future
+            self._contadores['enviados'] += 1
+        future.add_done_callback(lambda f: self._finalizar(pdf_filename, f))
+
+        logger.info(f"Renderizado de PDF encolado: {pdf_filename}")
+        return pdf_filename
+
+    def _finalizar(self, pdf_filename, future):
+        with self._lock:
+            if future.exception():
+                self._contadores['fallidos'] += 1
+                logger.error(f"Error renderizando PDF {pdf_filename}: {future.exception()}")
+            else:
+                self._contadores['completados'] += 1
+                self._duraciones = (self._duraciones + [future.result()])[-200:]
+                logger.info(f"PDF generado exitosamente: {pdf_filename}")
+        self._cerrar_marcador(pdf_filename, future)
+
+    def _cerrar_marcador(self, pdf_filename, future):
+        try:
+            if future.exception():
+                self._marcar(pdf_filename, 'error')
+            else:
+                self._desmarcar(pdf_filename)
+        except OSError as e:
+            logger.error(f"Error actualizando el marcador del PDF {pdf_filename}: {str(e)}")
+
+    def estado(self, pdf_filename):
+        """
+        Estado del renderizado: pendiente, completado, error o desconocido
+        """
+        with self._lock:
+            future = self._trabajos.get(pdf_filename)
+        if future is not None:
+            if not future.done():
+                return 'pendiente'
+            return 'error' if future.exception() else 'completado'
+        marcador = self._estado_marcador(pdf_filename)
+        if marcador:
+            return marcador
+        return 'completado' if os.path.exists(self._ruta(pdf_filename)) else 'desconocido'
+
+    def wait(self, pdf_filename, timeout=None):
+        """
+        Espera a que el PDF esté disponible. Si el trabajo se envió desde otro
+        proceso se espera a que su marcador desaparezca de PDF_FOLDER, no a
+        que exista el archivo, que puede ser el de un tiquete anterior
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        with self._lock:
+            future = self._trabajos.get(pdf_filename)
+
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+                return True
+            except FutureTimeoutError:
+                logger.warning(f"Tiempo de espera agotado para el PDF {pdf_filename}")
+                return False
+            except Exception as e:
+                logger.error(f"El renderizado del PDF {pdf_filename} falló: {str(e)}")
+                return False
+
+        limite = time.time() + timeout
+        while True:
+            marcador = self._estado_marcador(pdf_filename)
+            if marcador is None:
+                return os.path.exists(self._ruta(pdf_filename))
+            if marcador == 'error':
+                logger.error(f"El renderizado del PDF {pdf_filename} falló en otro proceso")
+                return False
+            if time.time() >= limite:
+                logger.warning(f"Tiempo de espera agotado para el PDF {pdf_filename}")
+                return False
+            time.sleep(0.1)
+
+    def _al_terminar(self, pdf_filename, accion):
+        """
+        Ejecuta accion() cuando termine el trabajo de pdf_filename (o ya, si
+        no hay trabajo en este proceso) y retorna un futuro con el resultado
+        """
+        with self._lock:
+            future = self._trabajos.get(pdf_filename)
+        siguiente = Future()
+
+        def continuar(f=None):
+            try:
+                duracion = f.result() if f is not None else None
+                accion()
+                siguiente.set_result(duracion)
+            except Exception as e:
+                siguiente.set_exception(e)
+
+        if future is None:
+            continuar()
+        else:
+            future.add_done_callback(continuar)
+        return siguiente
+
+    def promover(self, pdf_temporal, pdf_filename):
+        """
+        Da al PDF renderizado como pdf_temporal su nombre definitivo cuando
+        termine, reemplazando el anterior. Desde ahí el trabajo se consulta
+        por el nombre definitivo
+        """
+        self._marcar(pdf_filename)
+        future = self._al_terminar(
+            pdf_temporal,
+            lambda: os.replace(self._ruta(pdf_temporal), self._ruta(pdf_filename))
+        )
+        with self._lock:
+            self._trabajos.pop(pdf_temporal, None)
+            self._trabajos[pdf_filename] = future
+        future.add_done_callback(lambda f: self._cerrar_marcador(pdf_filename, f))
+        return pdf_filename
+
+    def descartar(self, pdf_temporal):
+        """
+        Borra el PDF renderizado como pdf_temporal (y su marcador) cuando
+        termine, haya fallado o no
+        """
+        def borrar(future=None):
+            for ruta in (self._ruta(pdf_temporal), self._marcador(pdf_temporal)):
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+
+        with self._lock:
+            future = self._trabajos.pop(pdf_temporal, None)
+        if future is None:
+            borrar()
+        else:
+            future.add_done_callback(borrar)
+
+    def render_sync(self, html, pdf_filename, stylesheet=None):
+        """
+        Renderiza y espera el resultado
+        """
+        self.submit(html, pdf_filename, stylesheet)
+        if not self.wait(pdf_filename):
+            raise Exception(f"No se pudo generar el PDF {pdf_filename}")
+        return pdf_filename
+
+    def cerrar(self, wait=True):
+        """
+        Termina el pool de este proceso esperando los PDFs en curso, para
+        un apagado ordenado del servidor
+        """
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+            logger.info("Pool de PDFs cerrado")
+
+    def metrics(self):
+        with self._lock:
+            pendientes = len([f for f in self._trabajos.values() if not f.done()])
+            duraciones = list(self._duraciones)
+            return {
+                'max_workers': self.max_workers,
+                'pendientes': pendientes,
+                'contadores': dict(self._contadores),
+                'duracion_promedio': round(sum(duraciones) / len(duraciones), 3) if duraciones else None
+            }
@@ -0,0 +1,131 @@
+# qr_service.py
+
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+import qrcode
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def clave_payload(payload):
+    """
+    Hash del contenido del QR, usado como clave de caché y ETag
+    """
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def matriz_qr(payload, border=4):
+    """
+    Módulos del QR (True = oscuro), incluido el borde
+    """
+    qr = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        border=border,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def matriz_a_svg(matriz, tamano=150, css_class='qr-code'):
+    """
+    SVG vectorial del QR: un único path con un rectángulo por cada tramo
+    horizontal de módulos oscuros
+    """
+    lado = len(matriz)
+    trazos = []
+    for y, fila in enumerate(matriz):
+        x = 0
+        while x < lado:
+            if fila[x]:
+                inicio = x
+                while x < lado and fila[x]:
+                    x += 1
+                trazos.append(f"M{inicio} {y}h{x - inicio}v1h-{x - inicio}z")
+            else:
+                x += 1
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" class="{css_class}" width="{tamano}" height="{tamano}" '
+        f'viewBox="0 0 {lado} {lado}" shape-rendering="crispEdges">'
+        f'<rect width="{lado}" height="{lado}" fill="#fff"/>'
+        f'<path d="{"".join(trazos)}" fill="#000"/></svg>'
+    )
+
+
+def matriz_a_png(matriz, box_size=10):
+    """
+    PNG del QR: se rasteriza a un píxel por módulo y se escala sin suavizado
+    """
+    lado = len(matriz)
+    img = Image.new('1', (lado, lado))
+    img.putdata([0 if modulo else 1 for fila in matriz for modulo in fila])
+    img = img.resize((lado * box_size, lado * box_size), Image.NEAREST)
+    buffer = BytesIO()
+    img.save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+
+class QRService:
+    """
+    Genera los códigos QR de seguimiento en memoria, como SVG para incrustar
+    en las plantillas o como bytes PNG para servir por HTTP. Los resultados
+    se guardan en una caché LRU por hash del contenido, así que un mismo QR
+    se calcula una sola vez por proceso y nunca se escribe a disco
+    """
+
+    def __init__(self, max_entradas=256, box_size=10, border=4):
+        self.max_entradas = max_entradas
+        self.box_size = box_size
+        self.border = border
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._estadisticas = {'aciertos': 0, 'fallos': 0, 'desalojados': 0}
+
+    def _obtener(self, formato, payload, generar):
+        clave = (formato, clave_payload(payload))
+        with self._lock:
+            if clave in self._cache:
+                self._cache.move_to_end(clave)
+                self._estadisticas['aciertos'] += 1
+                return self._cache[clave]
+            self._estadisticas['fallos'] += 1
+
+        valor = generar(matriz_qr(payload, self.border))
+
+        with self._lock:
+            self._cache[clave] = valor
+            self._cache.move_to_end(clave)
+            while len(self._cache) > self.max_entradas:
+                self._cache.popitem(last=False)
+                self._estadisticas['desalojados'] += 1
+        return valor
+
+    def svg(self, payload, tamano=150):
+        """
+        Marcado SVG del QR, para incrustar en el HTML
+        """
+        return self._obtener(
+            f'svg-{tamano}',
+            payload,
+            lambda matriz: matriz_a_svg(matriz, tamano)
+        )
+
+    def png(self, payload):
+        """
+        Bytes PNG del QR
+        """
+        return self._obtener(
+            'png',
+            payload,
+            lambda matriz: matriz_a_png(matriz, self.box_size)
+        )
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._estadisticas, entradas=len(self._cache), max_entradas=self.max_entradas)
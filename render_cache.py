@@ -0,0 +1,82 @@
+# render_cache.py
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class RenderCache:
+    """
+    Caché LRU en memoria de HTML renderizado, con vida corta. Cada entrada
+    guarda la versión de los datos con que se renderizó (por ejemplo la
+    fecha de actualización de la guía); si la versión cambió la entrada
+    se descarta, de modo que un cambio de estado hecho en cualquier proceso
+    invalida la página sin esperar el TTL
+    """
+
+    def __init__(self, ttl=30, max_entradas=500):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self._estadisticas = {'aciertos': 0, 'fallos': 0, 'invalidados': 0, 'desalojados': 0}
+
+    def get(self, clave, version):
+        """
+        Retorna el valor guardado para la clave si sigue vigente y es de la
+        misma versión, o None
+        """
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self._estadisticas['fallos'] += 1
+                return None
+
+            guardado, version_guardada, valor = entrada
+            if version_guardada != version or time.monotonic() - guardado > self.ttl:
+                del self._entradas[clave]
+                self._estadisticas['invalidados'] += 1
+                self._estadisticas['fallos'] += 1
+                return None
+
+            self._entradas.move_to_end(clave)
+            self._estadisticas['aciertos'] += 1
+            return valor
+
+    def set(self, clave, version, valor):
+        with self._lock:
+            self._entradas[clave] = (time.monotonic(), version, valor)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+                self._estadisticas['desalojados'] += 1
+        return valor
+
+    def obtener_o_renderizar(self, clave, version, renderizar):
+        """
+        Retorna el valor en caché o lo genera con renderizar() y lo guarda
+        """
+        valor = self.get(clave, version)
+        if valor is None:
+            valor = self.set(clave, version, renderizar())
+        return valor
+
+    def invalidar(self, clave=None):
+        """
+        Descarta la entrada de la clave, o todas
+        """
+        with self._lock:
+            if clave is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(clave, None)
+
+    def metrics(self):
+        with self._lock:
+            return dict(
+                self._estadisticas,
+                entradas=len(self._entradas),
+                max_entradas=self.max_entradas,
+                ttl=self.ttl
+            )
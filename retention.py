@@ -0,0 +1,282 @@
+# retention.py
+
+import os
+import json
+import time
+import fnmatch
+import logging
+import zipfile
+import threading
+import traceback
+from datetime import datetime
+
+from db import conectar
+
+logger = logging.getLogger(__name__)
+
+DIA = 24 * 3600
+
+
+class Politica:
+    """
+    Política de retención de un tipo de artefacto generado. Un archivo es
+    eliminable si no lo protege una guía reciente y además:
+    - es huérfano (ninguna guía lo referencia) y supera el periodo de gracia,
+    - supera la edad máxima, o
+    - queda fuera de los max_cantidad archivos más recientes del tipo
+    Los archivos para los que conservar(nombre) retorna True nunca se eliminan
+    """
+
+    def __init__(self, tipo, carpeta, patrones, max_edad=None, max_cantidad=None, gracia=None,
+                 archivar=False, conservar=None):
+        self.tipo = tipo
+        self.carpeta = carpeta
+        self.patrones = patrones
+        self.max_edad = max_edad
+        self.max_cantidad = max_cantidad
+        self.gracia = gracia
+        self.archivar = archivar
+        self.conservar = conservar
+
+    def coincide(self, nombre):
+        return any(fnmatch.fnmatch(nombre, patron) for patron in self.patrones)
+
+
+class RetentionManager:
+    """
+    Limpieza y compactación periódica de artefactos generados (PDFs,
+    temporales de PDF, guías HTML y QR). Los archivos eliminables se borran
+    o se archivan en zips mensuales. Cada ejecución se registra en SQLite, lo
+    que además evita que varios procesos del servidor limpien a la vez
+    """
+
+    def __init__(self, ruta_db, politicas, referencias, carpeta_archivo, intervalo=6 * 3600):
+        """
+        referencias() retorna {tipo: {nombre: actualizado}} con los artefactos
+        referenciados por el estado de las guías y la última actualización de
+        la guía que los referencia
+        """
+        self.ruta_db = ruta_db
+        self.politicas = politicas
+        self.referencias = referencias
+        self.carpeta_archivo = carpeta_archivo
+        self.intervalo = intervalo
+
+        self._hilo = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conexion = conectar(self.ruta_db)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS retencion_ejecuciones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                inicio REAL NOT NULL,
+                fin REAL,
+                simulacion INTEGER NOT NULL DEFAULT 0,
+                resultado TEXT NOT NULL DEFAULT '{}'
+            )
+        """)
+
+    def iniciar(self):
+        """
+        Inicia el hilo programador de forma perezosa (y de nuevo tras un fork)
+        """
+        if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+                return
+            self._pid = os.getpid()
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._programador, name='retencion', daemon=True)
+            self._hilo.start()
+            logger.info(f"Retención de artefactos programada cada {self.intervalo}s (pid {self._pid})")
+
+    def detener(self):
+        self._detener.set()
+
+    def _programador(self):
+        while not self._detener.is_set():
+            try:
+                self.ejecutar(forzar=False)
+            except Exception as e:
+                logger.error(f"Error en la retención de artefactos: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._detener.wait(min(self.intervalo, 600))
+
+    def _reservar(self, forzar, simulacion):
+        """
+        Registra el inicio de una ejecución si no hubo otra dentro del
+        intervalo. Retorna el id de la ejecución o None
+        """
+        conexion = conectar(self.ruta_db)
+        conexion.execute("BEGIN IMMEDIATE")
+        ultima = conexion.execute(
+            "SELECT MAX(inicio) FROM retencion_ejecuciones WHERE simulacion = 0"
+        ).fetchone()[0]
+        ahora = time.time()
+        if not forzar and not simulacion and ultima and ahora - ultima < self.intervalo:
+            conexion.execute("ROLLBACK")
+            return None
+        cursor = conexion.execute(
+            "INSERT INTO retencion_ejecuciones (inicio, simulacion) VALUES (?, ?)",
+            (ahora, int(simulacion))
+        )
+        conexion.execute("COMMIT")
+        return cursor.lastrowid
+
+    def ejecutar(self, forzar=True, simulacion=False):
+        """
+        Aplica todas las políticas. Con simulacion solo reporta lo que se
+        eliminaría. Retorna el resultado por tipo o None si otra ejecución
+        reciente lo hizo
+        """
+        ejecucion = self._reservar(forzar, simulacion)
+        if ejecucion is None:
+            return None
+
+        inicio = time.time()
+        referencias = self.referencias()
+        resultado = {}
+        for politica in self.politicas:
+            try:
+                resultado[politica.tipo] = self._aplicar(
+                    politica, referencias.get(politica.tipo, {}), simulacion
+                )
+            except Exception as e:
+                logger.error(f"Error aplicando retención de {politica.tipo}: {str(e)}")
+                logger.error(traceback.format_exc())
+                resultado[politica.tipo] = {'error': str(e)}
+
+        conectar(self.ruta_db).execute(
+            "UPDATE retencion_ejecuciones SET fin = ?, resultado = ? WHERE id = ?",
+            (time.time(), json.dumps(resultado, ensure_ascii=False), ejecucion)
+        )
+        logger.info(f"Retención {'simulada' if simulacion else 'ejecutada'} en {time.time() - inicio:.2f}s: "
+                    + ', '.join(f"{tipo}={r.get('eliminados', 0)}" for tipo, r in resultado.items()))
+        return resultado
+
+    def _listar(self, politica):
+        archivos = []
+        with os.scandir(politica.carpeta) as entradas:
+            for entrada in entradas:
+                if entrada.is_file() and politica.coincide(entrada.name):
+                    estado = entrada.stat()
+                    archivos.append((entrada.name, estado.st_mtime, estado.st_size))
+        return archivos
+
+    def _aplicar(self, politica, referenciados, simulacion):
+        if not os.path.isdir(politica.carpeta):
+            return {'archivos': 0}
+
+        ahora = time.time()
+        inicio_listado = time.perf_counter()
+        archivos = self._listar(politica)
+        listado_ms = round((time.perf_counter() - inicio_listado) * 1000, 2)
+
+        # Los más recientes primero, para la política de cantidad
+        archivos.sort(key=lambda a: a[1], reverse=True)
+
+        eliminables = []
+        huerfanos = 0
+        conservados = 0
+        for posicion, (nombre, mtime, tamano) in enumerate(archivos):
+            if politica.conservar is not None and politica.conservar(nombre):
+                conservados += 1
+                continue
+
+            edad = ahora - mtime
+            actualizado = referenciados.get(nombre)
+            if actualizado is None:
+                huerfanos += 1
+
+            # Un artefacto de una guía con actividad reciente no se toca
+            if actualizado is not None and (politica.max_edad is None or ahora - actualizado < politica.max_edad):
+                continue
+
+            if (
+                (actualizado is None and politica.gracia is not None and edad > politica.gracia)
+                or (politica.max_edad is not None and edad > politica.max_edad)
+                or (politica.max_cantidad is not None and posicion >= politica.max_cantidad)
+            ):
+                eliminables.append((nombre, mtime, tamano))
+
+        archivados = 0
+        liberados = 0
+        if not simulacion:
+            if politica.archivar:
+                archivados = self._archivar(politica, eliminables)
+            for nombre, _, tamano in eliminables:
+                try:
+                    os.remove(os.path.join(politica.carpeta, nombre))
+                    liberados += tamano
+                except FileNotFoundError:
+                    pass
+
+        return {
+            'archivos': len(archivos),
+            'bytes': sum(a[2] for a in archivos),
+            'huerfanos': huerfanos,
+            'conservados': conservados,
+            'eliminados': len(eliminables),
+            'archivados': archivados,
+            'bytes_liberados': liberados if not simulacion else sum(a[2] for a in eliminables),
+            'listado_ms': listado_ms
+        }
+
+    def _archivar(self, politica, archivos):
+        """
+        Agrega los archivos a zips mensuales por tipo según su fecha de modificación
+        """
+        por_mes = {}
+        for nombre, mtime, _ in archivos:
+            por_mes.setdefault(datetime.fromtimestamp(mtime).strftime('%Y-%m'), []).append(nombre)
+
+        carpeta = os.path.join(self.carpeta_archivo, politica.tipo)
+        os.makedirs(carpeta, exist_ok=True)
+        archivados = 0
+        for mes, nombres in por_mes.items():
+            ruta_zip = os.path.join(carpeta, f"{politica.tipo}_{mes}.zip")
+            with zipfile.ZipFile(ruta_zip, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+                existentes = set(zf.namelist())
+                for nombre in nombres:
+                    if nombre not in existentes:
+                        zf.write(os.path.join(politica.carpeta, nombre), nombre)
+                        archivados += 1
+        return archivados
+
+    def metrics(self, limite=10):
+        """
+        Últimas ejecuciones y estado actual de cada carpeta
+        """
+        filas = conectar(self.ruta_db).execute(
+            "SELECT * FROM retencion_ejecuciones ORDER BY id DESC LIMIT ?", (limite,)
+        ).fetchall()
+        carpetas = {}
+        for politica in self.politicas:
+            if not os.path.isdir(politica.carpeta):
+                continue
+            inicio = time.perf_counter()
+            archivos = self._listar(politica)
+            carpetas[politica.tipo] = {
+                'archivos': len(archivos),
+                'bytes': sum(a[2] for a in archivos),
+                'listado_ms': round((time.perf_counter() - inicio) * 1000, 2)
+            }
+        return {
+            'intervalo': self.intervalo,
+            'programador_activo': bool(self._hilo and self._hilo.is_alive() and self._pid == os.getpid()),
+            'carpetas': carpetas,
+            'ejecuciones': [
+                {
+                    'inicio': fila['inicio'],
+                    'fin': fila['fin'],
+                    'simulacion': bool(fila['simulacion']),
+                    'resultado': json.loads(fila['resultado'])
+                }
+                for fila in filas
+            ]
+        }
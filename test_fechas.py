@@ -0,0 +1,79 @@
+import time
+from datetime import date, datetime
+
+from fechas import parsear_fecha, normalizar_fecha, estadisticas_cache
+
+# Variantes de fecha vistas en las respuestas del OCR
+VARIANTES = {
+    '14-01-2025': date(2025, 1, 14),
+    '14/01/2025': date(2025, 1, 14),
+    '14.01.2025': date(2025, 1, 14),
+    '2025-01-14': date(2025, 1, 14),
+    '2025/01/14': date(2025, 1, 14),
+    '4-1-2025': date(2025, 1, 4),
+    '14 - 01 - 2025': date(2025, 1, 14),
+    ' 14/01/25 ': date(2025, 1, 14),
+    '14 01 2025': date(2025, 1, 14),
+}
+
+NO_VALIDAS = ['No disponible', '', None, '31-02-2025', '14-13-2025', '14-01/2025', '2025-14', 'ayer']
+
+FORMATOS_ANTERIORES = ['%d-%m-%Y', '%Y-%m-%d', '%d/%m/%Y']
+
+
+def parsear_con_strptime(texto):
+    """
+    Parseo anterior, solo para comparar en el benchmark
+    """
+    for fmt in FORMATOS_ANTERIORES:
+        try:
+            return datetime.strptime(texto, fmt).date()
+        except (ValueError, TypeError):
+            continue
+    return None
+
+
+def test_variantes_ocr():
+    for texto, esperada in VARIANTES.items():
+        assert parsear_fecha(texto) == esperada, texto
+
+
+def test_no_validas():
+    for texto in NO_VALIDAS:
+        assert parsear_fecha(texto) is None, texto
+        assert normalizar_fecha(texto, 'x') == 'x'
+
+
+def test_compatible_con_formatos_anteriores():
+    for texto in ('14-01-2025', '2025-01-14', '14/01/2025', '1-2-2025', 'No disponible'):
+        assert parsear_fecha(texto) == parsear_con_strptime(texto), texto
+
+
+def test_normalizar():
+    assert normalizar_fecha('2025-01-14') == '14/01/2025'
+
+
+def test_cache():
+    antes = estadisticas_cache()['aciertos']
+    parsear_fecha('15-01-2025')
+    parsear_fecha('15-01-2025')
+    assert estadisticas_cache()['aciertos'] > antes
+
+
+def benchmark(repeticiones=20000):
+    """
+    Compara el parseo con el anterior sobre las variantes del OCR
+    """
+    textos = list(VARIANTES) + [t for t in NO_VALIDAS if t]
+    for nombre, funcion in (('strptime', parsear_con_strptime), ('fechas', parsear_fecha)):
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            for texto in textos:
+                funcion(texto)
+        duracion = time.perf_counter() - inicio
+        print(f"{nombre}: {duracion * 1e6 / (repeticiones * len(textos)):.2f} µs por fecha")
+    print(estadisticas_cache())
+
+
+if __name__ == "__main__":
+    benchmark()
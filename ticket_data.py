@@ -0,0 +1,82 @@
+# ticket_data.py
+
+from datetime import datetime
+
+from fechas import parsear_fecha
+
+NO_DISPONIBLE = 'No disponible'
+
+
+def valor_efectivo(fila):
+    """
+    Valor sugerido de la fila, o el original si no hay sugerencia
+    """
+    return fila['original'] if fila['sugerido'] == NO_DISPONIBLE else fila['sugerido']
+
+
+class TicketData:
+    """
+    Datos de un tiquete parseado, construidos una sola vez a partir de
+    parsed_data: filas por campo, valores efectivos (sugerido salvo
+    'No disponible') y la fecha ya interpretada. Las filas son las mismas
+    de parsed_data, de modo que modificarlas actualiza parsed_data.
+    Si un campo aparece repetido, las lecturas usan su primera fila y
+    las ediciones deben aplicarse a todas las filas del campo (filas)
+    """
+
+    __slots__ = ('parsed_data', 'filas', 'campos', 'valores', 'fecha_texto', 'fecha')
+
+    def __init__(self, parsed_data):
+        self.parsed_data = parsed_data or {}
+        self.filas = {}
+        for fila in self.parsed_data.get('table_data', []):
+            self.filas.setdefault(fila['campo'], []).append(fila)
+        self.campos = {campo: filas[0] for campo, filas in self.filas.items()}
+        self.valores = {campo: valor_efectivo(fila) for campo, fila in self.campos.items()}
+
+        self.fecha_texto = self.valores.get('Fecha')
+        self.fecha = parsear_fecha(self.fecha_texto)
+
+    @classmethod
+    def de(cls, datos):
+        """
+        Retorna datos si ya es un TicketData o lo construye desde parsed_data
+        """
+        return datos if isinstance(datos, cls) else cls(datos)
+
+    def __bool__(self):
+        return bool(self.campos)
+
+    def actualizar(self, campo, sugerido):
+        """
+        Asigna el valor sugerido a todas las filas del campo. Retorna False
+        si el tiquete no tiene ese campo
+        """
+        filas = self.filas.get(campo, [])
+        for fila in filas:
+            fila['sugerido'] = sugerido
+        if filas:
+            self.valores[campo] = valor_efectivo(filas[0])
+        return bool(filas)
+
+    def valor(self, campo, default=''):
+        return self.valores.get(campo, default)
+
+    def original(self, campo, default=''):
+        fila = self.campos.get(campo)
+        return fila['original'] if fila else default
+
+    @property
+    def codigo(self):
+        return self.valores.get('Código', 'desconocido')
+
+    def fecha_registro(self, conservar_texto=False):
+        """
+        Fecha del tiquete como dd/mm/aaaa. Si no se pudo interpretar retorna
+        el texto leído (con conservar_texto) o la fecha actual
+        """
+        if self.fecha:
+            return self.fecha.strftime("%d/%m/%Y")
+        if conservar_texto and self.fecha_texto:
+            return self.fecha_texto
+        return datetime.now().strftime("%d/%m/%Y")
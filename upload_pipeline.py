@@ -0,0 +1,120 @@
+# upload_pipeline.py
+
+import os
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Firmas de los formatos de imagen aceptados
+FIRMAS_MIME = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+)
+
+TAMANO_BLOQUE = 64 * 1024
+
+
+class ArchivoRechazadoError(Exception):
+    """
+    Se lanza cuando un archivo subido excede el tamaño máximo o no es una
+    imagen aceptada. status es el código HTTP a retornar
+    """
+
+    def __init__(self, mensaje, status=400):
+        super().__init__(mensaje)
+        self.status = status
+
+
+def detectar_mime(cabecera):
+    """
+    Detecta el tipo de imagen por sus primeros bytes; None si no es aceptado
+    """
+    for firma, mime in FIRMAS_MIME:
+        if cabecera.startswith(firma):
+            return mime
+    return None
+
+
+class ArchivoRecibido:
+    """
+    Archivo guardado por el pipeline: ruta, hash SHA-256, tipo detectado y
+    tamaño. Si se pidió, archivo es el handle abierto para lectura. clave es
+    la ruta relativa en el almacén de uploads
+    """
+
+    __slots__ = ('ruta', 'filename', 'clave', 'hash', 'mime', 'tamano', 'archivo')
+
+    def __init__(self, ruta, hash, mime, tamano, archivo=None, clave=None):
+        self.ruta = ruta
+        self.filename = os.path.basename(ruta)
+        self.clave = clave or self.filename
+        self.hash = hash
+        self.mime = mime
+        self.tamano = tamano
+        self.archivo = archivo
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+    def cerrar(self):
+        if self.archivo is not None:
+            self.archivo.close()
+            self.archivo = None
+
+
+def guardar_stream(origen, ruta, max_bytes=None, mantener_abierto=False, tamano_bloque=TAMANO_BLOQUE):
+    """
+    Copia el stream a disco por bloques calculando el hash y detectando el
+    tipo de imagen en la misma pasada. Escribe en un temporal que solo se
+    renombra si el archivo es válido, de modo que un rechazo no pisa un
+    archivo existente. Con mantener_abierto retorna el archivo abierto para
+    lectura, sin volver a leerlo
+    """
+    sha = hashlib.sha256()
+    tamano = 0
+    mime = None
+    temp_path = f"{ruta}.{os.getpid()}.{threading.get_ident()}.part"
+
+    destino = open(temp_path, 'wb')
+    try:
+        while True:
+            bloque = origen.read(tamano_bloque)
+            if not bloque:
+                break
+            if not tamano:
+                mime = detectar_mime(bloque[:16])
+                if mime is None:
+                    raise ArchivoRechazadoError("El archivo no es una imagen válida.", status=415)
+            tamano += len(bloque)
+            if max_bytes and tamano > max_bytes:
+                raise ArchivoRechazadoError(
+                    f"El archivo supera el tamaño máximo de {max_bytes // (1024 * 1024)} MB.",
+                    status=413
+                )
+            sha.update(bloque)
+            destino.write(bloque)
+
+        if not tamano:
+            raise ArchivoRechazadoError("El archivo está vacío.")
+
+        destino.close()
+        os.replace(temp_path, ruta)
+    except BaseException:
+        destino.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    logger.info(f"Archivo recibido {os.path.basename(ruta)}: {tamano} bytes, {mime}")
+    return ArchivoRecibido(ruta, sha.hexdigest(), mime, tamano, open(ruta, 'rb') if mantener_abierto else None)
+
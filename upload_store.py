@@ -0,0 +1,206 @@
+# upload_store.py
+
+import os
+import re
+import time
+import uuid
+import logging
+import traceback
+from datetime import datetime
+
+from flask import url_for
+
+from db import conectar
+from upload_pipeline import guardar_stream, ArchivoRecibido
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONES_MIME = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/bmp': '.bmp',
+    'image/tiff': '.tiff',
+}
+
+# Claves con el hash del contenido en el nombre (AAAA/MM/DD/ab/<hash>.ext)
+RE_CLAVE_HASH = re.compile(r'^\d{4}/\d{2}/\d{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z]+$')
+
+
+class UploadStore:
+    """
+    Almacén de imágenes subidas nombradas por el hash de su contenido y
+    repartidas en subdirectorios fecha/prefijo del hash
+    (AAAA/MM/DD/ab/<hash>.jpg). Una imagen repetida se guarda una sola vez
+    y las guías que la usan comparten el archivo. La clave de una imagen es
+    su ruta relativa a la carpeta de uploads; las claves antiguas (nombre
+    plano) siguen siendo válidas
+    """
+
+    def __init__(self, carpeta, ruta_db, prefijo_url='uploads'):
+        self.carpeta = carpeta
+        self.ruta_db = ruta_db
+        self.prefijo_url = prefijo_url
+        self._temporal = os.path.join(carpeta, '.tmp')
+        os.makedirs(self._temporal, exist_ok=True)
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conexion = conectar(self.ruta_db)
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                hash TEXT PRIMARY KEY,
+                clave TEXT NOT NULL UNIQUE,
+                mime TEXT NOT NULL,
+                tamano INTEGER NOT NULL,
+                nombre_original TEXT NOT NULL DEFAULT '',
+                creado REAL NOT NULL,
+                ultimo_uso REAL NOT NULL
+            )
+        """)
+
+    def _clave_para(self, image_hash, mime):
+        fecha = datetime.now()
+        return '/'.join((
+            fecha.strftime('%Y'),
+            fecha.strftime('%m'),
+            fecha.strftime('%d'),
+            image_hash[:2],
+            f"{image_hash}{EXTENSIONES_MIME.get(mime, '.bin')}"
+        ))
+
+    def guardar(self, origen, nombre_original='', max_bytes=None, mantener_abierto=False):
+        """
+        Guarda el stream en el almacén y retorna un ArchivoRecibido con la
+        clave de la imagen. Si el contenido ya existía se reutiliza el archivo
+        y se actualiza su último uso
+        """
+        temp_path = os.path.join(self._temporal, uuid.uuid4().hex)
+        recibido = guardar_stream(origen, temp_path, max_bytes=max_bytes)
+
+        conexion = conectar(self.ruta_db)
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            fila = conexion.execute(
+                "SELECT clave FROM uploads WHERE hash = ?", (recibido.hash,)
+            ).fetchone()
+
+            if fila and os.path.exists(self.ruta(fila['clave'])):
+                clave = fila['clave']
+                os.remove(temp_path)
+                conexion.execute(
+                    "UPDATE uploads SET ultimo_uso = ? WHERE hash = ?",
+                    (time.time(), recibido.hash)
+                )
+                logger.info(f"Imagen repetida {nombre_original}, se reutiliza {clave}")
+            else:
+                clave = fila['clave'] if fila else self._clave_para(recibido.hash, recibido.mime)
+                ruta = self.ruta(clave)
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                os.replace(temp_path, ruta)
+                ahora = time.time()
+                conexion.execute(
+                    """
+                    INSERT OR REPLACE INTO uploads
+                        (hash, clave, mime, tamano, nombre_original, creado, ultimo_uso)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (recibido.hash, clave, recibido.mime, recibido.tamano, nombre_original, ahora, ahora)
+                )
+            conexion.execute("COMMIT")
+
+        except Exception as e:
+            conexion.execute("ROLLBACK")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            logger.error(f"Error guardando imagen en el almacén: {str(e)}")
+            logger.error(traceback.format_exc())
+            raise
+
+        ruta = self.ruta(clave)
+        return ArchivoRecibido(
+            ruta,
+            recibido.hash,
+            recibido.mime,
+            recibido.tamano,
+            open(ruta, 'rb') if mantener_abierto else None,
+            clave=clave
+        )
+
+    def guardar_upload(self, file_storage, max_bytes=None, mantener_abierto=False):
+        """
+        Guarda un archivo de request.files en el almacén
+        """
+        return self.guardar(
+            file_storage.stream,
+            file_storage.filename or '',
+            max_bytes=max_bytes,
+            mantener_abierto=mantener_abierto
+        )
+
+    def ruta(self, clave):
+        """
+        Ruta en disco de la imagen con la clave dada
+        """
+        ruta = os.path.normpath(os.path.join(self.carpeta, clave))
+        if not ruta.startswith(os.path.normpath(self.carpeta) + os.sep):
+            raise ValueError(f"Clave de imagen inválida: {clave}")
+        return ruta
+
+    def existe(self, clave):
+        return bool(clave) and os.path.exists(self.ruta(clave))
+
+    def es_inmutable(self, clave):
+        """
+        True si la clave lleva el hash del contenido, de modo que su URL
+        siempre sirve los mismos bytes y se puede cachear sin revalidar
+        """
+        return bool(RE_CLAVE_HASH.match(clave or ''))
+
+    def url(self, clave, externa=False):
+        """
+        URL pública de la imagen, para las plantillas
+        """
+        return url_for('static', filename=f"{self.prefijo_url}/{clave}", _external=externa)
+
+    def obtener(self, image_hash):
+        """
+        Retorna los datos de la imagen con el hash dado o None
+        """
+        fila = conectar(self.ruta_db).execute(
+            "SELECT * FROM uploads WHERE hash = ?", (image_hash,)
+        ).fetchone()
+        return dict(fila) if fila else None
+
+    def descartar(self, clave, desde):
+        """
+        Elimina una imagen guardada a partir de 'desde' que nadie volvió a
+        subir desde entonces, para deshacer una carga que falló. Retorna
+        True si se eliminó
+        """
+        conexion = conectar(self.ruta_db)
+        # El archivo se borra dentro de la transacción para que un guardar()
+        # concurrente del mismo contenido no lo reemplace a mitad de camino
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conexion.execute(
+                "DELETE FROM uploads WHERE clave = ? AND creado >= ? AND ultimo_uso = creado",
+                (clave, desde)
+            )
+            if cursor.rowcount:
+                ruta = self.ruta(clave)
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+        if cursor.rowcount:
+            logger.info(f"Imagen eliminada del almacén: {clave}")
+        return bool(cursor.rowcount)
+
+    def stats(self):
+        fila = conectar(self.ruta_db).execute(
+            "SELECT COUNT(*) AS archivos, COALESCE(SUM(tamano), 0) AS bytes FROM uploads"
+        ).fetchone()
+        return dict(fila)
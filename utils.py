@@ -1,12 +1,12 @@
 import os
-import qrcode
 import time
 from datetime import datetime
 import json
 import traceback
 import logging
-from weasyprint import HTML
-from flask import session, render_template, current_app
+from pdf_renderer import render_pdf
+from ticket_data import TicketData
+from flask import render_template, current_app
 
 logger = logging.getLogger(__name__)
 
@@ -43,92 +43,18 @@ class Utils:
             logger.error(traceback.format_exc())
             raise
 
-    def generate_qr(self, data, filename):
+    def nombre_pdf_tiquete(self, parsed_data):
         """
-        Genera un archivo QR y su guía HTML asociada
+        Nombre del PDF del tiquete: código del proveedor y fecha del tiquete
         """
-        try:
-            logger.info("Iniciando generación de QR")
-            
-            # Obtener el código del proveedor y generar código de guía
-            codigo_proveedor = data.get('codigo', '').strip()
-            timestamp = datetime.now()
-            fecha_hora = timestamp.strftime('%Y%m%d_%H%M%S')
-            html_filename = f"guia_{codigo_proveedor}_{fecha_hora}.html"
-            html_path = os.path.join(self.app.config['GUIAS_FOLDER'], html_filename)
-            
-            logger.info(f"Generando archivo HTML en: {html_path}")
+        ticket = TicketData.de(parsed_data)
+        return f'tiquete_{ticket.codigo}_{ticket.fecha_registro().replace("/", "-")}.pdf'
 
-            # Verificar existencia de imagen
-            image_filename = data.get('image_filename', '')
-            image_exists = False
-            if image_filename:
-                image_path = os.path.join(self.app.static_folder, 'uploads', image_filename)
-                logger.info(f"Verificando imagen en: {image_path}")  # Agregar este log
-                image_exists = os.path.exists(image_path)
-                if not image_exists:
-                    logger.warning(f"Imagen no encontrada en: {image_path}")
-                    image_filename = None
-
-                
-            # Obtener fecha del tiquete y fecha actual
-            fecha_tiquete = data.get('fecha', '')
-            fecha_actual = timestamp.strftime('%d/%m/%Y')
-            hora_actual = timestamp.strftime('%H:%M:%S')
-            
-            # Obtener los datos del tiquete
-            html_content = render_template(
-                'guia_template.html',
-                codigo=codigo_proveedor,
-                nombre=data.get('nombre', ''),
-                fecha_tiquete=fecha_tiquete,
-                fecha_registro=fecha_actual,
-                fecha=data.get('fecha', ''),
-                placa=data.get('placa', ''),
-                cantidad_racimos=data.get('cantidad_racimos', ''),
-                transportador=data.get('transportador', ''),
-                estado_actual='pesaje',
-                codigo_guia=f"{codigo_proveedor}_{fecha_hora}",
-                fecha_formato=fecha_actual,
-                hora_formato=hora_actual,  # Agregamos la coma aquí
-                pdf_filename=session.get('pdf_filename', '')  # Ahora esta línea está correcta
-            )
-            
-            # Guardar el archivo HTML
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
-                    
-            logger.info(f"Archivo HTML guardado: {os.path.exists(html_path)}")
-            
-            # Generar URL para el QR
-            base_url = "http://localhost:5002"
-            url = f"{base_url}/guias/{html_filename}"
-            
-            # Generar QR
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_H,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(url)
-            qr.make(fit=True)
-            
-            # Guardar QR
-            qr_image = qr.make_image(fill_color="black", back_color="white")
-            qr_image.save(filename)
-            
-            logger.info(f"QR generado exitosamente en: {filename}")
-            return filename
-                
-        except Exception as e:
-            logger.error(f"Error en generación QR: {str(e)}")
-            logger.error(traceback.format_exc())
-            raise
-
-    def generate_pdf(self, parsed_data, image_filename, fecha_procesamiento, hora_procesamiento, revalidation_data=None):
+    def generate_pdf(self, parsed_data, image_filename, fecha_procesamiento, hora_procesamiento, revalidation_data=None, qr_svg='',
+                     pdf_filename=None):
         """
-        Genera un PDF con los datos del tiquete
+        Genera un PDF con los datos del tiquete, con el nombre dado o el de
+        nombre_pdf_tiquete
         """
         try:
             logger.info("Iniciando generación de PDF")
@@ -140,13 +66,14 @@ class Utils:
                 logger.warning("Logo no encontrado. Se omitirá en el PDF")
             
             now = datetime.now()
+            ticket = TicketData.de(parsed_data)
             
             # Formatear fecha del tiquete
-            fecha_tiquete = self.format_date(parsed_data)
+            fecha_tiquete = ticket.fecha_registro()
             
             # Preparar datos para el PDF
             context = {
-                'parsed_data': parsed_data,
+                'parsed_data': ticket.parsed_data,
                 'revalidation_data': revalidation_data,
                 'image_filename': image_filename,
                 'fecha_registro': fecha_tiquete,
@@ -155,61 +82,51 @@ class Utils:
                 'fecha_emision': now.strftime("%d/%m/%Y"),
                 'hora_emision': now.strftime("%H:%M:%S"),
                 'logo_exists': os.path.exists(logo_path),
-                'qr_filename': session.get('qr_filename', '')
+                'qr_svg': qr_svg
             }
 
             # Generar PDF
             rendered = render_template('pdf_template.html', **context)
             
-            # Obtener código del tiquete
-            codigo = self.get_codigo_from_data(parsed_data)
-            
             # Generar nombre del archivo
-            pdf_filename = f'tiquete_{codigo}_{fecha_tiquete.replace("/", "-")}.pdf'
-            pdf_path = os.path.join(self.app.config['PDF_FOLDER'], pdf_filename)
-
-            # Asegurar que el directorio existe
-            os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-            
-            HTML(
-                string=rendered,
-                base_url=self.app.static_folder
-            ).write_pdf(pdf_path)
-            
-            logger.info(f"PDF generado exitosamente: {pdf_filename}")
-            return pdf_filename
+            pdf_filename = pdf_filename or self.nombre_pdf_tiquete(ticket)
+            return self.render_pdf(rendered, pdf_filename, 'pdf_tiquete.css')
             
         except Exception as e:
             logger.error(f"Error en generate_pdf: {str(e)}")
             logger.error(traceback.format_exc())
             raise
 
+    def render_pdf(self, rendered, pdf_filename, stylesheet=None):
+        """
+        Envía el HTML al pool de renderizado si está configurado; si no,
+        genera el PDF en la misma petición
+        """
+        renderer = self.app.extensions.get('pdf_renderer')
+        if renderer:
+            return renderer.submit(rendered, pdf_filename, stylesheet)
+
+        pdf_path = os.path.join(self.app.config['PDF_FOLDER'], pdf_filename)
+
+        # Asegurar que el directorio existe
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+        
+        render_pdf(rendered, pdf_path, self.app.static_folder, stylesheet)
+        
+        logger.info(f"PDF generado exitosamente: {pdf_filename}")
+        return pdf_filename
+
     def format_date(self, parsed_data):
         """
         Formatea la fecha del tiquete en un formato consistente
         """
-        for row in parsed_data.get('table_data', []):
-            if row['campo'] == 'Fecha':
-                fecha_str = row['original'] if row['sugerido'] == 'No disponible' else row['sugerido']
-                try:
-                    for fmt in ['%d-%m-%Y', '%Y-%m-%d', '%d/%m/%Y']:
-                        try:
-                            return datetime.strptime(fecha_str, fmt).strftime("%d/%m/%Y")
-                        except ValueError:
-                            continue
-                except Exception as e:
-                    logger.error(f"Error parseando fecha: {str(e)}")
-                    return fecha_str
-        return datetime.now().strftime("%d/%m/%Y")
+        return TicketData.de(parsed_data).fecha_registro()
 
     def get_codigo_from_data(self, parsed_data):
         """
         Obtiene el código del tiquete de los datos parseados
         """
-        for row in parsed_data.get('table_data', []):
-            if row['campo'] == 'Código':
-                return row['sugerido'] if row['sugerido'] != 'No disponible' else row['original']
-        return 'desconocido'
+        return TicketData.de(parsed_data).codigo
 
     def generar_codigo_guia(self, codigo_proveedor):
         """
@@ -230,30 +147,13 @@ class Utils:
         """
         Obtiene la fecha del tiquete de los datos parseados
         """
-        for row in parsed_data.get('table_data', []):
-            if row['campo'] == 'Fecha':
-                fecha_str = row['original'] if row['sugerido'] == 'No disponible' else row['sugerido']
-                try:
-                    for fmt in ['%d-%m-%Y', '%Y-%m-%d', '%d/%m/%Y']:
-                        try:
-                            fecha_obj = datetime.strptime(fecha_str, fmt)
-                            return fecha_obj.strftime("%d/%m/%Y")
-                        except ValueError:
-                            continue
-                except Exception as e:
-                    logger.error(f"Error parseando fecha: {str(e)}")
-                    return fecha_str
-        return datetime.now().strftime("%d/%m/%Y")
+        return TicketData.de(parsed_data).fecha_registro()
 
     def prepare_revalidation_data(self, parsed_data, data):
         """
         Prepara los datos de revalidación
         """
-        revalidation_data = {}
-        for row in parsed_data.get('table_data', []):
-            campo = row['campo']
-            valor = row['sugerido'] if row['sugerido'] != 'No disponible' else row['original']
-            revalidation_data[campo] = valor
+        revalidation_data = dict(TicketData.de(parsed_data).valores)
 
         if data:
             if data.get('Nombre'):
@@ -265,106 +165,6 @@ class Utils:
 
         return revalidation_data
 
-def obtener_datos_guia(self, codigo):
-    try:
-        # Obtener el código de guía actual
-        timestamp = datetime.now()
-        codigo_guia = f"{codigo}_{timestamp.strftime('%Y%m%d_%H%M%S')}"
-
-        datos = {
-            'codigo': codigo,
-            'codigo_guia': codigo_guia,
-            'nombre': '',
-            'fecha_registro': '',
-            'hora_registro': datetime.now().strftime("%H:%M:%S"),
-            'placa': '',
-            'transportador': '',
-            'cantidad_racimos': '',
-            'estado_actual': session.get('estado_actual', 'pesaje'),
-            'image_filename': session.get('image_filename', ''),
-            'pdf_filename': session.get('pdf_filename', ''),
-            # Datos de pesaje
-            'peso_bruto': session.get('peso_bruto', ''),
-            'tipo_pesaje': session.get('tipo_pesaje', ''),
-            'fecha_pesaje': session.get('fecha_pesaje', ''),
-            'hora_pesaje': session.get('hora_pesaje', ''),
-            'pdf_pesaje': session.get('pdf_pesaje', ''),
-            'imagen_pesaje': session.get('imagen_pesaje', '')
-        }
-        
-         # Obtener datos de la sesión
-        parsed_data = session.get('parsed_data', {})
-
-        if parsed_data and 'table_data' in parsed_data:
-            for row in parsed_data['table_data']:
-                campo = row['campo']
-                valor = row['original'] if row['sugerido'] == 'No disponible' else row['sugerido']
-                
-                if campo == 'Nombre del Agricultor':
-                    datos['nombre'] = valor
-                elif campo == 'Fecha':
-                    datos['fecha_registro'] = valor
-                elif campo == 'Placa':
-                    datos['placa'] = valor
-                elif campo == 'Cantidad de Racimos':
-                    datos['cantidad_racimos'] = valor
-                elif campo == 'Transportador':
-                    datos['transportador'] = valor
-        
-        # Extraer datos del parsed_data
-        if parsed_data and 'table_data' in parsed_data:
-            for row in parsed_data['table_data']:
-                campo = row['campo']
-                valor = row['original'] if row['sugerido'] == 'No disponible' else row['sugerido']
-                
-                if campo == 'Fecha':
-                    try:
-                        # Intentar diferentes formatos de fecha
-                        for fmt in ['%d-%m-%Y', '%Y-%m-%d', '%d/%m/%Y']:
-                            try:
-                                fecha_obj = datetime.strptime(valor, fmt)
-                                datos['fecha_registro'] = fecha_obj.strftime("%d/%m/%Y")
-                                break
-                            except ValueError:
-                                continue
-                        if not datos['fecha_registro']:
-                            datos['fecha_registro'] = valor
-                    except Exception as e:
-                        logger.error(f"Error parseando fecha: {str(e)}")
-                        datos['fecha_registro'] = valor
-                elif campo == 'Nombre del Agricultor':
-                    datos['nombre'] = valor
-                elif campo == 'Código':
-                    datos['codigo'] = valor
-                elif campo == 'Placa':
-                    datos['placa'] = valor
-                elif campo == 'Cantidad de Racimos':
-                    datos['cantidad_racimos'] = valor
-                elif campo == 'Transportador':
-                    datos['transportador'] = valor
-
-        # Si no se encontró fecha, usar la fecha actual
-        if not datos['fecha_registro']:
-            datos['fecha_registro'] = datetime.now().strftime("%d/%m/%Y")
-
-# Log para debug
-        logger.info(f"Datos de pesaje en sesión: peso={session.get('peso_bruto')}, "
-                   f"tipo={session.get('tipo_pesaje')}, "
-                   f"pdf={session.get('pdf_pesaje')}, "
-                   f"imagen={session.get('imagen_pesaje')}")            
-        
-        logger.info(f"Datos completos de guía: {datos}")
-        return datos
-        
-    except Exception as e:
-        logger.error(f"Error obteniendo datos de guía: {str(e)}")
-        logger.error(traceback.format_exc())
-        return {}
-
-    except Exception as e:
-        logger.error(f"Error obteniendo datos de guía: {str(e)}")
-        logger.error(traceback.format_exc())
-        return {}
 # Para mantener compatibilidad con código existente que no use la clase
 utils = None
 
@@ -0,0 +1,262 @@
+# webhook_client.py
+
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+# Límites superiores (segundos) de los buckets del histograma de latencia
+BUCKETS_LATENCIA = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class CircuitoAbiertoError(requests.exceptions.RequestException):
+    """
+    Se lanza cuando el circuito del endpoint está abierto por fallos consecutivos
+    """
+    pass
+
+
+def _sin_conexion(error):
+    """
+    Indica si el error de conexión ocurrió antes de enviar la petición
+    (conexión rechazada, DNS o timeout al conectar)
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    razon = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(razon, NewConnectionError)
+
+
+class _Endpoint:
+    """
+    Configuración, estado del circuito y métricas de un webhook
+    """
+
+    def __init__(self, nombre, url, timeout, reintentos, idempotente=True, plazo=None):
+        self.nombre = nombre
+        self.url = url
+        self.timeout = timeout
+        self.reintentos = reintentos
+        self.idempotente = idempotente
+        self.plazo = plazo
+        self.lock = threading.Lock()
+
+        # Circuit breaker
+        self.estado = 'cerrado'
+        self.fallos_consecutivos = 0
+        self.abierto_hasta = 0
+        self.prueba_en_curso = False
+
+        # Métricas
+        self.buckets = [0] * len(BUCKETS_LATENCIA)
+        self.llamadas = 0
+        self.latencia_total = 0.0
+        self.errores = 0
+        self.reintentos_realizados = 0
+        self.rechazos_circuito = 0
+        self.codigos = {}
+
+    def registrar_latencia(self, segundos, codigo=None):
+        with self.lock:
+            self.llamadas += 1
+            self.latencia_total += segundos
+            for i, limite in enumerate(BUCKETS_LATENCIA):
+                if segundos <= limite:
+                    self.buckets[i] += 1
+                    break
+            llave = str(codigo) if codigo is not None else 'error'
+            self.codigos[llave] = self.codigos.get(llave, 0) + 1
+
+    def metricas(self):
+        with self.lock:
+            return {
+                'url': self.url,
+                'timeout': self.timeout,
+                'reintentos': self.reintentos,
+                'idempotente': self.idempotente,
+                'plazo': self.plazo,
+                'circuito': self.estado,
+                'fallos_consecutivos': self.fallos_consecutivos,
+                'llamadas': self.llamadas,
+                'errores': self.errores,
+                'reintentos_realizados': self.reintentos_realizados,
+                'rechazos_circuito': self.rechazos_circuito,
+                'latencia_promedio': round(self.latencia_total / self.llamadas, 3) if self.llamadas else None,
+                'histograma': {
+                    ('+Inf' if limite == float('inf') else str(limite)): cantidad
+                    for limite, cantidad in zip(BUCKETS_LATENCIA, self.buckets)
+                },
+                'codigos': dict(self.codigos)
+            }
+
+
+class WebhookClient:
+    """
+    Cliente HTTP compartido para los webhooks de Make.com: conexiones
+    keep-alive reutilizables, timeout por endpoint, reintentos con backoff
+    exponencial y jitter, circuit breaker e histogramas de latencia
+    """
+
+    def __init__(self, pool_size=10, timeout=30, reintentos=2, backoff=0.5, backoff_max=8,
+                 umbral_fallos=5, enfriamiento=30):
+        self.timeout = timeout
+        self.reintentos = reintentos
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.umbral_fallos = umbral_fallos
+        self.enfriamiento = enfriamiento
+        self._endpoints = {}
+
+        # Los reintentos se manejan aquí, no en urllib3
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def registrar(self, nombre, url, timeout=None, reintentos=None, idempotente=True, plazo=None):
+        """
+        Registra un endpoint con su timeout y número de reintentos. Los
+        endpoints no idempotentes (el webhook pudo haber procesado la
+        petición aunque falle) solo se reintentan si no se pudo conectar.
+        Con plazo, la suma de todos los intentos y esperas no lo supera
+        """
+        self._endpoints[nombre] = _Endpoint(
+            nombre,
+            url,
+            timeout if timeout is not None else self.timeout,
+            reintentos if reintentos is not None else self.reintentos,
+            idempotente,
+            plazo
+        )
+
+    def url(self, nombre):
+        return self._endpoints[nombre].url
+
+    def post(self, nombre, **kwargs):
+        return self.request('POST', nombre, **kwargs)
+
+    def get(self, nombre, **kwargs):
+        return self.request('GET', nombre, **kwargs)
+
+    def request(self, metodo, nombre, timeout=None, **kwargs):
+        """
+        Envía la petición al endpoint registrado. Reintenta ante errores de
+        conexión y respuestas 5xx (los no idempotentes, solo si no se pudo
+        conectar); si se agotan los reintentos o el plazo del endpoint
+        retorna la última respuesta 5xx o relanza el último error de conexión
+        """
+        endpoint = self._endpoints[nombre]
+        es_prueba = self._verificar_circuito(endpoint)
+        try:
+            return self._enviar(endpoint, metodo, timeout, kwargs)
+        finally:
+            if es_prueba:
+                # Un error inesperado no debe dejar el circuito esperando una prueba que ya terminó
+                with endpoint.lock:
+                    endpoint.prueba_en_curso = False
+
+    def _enviar(self, endpoint, metodo, timeout, kwargs):
+        nombre = endpoint.nombre
+        timeout = timeout if timeout is not None else endpoint.timeout
+        intentos = endpoint.reintentos + 1
+        limite = time.monotonic() + endpoint.plazo if endpoint.plazo is not None else None
+
+        def restante():
+            return limite - time.monotonic() if limite is not None else float('inf')
+
+        for intento in range(intentos):
+            if intento:
+                espera = random.uniform(0, min(self.backoff_max, self.backoff * (2 ** intento), restante()))
+                logger.warning(f"Reintentando webhook {nombre} ({intento}/{endpoint.reintentos}) en {espera:.2f}s")
+                time.sleep(espera)
+                with endpoint.lock:
+                    endpoint.reintentos_realizados += 1
+                self._rebobinar_archivos(kwargs.get('files'))
+
+            # Cada intento dispone solo de lo que queda del plazo total
+            timeout_intento = max(0.1, min(timeout, restante()))
+
+            inicio = time.perf_counter()
+            try:
+                response = self.session.request(metodo, endpoint.url, timeout=timeout_intento, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                endpoint.registrar_latencia(time.perf_counter() - inicio)
+                logger.error(f"Error de conexión con webhook {nombre}: {str(e)}")
+                if intento == intentos - 1 or restante() < 1 or not (endpoint.idempotente or _sin_conexion(e)):
+                    self._registrar_fallo(endpoint)
+                    raise
+                continue
+            except requests.exceptions.RequestException:
+                # Un timeout de lectura no se reintenta: el webhook pudo haber procesado la petición
+                endpoint.registrar_latencia(time.perf_counter() - inicio)
+                self._registrar_fallo(endpoint)
+                raise
+
+            endpoint.registrar_latencia(time.perf_counter() - inicio, response.status_code)
+            if response.status_code >= 500 and intento < intentos - 1 and restante() >= 1 and endpoint.idempotente:
+                logger.error(f"Webhook {nombre} respondió {response.status_code}")
+                continue
+
+            if response.status_code >= 500:
+                self._registrar_fallo(endpoint)
+            else:
+                self._registrar_exito(endpoint)
+            return response
+
+    def _rebobinar_archivos(self, files):
+        if not files:
+            return
+        for valor in files.values():
+            archivo = valor[1] if isinstance(valor, (tuple, list)) else valor
+            if hasattr(archivo, 'seek'):
+                archivo.seek(0)
+
+    def _verificar_circuito(self, endpoint):
+        """
+        Lanza CircuitoAbiertoError si el circuito no deja pasar la petición.
+        Retorna True si la petición es la prueba del circuito semiabierto
+        """
+        with endpoint.lock:
+            if endpoint.estado == 'cerrado':
+                return False
+            if endpoint.estado == 'abierto' and time.time() >= endpoint.abierto_hasta:
+                endpoint.estado = 'semiabierto'
+                endpoint.prueba_en_curso = False
+            if endpoint.estado == 'semiabierto' and not endpoint.prueba_en_curso:
+                # Se deja pasar una sola petición de prueba
+                endpoint.prueba_en_curso = True
+                return True
+            endpoint.rechazos_circuito += 1
+        raise CircuitoAbiertoError(
+            f"Webhook {endpoint.nombre} no disponible temporalmente, intente de nuevo en unos segundos"
+        )
+
+    def _registrar_exito(self, endpoint):
+        with endpoint.lock:
+            if endpoint.estado != 'cerrado':
+                logger.info(f"Circuito del webhook {endpoint.nombre} cerrado")
+            endpoint.estado = 'cerrado'
+            endpoint.fallos_consecutivos = 0
+            endpoint.prueba_en_curso = False
+
+    def _registrar_fallo(self, endpoint):
+        with endpoint.lock:
+            endpoint.errores += 1
+            endpoint.fallos_consecutivos += 1
+            endpoint.prueba_en_curso = False
+            if endpoint.estado == 'semiabierto' or endpoint.fallos_consecutivos >= self.umbral_fallos:
+                endpoint.estado = 'abierto'
+                endpoint.abierto_hasta = time.time() + self.enfriamiento
+                logger.error(f"Circuito del webhook {endpoint.nombre} abierto por {self.enfriamiento}s")
+
+    def metrics(self):
+        """
+        Métricas por endpoint
+        """
+        return {nombre: endpoint.metricas() for nombre, endpoint in self._endpoints.items()}
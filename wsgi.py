@@ -0,0 +1,8 @@
+# wsgi.py
+#
+# Punto de entrada de producción:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+
+from apptiquetes import app
+
+application = app